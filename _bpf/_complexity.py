@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''Estimate how much work the verifier will have to do for a program.
+
+The verifier walks every path through a program, so big or branchy programs
+can take it seconds before they're rejected for hitting one of its limits.
+bpf only allows forward jumps, so we can count paths and what's on them
+with a single pass in each direction, and warn about limits we're likely to
+hit before we ever try loading.
+'''
+
+import bisect
+import collections
+
+from py2bpf._bpf import _instructions as bi
+
+_STACK_SIZE = 512
+
+Limits = collections.namedtuple(
+    'Limits', ['max_insns', 'max_processed_insns'])
+
+
+def _kern_version(major, minor):
+    return (major << 16) + (minor << 8)
+
+
+def get_limits(kern_version):
+    '''The verifier's limits for kern_version, as packed by
+    prog._get_kern_version
+    '''
+    if kern_version >= _kern_version(5, 2):
+        return Limits(max_insns=1000000, max_processed_insns=1000000)
+    elif kern_version >= _kern_version(4, 14):
+        return Limits(max_insns=4096, max_processed_insns=131072)
+    return Limits(max_insns=4096, max_processed_insns=65536)
+
+
+class Report:
+    '''What analyze found. num_paths is the number of paths from the start of
+    the program to a return, path_insns how many instructions all of those
+    add up to, and hot_spots pairs insns_to_info entries with how many of
+    those instructions they account for, worst first.
+    '''
+    def __init__(self, **kwargs):
+        self.num_insns = kwargs['num_insns']
+        self.num_paths = kwargs['num_paths']
+        self.longest_path = kwargs['longest_path']
+        self.max_calls = kwargs['max_calls']
+        self.stack_depth = kwargs['stack_depth']
+        self.path_insns = kwargs['path_insns']
+        self.estimated_processed_insns = kwargs['estimated_processed_insns']
+        self.hot_spots = kwargs['hot_spots']
+        self.warnings = kwargs['warnings']
+
+    def __str__(self):
+        lines = [
+            'Complexity:',
+            '  instructions: {}'.format(self.num_insns),
+            '  paths: {}'.format(self.num_paths),
+            '  longest path: {} instructions'.format(self.longest_path),
+            '  helper calls per path: {}'.format(self.max_calls),
+            '  stack depth: {} bytes'.format(self.stack_depth),
+            '  estimated instructions to verify: {}'.format(
+                self.estimated_processed_insns),
+        ]
+        if len(self.hot_spots) > 0:
+            lines.append('  hot spots:')
+            for info, n in self.hot_spots:
+                lines.append('    {}: {}'.format(n, info))
+        for w in self.warnings:
+            lines.append('  warning: {}'.format(w))
+        return '\n'.join(lines)
+
+
+def _get_raw_size(insn):
+    if isinstance(insn, bi.Label):
+        return 0
+    elif isinstance(insn, bi._Jump):
+        return 1
+    r = insn._raw()
+    return len(r) if isinstance(r, list) else 1
+
+
+def _get_successors(insns, labels, idx):
+    insn = insns[idx]
+    if isinstance(insn, bi.Ret):
+        return []
+    elif isinstance(insn, bi.Jump):
+        return [labels[insn.target]]
+    elif isinstance(insn, bi._CondJump):
+        ret = [labels[insn.target]]
+    else:
+        ret = []
+    if idx + 1 < len(insns):
+        ret.append(idx + 1)
+    return ret
+
+
+def _get_stack_depth(insns):
+    depth = 0
+    for idx, insn in enumerate(insns):
+        for o in [getattr(insn, 'src', None), getattr(insn, 'dst', None)]:
+            if isinstance(o, bi.Mem) and o.reg == bi.Reg.RSP:
+                depth = max(depth, -o.off)
+        # Taking the address of something on the stack
+        if (isinstance(insn, bi.Add) and isinstance(insn.src, bi.Imm) and
+                idx > 0 and isinstance(insns[idx - 1], bi.Mov) and
+                insns[idx - 1].src == bi.Reg.RSP and
+                insns[idx - 1].dst == insn.dst):
+            depth = max(depth, -insn.src.value)
+    return depth
+
+
+def _get_hot_spots(insns, insns_to_info, visits, num):
+    starts = sorted(insns_to_info)
+    if len(starts) == 0:
+        return []
+    totals = collections.Counter()
+    for idx, n in enumerate(visits):
+        pos = bisect.bisect_right(starts, idx) - 1
+        if pos >= 0 and n > 0:
+            totals[starts[pos]] += n
+    return [(insns_to_info[start], n) for start, n in totals.most_common(num)]
+
+
+def analyze(insns, insns_to_info, kern_version, num_hot_spots=5):
+    '''Analyze insns, as output by the template jit, against the limits for
+    kern_version. Returns a Report.
+    '''
+    labels = {insn.name: idx for idx, insn in enumerate(insns)
+              if isinstance(insn, bi.Label)}
+    succs = [_get_successors(insns, labels, idx) for idx in range(len(insns))]
+    sizes = [_get_raw_size(insn) for insn in insns]
+    calls = [1 if isinstance(insn, bi.Call) else 0 for insn in insns]
+
+    # Jumps only go forward, so index order is a topological order
+    paths_to = [0] * len(insns)
+    if len(insns) > 0:
+        paths_to[0] = 1
+    for idx in range(len(insns)):
+        for s in succs[idx]:
+            paths_to[s] += paths_to[idx]
+
+    paths_from = [0] * len(insns)
+    longest_from = [0] * len(insns)
+    calls_from = [0] * len(insns)
+    for idx in reversed(range(len(insns))):
+        if isinstance(insns[idx], bi.Ret):
+            paths_from[idx] = 1
+        paths_from[idx] += sum(paths_from[s] for s in succs[idx])
+        longest_from[idx] = sizes[idx] + max(
+            [longest_from[s] for s in succs[idx]] or [0])
+        calls_from[idx] = calls[idx] + max(
+            [calls_from[s] for s in succs[idx]] or [0])
+
+    # How many times each instruction shows up across all paths
+    visits = [paths_to[idx] * paths_from[idx] * sizes[idx]
+              for idx in range(len(insns))]
+
+    num_insns = sum(sizes)
+    num_paths = paths_from[0] if len(insns) > 0 else 0
+    path_insns = sum(visits)
+    if kern_version >= _kern_version(5, 3):
+        # Since 5.3, the verifier tracks which scalars actually matter, so
+        # it prunes most paths that join back up and mostly sees each
+        # instruction only a few times.
+        estimated = min(path_insns, num_insns * 4)
+    else:
+        # Before that, paths that set a variable to different constants
+        # look different and couldn't be pruned
+        estimated = path_insns
+
+    limits = get_limits(kern_version)
+    stack_depth = _get_stack_depth(insns)
+    warnings = []
+    if num_insns > limits.max_insns:
+        warnings.append('{} instructions is over the limit of {}'.format(
+            num_insns, limits.max_insns))
+    if estimated > limits.max_processed_insns:
+        warnings.append(
+            'the verifier will likely have to process more than its limit '
+            'of {} instructions'.format(limits.max_processed_insns))
+    if stack_depth > _STACK_SIZE:
+        warnings.append('{} bytes of stack is over the limit of {}'.format(
+            stack_depth, _STACK_SIZE))
+
+    return Report(
+        num_insns=num_insns,
+        num_paths=num_paths,
+        longest_path=longest_from[0] if len(insns) > 0 else 0,
+        max_calls=calls_from[0] if len(insns) > 0 else 0,
+        stack_depth=stack_depth,
+        path_insns=path_insns,
+        estimated_processed_insns=estimated,
+        hot_spots=_get_hot_spots(
+            insns, insns_to_info, visits, num_hot_spots),
+        warnings=warnings,
+    )
@@ -66,6 +66,8 @@ class _Op(enum.IntEnum):
     BPF_JSGE = 0x70
     BPF_CALL = 0x80
     BPF_EXIT = 0x90
+    BPF_JLT = 0xa0
+    BPF_JLE = 0xb0
 
 
 class _Insn(ctypes.Structure):
@@ -363,6 +365,14 @@ class JumpIfGreaterThan(_CondJump):
 class JumpIfGreaterOrEqual(_CondJump):
     CMP_OP_CODE = _Op.BPF_JGE
 
+
+class JumpIfLessThan(_CondJump):
+    CMP_OP_CODE = _Op.BPF_JLT
+
+
+class JumpIfLessOrEqual(_CondJump):
+    CMP_OP_CODE = _Op.BPF_JLE
+
 # TODO: am I right? What does S stand for?
 #
 # class JumpIfSignedGreaterThan(_CondJump):
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''Operations shared by all bpf objects, maps and programs alike: pinning
+them to a bpf filesystem, getting them back, and asking the kernel about
+them.
+'''
+
+import ctypes
+import enum
+import os
+
+from py2bpf._bpf import _syscall
+
+
+class _ObjCmd(enum.IntEnum):
+    PIN = 6
+    GET = 7
+    GET_INFO_BY_FD = 15
+
+
+class _BpfAttrObj(ctypes.Structure):
+    _fields_ = [
+        ('pathname', ctypes.c_uint64),
+        ('bpf_fd', ctypes.c_uint),
+        ('file_flags', ctypes.c_uint),
+    ]
+
+
+class _BpfAttrInfo(ctypes.Structure):
+    _fields_ = [
+        ('bpf_fd', ctypes.c_uint),
+        ('info_len', ctypes.c_uint),
+        ('info', ctypes.c_uint64),
+    ]
+
+
+def _raise(what, path=None):
+    eno = _syscall._get_errno()
+    raise OSError(eno, 'Failed to {}: {}'.format(what, os.strerror(eno)),
+                  path)
+
+
+def pin(fd, path):
+    '''Pin the object behind fd at path, which must be on a bpf filesystem
+    (usually mounted at /sys/fs/bpf), so it outlives us
+    '''
+    path_buf = ctypes.create_string_buffer(os.fsencode(path))
+    attr = _BpfAttrObj(pathname=ctypes.addressof(path_buf), bpf_fd=fd)
+    if _syscall.bpf(_ObjCmd.PIN, ctypes.byref(attr),
+                    ctypes.sizeof(attr)) != 0:
+        _raise('pin bpf object', path)
+
+
+def get_pinned(path):
+    '''Returns a new fd for the object pinned at path'''
+    path_buf = ctypes.create_string_buffer(os.fsencode(path))
+    attr = _BpfAttrObj(pathname=ctypes.addressof(path_buf))
+    fd = _syscall.bpf(_ObjCmd.GET, ctypes.byref(attr), ctypes.sizeof(attr))
+    if fd < 0:
+        _raise('get pinned bpf object', path)
+    return fd
+
+
+def get_info(fd, info_type):
+    '''Returns an info_type, like bpf_map_info or bpf_prog_info from
+    linux/bpf.h, describing the object behind fd. The kernel fills in as
+    much of it as it knows about.
+    '''
+    info = info_type()
+    attr = _BpfAttrInfo(bpf_fd=fd, info_len=ctypes.sizeof(info),
+                        info=ctypes.addressof(info))
+    if _syscall.bpf(_ObjCmd.GET_INFO_BY_FD, ctypes.byref(attr),
+                    ctypes.sizeof(attr)) != 0:
+        _raise('get bpf object info')
+    return info
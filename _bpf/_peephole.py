@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''Peephole optimization of the template jit's output.
+
+The templates are simple, which means that stitching them together leaves
+plenty of redundancy -- stores immediately reloaded, moves into scratch
+registers that are immediately moved out again, jumps to the next
+instruction, and so on. Each rule here looks at a short window of
+instructions and proposes a cheaper replacement, and we keep applying them
+until none match.
+'''
+
+import collections
+import os
+
+from py2bpf._bpf import _instructions as bi
+
+_rules = collections.OrderedDict()
+
+_U64_MASK = (1 << 64) - 1
+_CALL_ARG_REGS = frozenset([
+    bi.Reg.R1, bi.Reg.R2, bi.Reg.R3, bi.Reg.R4, bi.Reg.R5])
+_CALLER_SAVED_REGS = _CALL_ARG_REGS | frozenset([bi.Reg.R0])
+_ALL_REGS = frozenset(bi.Reg)
+
+
+def _peephole_rule(name):
+    '''This decorator just puts the function into the _rules map for
+    optimize to use. Rules take a _Context and an index and return None, or
+    the number of instructions to replace along with their replacement.
+    '''
+    def dec(f):
+        _rules[name] = f
+        return f
+
+    return dec
+
+
+def _get_regs(*operands):
+    ret = set()
+    for o in operands:
+        if isinstance(o, bi.Reg):
+            ret.add(o)
+        elif isinstance(o, bi.Mem):
+            ret.add(o.reg)
+    return ret
+
+
+def _get_uses_defs(insn):
+    '''Returns the registers read and written by insn'''
+    if isinstance(insn, bi.Label) or isinstance(insn, bi.Jump):
+        return set(), set()
+    elif isinstance(insn, bi.Mov):
+        if isinstance(insn.dst, bi.Mem):
+            return _get_regs(insn.src, insn.dst), set()
+        return _get_regs(insn.src), set([insn.dst])
+    elif isinstance(insn, bi._Alu64):
+        return _get_regs(insn.src, insn.dst), set([insn.dst])
+    elif isinstance(insn, bi.ChangeByteOrder):
+        return set([insn.dst]), set([insn.dst])
+    elif isinstance(insn, bi._CondJump):
+        return _get_regs(insn.src, insn.dst), set()
+    elif isinstance(insn, bi.Call):
+        return set(_CALL_ARG_REGS), set(_CALLER_SAVED_REGS)
+    elif isinstance(insn, bi.LoadSkb):
+        # Implicitly reads the context out of R6
+        return _get_regs(insn.src) | set([bi.Reg.R6]), set(_CALLER_SAVED_REGS)
+    elif isinstance(insn, bi.Ret):
+        return set([bi.Reg.R0]), set()
+    # Something we don't understand, so assume the worst
+    return set(_ALL_REGS), set()
+
+
+def _get_live_out(insns):
+    '''Returns, for each instruction, the set of registers that may be read
+    before being written after it executes. Jumps only go forward, so a
+    single backward pass is enough.
+    '''
+    label_idxs = {
+        insn.name: idx for idx, insn in enumerate(insns)
+        if isinstance(insn, bi.Label)
+    }
+    live_in = [None] * len(insns)
+    live_out = [None] * len(insns)
+    for idx in reversed(range(len(insns))):
+        insn = insns[idx]
+        out = set()
+        if (idx + 1 < len(insns) and
+                not isinstance(insn, bi.Jump) and not isinstance(insn, bi.Ret)):
+            out |= live_in[idx + 1]
+        if isinstance(insn, bi._Jump):
+            target_idx = label_idxs[insn.target]
+            assert target_idx > idx, 'only allow forward jumps'
+            out |= live_in[target_idx]
+        uses, defs = _get_uses_defs(insn)
+        live_out[idx] = out
+        live_in[idx] = uses | (out - defs)
+    return live_out
+
+
+class _Context:
+    def __init__(self, insns):
+        self.insns = insns
+        self.live_out = _get_live_out(insns)
+        self.targets = set(
+            insn.target for insn in insns if isinstance(insn, bi._Jump))
+
+    def get(self, idx, num):
+        '''Returns the num instructions starting at idx, or None if we'd run
+        off the end
+        '''
+        if idx + num > len(self.insns):
+            return None
+        return self.insns[idx:idx + num]
+
+    def is_dead_after(self, idx, reg):
+        return reg not in self.live_out[idx]
+
+
+@_peephole_rule('unreachable')
+def _unreachable(ctx, idx):
+    '''Anything between an unconditional jump and the next label can never
+    execute, and the verifier refuses to load it
+    '''
+    w = ctx.get(idx, 2)
+    if (w is not None and
+            (isinstance(w[0], bi.Jump) or isinstance(w[0], bi.Ret)) and
+            not isinstance(w[1], bi.Label)):
+        return 2, [w[0]]
+
+
+@_peephole_rule('unused_label')
+def _unused_label(ctx, idx):
+    # Nothing else can match across a label, so get rid of them if we can
+    insn = ctx.insns[idx]
+    if isinstance(insn, bi.Label) and insn.name not in ctx.targets:
+        return 1, []
+
+
+@_peephole_rule('jump_to_next')
+def _jump_to_next(ctx, idx):
+    insn = ctx.insns[idx]
+    if not isinstance(insn, bi._Jump):
+        return None
+    for nxt in ctx.insns[idx + 1:]:
+        if not isinstance(nxt, bi.Label):
+            return None
+        elif nxt.name == insn.target:
+            return 1, []
+
+
+@_peephole_rule('self_move')
+def _self_move(ctx, idx):
+    insn = ctx.insns[idx]
+    if (isinstance(insn, bi.Mov) and isinstance(insn.src, bi.Reg) and
+            insn.src == insn.dst):
+        return 1, []
+
+
+@_peephole_rule('identity_alu')
+def _identity_alu(ctx, idx):
+    insn = ctx.insns[idx]
+    if not isinstance(insn, bi._Alu64) or not isinstance(insn.src, bi.Imm):
+        return None
+    identities = {
+        bi.Add: 0,
+        bi.Sub: 0,
+        bi.BitOr: 0,
+        bi.BitXor: 0,
+        bi.LeftShift: 0,
+        bi.RightShift: 0,
+        bi.Multiply: 1,
+        bi.Divide: 1,
+        bi.BitAnd: -1,
+    }
+    if identities.get(type(insn)) == insn.src.value:
+        return 1, []
+
+
+_swapped_cond_jumps = {
+    bi.JumpIfEqual: bi.JumpIfEqual,
+    bi.JumpIfNotEqual: bi.JumpIfNotEqual,
+    bi.JumpIfGreaterThan: bi.JumpIfLessThan,
+    bi.JumpIfGreaterOrEqual: bi.JumpIfLessOrEqual,
+    bi.JumpIfLessThan: bi.JumpIfGreaterThan,
+    bi.JumpIfLessOrEqual: bi.JumpIfGreaterOrEqual,
+}
+
+
+def _eval_cond_jump(insn, val):
+    '''Returns whether insn jumps, if its dst holds val, or None if we don't
+    know how to tell
+    '''
+    lhs, rhs = val & _U64_MASK, insn.src.value & _U64_MASK
+    if isinstance(insn, bi.JumpIfEqual):
+        return lhs == rhs
+    elif isinstance(insn, bi.JumpIfNotEqual):
+        return lhs != rhs
+    elif isinstance(insn, bi.JumpIfGreaterThan):
+        return lhs > rhs
+    elif isinstance(insn, bi.JumpIfGreaterOrEqual):
+        return lhs >= rhs
+    elif isinstance(insn, bi.JumpIfLessThan):
+        return lhs < rhs
+    elif isinstance(insn, bi.JumpIfLessOrEqual):
+        return lhs <= rhs
+    return None
+
+
+@_peephole_rule('const_cond')
+def _const_cond(ctx, idx):
+    '''A constant compared against an immediate always goes the same way'''
+    w = ctx.get(idx, 2)
+    if (w is None or not isinstance(w[0], bi.Mov) or
+            type(w[0].src) != bi.Imm or not isinstance(w[1], bi._CondJump) or
+            type(w[1].src) != bi.Imm or w[1].dst != w[0].dst):
+        return None
+    taken = _eval_cond_jump(w[1], w[0].src.value)
+    if taken is None:
+        return None
+    return 2, [w[0]] + ([bi.Jump(w[1].target)] if taken else [])
+
+
+_SIZE_BYTES = {
+    bi.Size.Quad: 8,
+    bi.Size.Word: 4,
+    bi.Size.Short: 2,
+    bi.Size.Byte: 1,
+}
+
+
+def _is_zero_extended(insn, reg, size):
+    '''Whether insn leaves reg holding a value that fits in size'''
+    return (isinstance(insn, bi.Mov) and insn.dst == reg and
+            isinstance(insn.src, bi.Mem) and
+            _SIZE_BYTES[insn.src.size] <= _SIZE_BYTES[size])
+
+
+def _is_same_mem(a, b):
+    return (isinstance(a, bi.Mem) and isinstance(b, bi.Mem) and
+            a.reg == b.reg and a.off == b.off and a.size == b.size)
+
+
+@_peephole_rule('store_reload')
+def _store_reload(ctx, idx):
+    '''Reloading what we just stored can use the register we stored from, so
+    long as the store didn't truncate it
+    '''
+    w = ctx.get(idx, 3)
+    if w is None:
+        return None
+    load, store, reload = w
+    if (not isinstance(store, bi.Mov) or not isinstance(reload, bi.Mov) or
+            not isinstance(store.src, bi.Reg) or
+            not _is_same_mem(store.dst, reload.src) or
+            not isinstance(reload.dst, bi.Reg)):
+        return None
+    elif (store.dst.size != bi.Size.Quad and
+            not _is_zero_extended(load, store.src, store.dst.size)):
+        return None
+    return 3, [load, store, bi.Mov(store.src, reload.dst)]
+
+
+def _replace_src(insn, old, new):
+    '''Returns insn reading new in place of old, or None if we can't'''
+    if isinstance(new, bi.Mem) and not isinstance(insn, bi.Mov):
+        return None
+    elif isinstance(insn, bi.Mov):
+        if insn.src != old or (
+                isinstance(new, bi.Mem) and isinstance(insn.dst, bi.Mem)):
+            return None
+        return bi.Mov(new, insn.dst)
+    elif isinstance(insn, bi._Alu64):
+        if insn.src != old or insn.dst == old:
+            return None
+        elif (isinstance(new, bi.Imm) and new.value == 0 and
+                type(insn) in [bi.Divide, bi.Modulo]):
+            # The verifier rejects division by an immediate zero
+            return None
+        return type(insn)(new, insn.dst)
+    elif isinstance(insn, bi._CondJump):
+        if insn.src == old and insn.dst != old:
+            return type(insn)(new, insn.dst, insn.target)
+        elif (insn.dst == old and insn.src != old and
+                isinstance(insn.src, bi.Reg) and
+                type(insn) in _swapped_cond_jumps):
+            # Swap sides, flipping the comparison to match
+            return _swapped_cond_jumps[type(insn)](
+                new, insn.src, insn.target)
+    return None
+
+
+@_peephole_rule('copy_forward')
+def _copy_forward(ctx, idx):
+    '''A value moved into a register that's only read once, by the next
+    instruction, can go straight to that instruction
+    '''
+    w = ctx.get(idx, 2)
+    if (w is None or not isinstance(w[0], bi.Mov) or
+            not isinstance(w[0].dst, bi.Reg) or
+            type(w[0].src) not in [bi.Reg, bi.Imm, bi.Mem] or
+            not ctx.is_dead_after(idx + 1, w[0].dst)):
+        return None
+    # The replacement has to read the source before anything else clobbers
+    # it, which is guaranteed by only handling the immediately following
+    # instruction.
+    new = _replace_src(w[1], w[0].dst, w[0].src)
+    if new is None:
+        return None
+    return 2, [new]
+
+
+@_peephole_rule('retarget')
+def _retarget(ctx, idx):
+    '''A value computed in a scratch register and then moved somewhere else
+    can be computed there instead
+    '''
+    w = ctx.get(idx, 3)
+    if w is None:
+        return None
+    mov, alu, out = w
+    if (not isinstance(mov, bi.Mov) or not isinstance(alu, bi._Alu64) or
+            not isinstance(out, bi.Mov) or not isinstance(mov.dst, bi.Reg) or
+            alu.dst != mov.dst or out.src != mov.dst or
+            not isinstance(out.dst, bi.Reg) or out.dst == mov.dst or
+            out.dst in _get_regs(mov.src, alu.src) or
+            not ctx.is_dead_after(idx + 2, mov.dst)):
+        return None
+    return 3, [bi.Mov(mov.src, out.dst), type(alu)(alu.src, out.dst)]
+
+
+@_peephole_rule('dead_def')
+def _dead_def(ctx, idx):
+    '''Register writes that are never read can go'''
+    insn = ctx.insns[idx]
+    if ((isinstance(insn, bi.Mov) or isinstance(insn, bi._Alu64)) and
+            isinstance(insn.dst, bi.Reg) and ctx.is_dead_after(idx, insn.dst)):
+        return 1, []
+
+
+def get_enabled_rules():
+    '''Rules named in PY2BPF_PEEPHOLE, comma separated, or all of them if
+    it's unset
+    '''
+    names = os.environ.get('PY2BPF_PEEPHOLE')
+    if names is None:
+        return list(_rules.keys())
+    names = [n.strip() for n in names.split(',') if n.strip() != '']
+    for n in names:
+        if n not in _rules:
+            raise ValueError('Unknown peephole rule: {}'.format(n))
+    return names
+
+
+def _remap_info(items, insns_to_info):
+    '''Attach each piece of info to the first surviving instruction that came
+    from at or after where it used to be
+    '''
+    new_info = {}
+    origins = [origin for _, origin in items]
+    new_idx = 0
+    for old_idx in sorted(insns_to_info.keys()):
+        while new_idx < len(origins) and origins[new_idx] < old_idx:
+            new_idx += 1
+        if new_idx == len(origins):
+            break
+        if new_idx in new_info:
+            new_info[new_idx] += '\n' + insns_to_info[old_idx]
+        else:
+            new_info[new_idx] = insns_to_info[old_idx]
+    return new_info
+
+
+def _count_insns(insns):
+    return len([insn for insn in insns if not isinstance(insn, bi.Label)])
+
+
+def optimize(insns, insns_to_info, rules=None, verbose=False):
+    '''Apply the named peephole rules (default: all of them) to insns until
+    none of them match. Returns the new instructions, insns_to_info remapped
+    onto them, and a Counter of how many times each rule fired.
+    '''
+    if rules is None:
+        rules = list(_rules.keys())
+    rules = [(name, _rules[name]) for name in rules]
+
+    hits = collections.Counter()
+    items = [(insn, idx) for idx, insn in enumerate(insns)]
+    changed = True
+    while changed:
+        changed = False
+        ctx = _Context([insn for insn, _ in items])
+        new_items = []
+        idx = 0
+        while idx < len(items):
+            for name, rule in rules:
+                r = rule(ctx, idx)
+                if r is not None:
+                    break
+            else:
+                new_items.append(items[idx])
+                idx += 1
+                continue
+
+            num, replacement = r
+            if len(replacement) == num:
+                origins = [origin for _, origin in items[idx:idx + num]]
+            else:
+                origins = [items[idx][1]] * len(replacement)
+            new_items.extend(zip(replacement, origins))
+            hits[name] += 1
+            idx += num
+            changed = True
+        items = new_items
+
+    new_insns = [insn for insn, _ in items]
+    if verbose:
+        before, after = _count_insns(insns), _count_insns(new_insns)
+        print('Peephole: {} -> {} instructions ({} saved)'.format(
+            before, after, before - after))
+        for name, _ in rules:
+            print('  {}: {}'.format(name, hits[name]))
+
+    return new_insns, _remap_info(items, insns_to_info), hits
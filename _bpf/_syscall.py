@@ -10,28 +10,45 @@ import ctypes
 
 assert ctypes.sizeof(ctypes.c_char_p) == 8, 'x86_64 only'
 
+_NR_bpf = 321
+
 __libc = None
+__syscall = None
+__bpf = None
 
 
 def __get_libc():
     global __libc
     if __libc is None:
         # libc.so.6 ??
-        __libc = ctypes.cdll.LoadLibrary('libc.so.6')
+        __libc = ctypes.CDLL('libc.so.6', use_errno=True)
     return __libc
 
 
+def __get_syscall(restype, argtypes=None):
+    # Indexing, unlike getattr, gets us our own function pointer, so setting
+    # its types doesn't affect anyone else's
+    fn = __get_libc()['syscall']
+    fn.restype = restype
+    if argtypes is not None:
+        fn.argtypes = argtypes
+    return fn
+
+
 def syscall(num, *args):
-    __get_libc().syscall.restype = int
-    return __get_libc().syscall(num, *args)
+    global __syscall
+    if __syscall is None:
+        __syscall = __get_syscall(ctypes.c_long)
+    return __syscall(num, *args)
 
 
 def bpf(cmd, attr_p, attr_len):
-    _NR_bpf = 321
-    return syscall(_NR_bpf, cmd, attr_p, attr_len)
+    global __bpf
+    if __bpf is None:
+        __bpf = __get_syscall(ctypes.c_long, [
+            ctypes.c_long, ctypes.c_int, ctypes.c_void_p, ctypes.c_uint])
+    return __bpf(_NR_bpf, cmd, attr_p, attr_len)
 
 
 def _get_errno():
-    get_errno_loc = __get_libc().__errno_location
-    get_errno_loc.restype = ctypes.POINTER(ctypes.c_int)
-    return get_errno_loc()[0]
+    return ctypes.get_errno()
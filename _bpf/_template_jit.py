@@ -14,8 +14,10 @@ file.
 
 import ctypes
 import _ctypes
+import platform
 
-from py2bpf._translation import _labels, _mem, _stack, _types, _dis_plus as dis
+from py2bpf._translation import (
+    _labels, _mem, _regs, _stack, _types, _dis_plus as dis)
 from py2bpf._bpf import _instructions as bi
 from py2bpf import funcs
 from py2bpf._translation._datastructures import FileDescriptorDatastructure
@@ -63,6 +65,32 @@ def _get_cdata_size(var_type):
     }[ctypes.sizeof(var_type)]
 
 
+def _get_size_bytes(sz):
+    return {
+        bi.Size.Quad: 8,
+        bi.Size.Word: 4,
+        bi.Size.Short: 2,
+        bi.Size.Byte: 1,
+    }[sz]
+
+
+def _get_reg_imm(val, num_bytes):
+    '''Returns an immediate which puts val, zero-extended from num_bytes, into
+    a register. Mov sign-extends 32-bit immediates, so anything that doesn't
+    survive that takes the 64-bit form.
+    '''
+    if hasattr(val, 'value'):
+        val = val.value
+    if isinstance(val, bytes):
+        val = int.from_bytes(val, 'little')
+    val &= (1 << (8 * num_bytes)) - 1
+    if val >= 1 << 63:
+        val -= 1 << 64
+    if -(1 << 31) <= val < (1 << 31):
+        return bi.Imm(val)
+    return bi.Imm64(val)
+
+
 def _convert_var(var):
     if isinstance(var, _mem.ConstVar):
         assert issubclass(var.var_type, _ctypes._SimpleCData)
@@ -71,6 +99,8 @@ def _convert_var(var):
     elif isinstance(var, _stack.StackVar) or isinstance(var, _mem.ArgVar):
         sz = _get_cdata_size(var.var_type)
         return bi.Mem(_get_var_reg(var), var.offset, sz)
+    elif isinstance(var, _regs.RegVar):
+        return var.reg
     elif all([not isinstance(var, t) for t in [
             bi.Reg, bi.Mem, bi.Imm, bi.Imm64, bi.MapFdImm]]):
         raise NotImplemented('StackVar, ArgVar, ConstVar, what am I missing?')
@@ -78,34 +108,131 @@ def _convert_var(var):
     return var
 
 
-def _mov_const(val_type, val, reg, offset):
-    if issubclass(val_type, FileDescriptorDatastructure):
-        return (_mov(bi.MapFdImm(val.fd), bi.Reg.R0) +
-                _mov(bi.Reg.R0, bi.Mem(reg, offset, bi.Size.Quad)))
+# The stack pointer, and so every stack offset's base, is 8 byte aligned
+_STACK_ALIGN = 8
+
+# Packet data isn't aligned to anything in particular, but the verifier only
+# insists on aligned packet access where the cpu can't do without it
+_UNALIGNED_PACKET_ACCESS = platform.machine() in ['x86_64', 'aarch64']
+
+_CHUNKS = [
+    (8, bi.Size.Quad),
+    (4, bi.Size.Word),
+    (2, bi.Size.Short),
+    (1, bi.Size.Byte),
+]
 
+
+def _get_chunks(num_bytes, align, offset=0):
+    '''Split num_bytes, starting offset bytes from an address aligned to
+    align, into the widest aligned accesses. Returns (offset, num_bytes,
+    size) tuples, with offsets relative to the start.
+    '''
+    ret = []
+    off = 0
+    while off < num_bytes:
+        for n, sz in _CHUNKS:
+            if (n <= align and (offset + off) % n == 0 and
+                    off + n <= num_bytes):
+                break
+        ret.append((off, n, sz))
+        off += n
+    return ret
+
+
+def _fill_const_image(val_type, val, img, offset):
     if issubclass(val_type, _ctypes._SimpleCData):
         # They may have passed us a vanilla int here
         if hasattr(val, 'value'):
             val = val.value
-        dst_mem = bi.Mem(reg, offset, _get_cdata_size(val_type))
-        return [bi.Mov(bi.Imm(val), dst_mem)]
-    ret = []
-    if issubclass(val_type, ctypes.Array):
+        img[offset:offset + ctypes.sizeof(val_type)] = bytes(val_type(val))
+    elif issubclass(val_type, ctypes.Array):
         for i in range(val_type._length_):
             el_off = offset + ctypes.sizeof(val_type._type_) * i
             el = val[i] if i < len(val) else val_type._type_()
-            ret.extend(_mov_const(val_type._type_, el, reg, el_off))
+            _fill_const_image(val_type._type_, el, img, el_off)
     else:
         for f, t in val_type._fields_:
             f_val = getattr(val, f)
             f_off = getattr(val_type, f).offset
-            ret.extend(_mov_const(t, f_val, reg, offset + f_off))
+            _fill_const_image(t, f_val, img, offset + f_off)
+
+
+def _store_imm(val, mem):
+    '''Store val, truncated to the size of mem'''
+    imm = _get_reg_imm(val, _get_size_bytes(mem.size))
+    if not isinstance(imm, bi.Imm64):
+        return [bi.Mov(imm, mem)]
+    elif mem.size != bi.Size.Quad:
+        # Only the low bytes are stored, so sign-extension doesn't matter
+        return [bi.Mov(bi.Imm(imm.value - (1 << 32)), mem)]
+    return [bi.Mov(imm, bi.Reg.R0), bi.Mov(bi.Reg.R0, mem)]
+
+
+def _mov_const(val_type, val, reg, offset):
+    '''Lay val down at offset from reg, which has to be the stack pointer'''
+    if issubclass(val_type, FileDescriptorDatastructure):
+        return (_mov(bi.MapFdImm(val.fd), bi.Reg.R0) +
+                _mov(bi.Reg.R0, bi.Mem(reg, offset, bi.Size.Quad)))
+
+    img = bytearray(ctypes.sizeof(val_type))
+    _fill_const_image(val_type, val, img, 0)
+
+    # Store immediates are sign-extended from 32 bits, so quad words that
+    # don't survive that are stored as two words instead
+    ret = []
+    for off, n, sz in _get_chunks(len(img), _STACK_ALIGN, offset):
+        v = int.from_bytes(img[off:off + n], 'little', signed=True)
+        if n == 8 and not -(1 << 31) <= v < (1 << 31):
+            ret.extend([
+                bi.Mov(bi.Imm(int.from_bytes(
+                    img[o:o + 4], 'little', signed=True)),
+                    bi.Mem(reg, offset + o, bi.Size.Word))
+                for o in [off, off + 4]
+            ])
+        else:
+            ret.append(bi.Mov(bi.Imm(v), bi.Mem(reg, offset + off, sz)))
+    return ret
+
+
+def _mov_to_reg_var(src, dst):
+    num_bytes = ctypes.sizeof(dst.var_type)
+    if isinstance(src, _mem.ConstVar):
+        return [bi.Mov(_get_reg_imm(src.val, num_bytes), dst.reg)]
+
+    src = _convert_var(src)
+    if isinstance(src, bi.Imm):
+        return [bi.Mov(_get_reg_imm(src.value, num_bytes), dst.reg)]
+
+    ret = [bi.Mov(src, dst.reg)] if src != dst.reg else []
+
+    # On the stack, narrow vars are truncated by the store, so we have to do
+    # the same. Loads zero-extend, so they're already fine.
+    if num_bytes < 8 and not (isinstance(src, bi.Mem) and
+                              _get_size_bytes(src.size) <= num_bytes):
+        if num_bytes == 4:
+            ret.extend([
+                bi.LeftShift(bi.Imm(32), dst.reg),
+                bi.RightShift(bi.Imm(32), dst.reg),
+            ])
+        else:
+            ret.append(
+                bi.BitAnd(bi.Imm((1 << (8 * num_bytes)) - 1), dst.reg))
     return ret
 
 
 def _mov(src, dst):
     if isinstance(src, _mem.ConstVar) and isinstance(dst, _stack.StackVar):
         return _mov_const(src.var_type, src.val, _get_var_reg(dst), dst.offset)
+    elif isinstance(dst, _regs.RegVar):
+        return _mov_to_reg_var(src, dst)
+    elif (isinstance(src, _mem.ConstVar) and isinstance(dst, bi.Reg) and
+            issubclass(src.var_type, _ctypes._SimpleCData)):
+        num_bytes = ctypes.sizeof(src.var_type)
+        return [bi.Mov(_get_reg_imm(src.val, num_bytes), dst)]
+    elif (isinstance(src, _mem.ConstVar) and isinstance(dst, bi.Mem) and
+            issubclass(src.var_type, _ctypes._SimpleCData)):
+        return _store_imm(src.val, dst)
 
     src, dst = _convert_var(src), _convert_var(dst)
     if isinstance(src, bi.Mem) and isinstance(dst, bi.Mem):
@@ -150,15 +277,21 @@ def _lea(i, src, dst, stack, **kwargs):
         )
 
 
-def _memcpy(i, dst_reg, src_reg, num_bytes):
+def _get_ptr_align(var):
+    '''The alignment we know the address held by var to have'''
+    return getattr(var.var_type, 'align', 1)
+
+
+def _memcpy(i, dst_reg, src_reg, num_bytes, align=1):
+    '''Copy num_bytes between registers holding addresses aligned to align'''
     ret = []
     # Unpack ctype
     if hasattr(num_bytes, 'value'):
         num_bytes = num_bytes.value
 
-    for i in range(num_bytes):
-        sm = bi.Mem(src_reg, i, bi.Size.Byte)
-        dm = bi.Mem(dst_reg, i, bi.Size.Byte)
+    for off, n, sz in _get_chunks(num_bytes, align):
+        sm = bi.Mem(src_reg, off, sz)
+        dm = bi.Mem(dst_reg, off, sz)
         ret.extend(_mov(sm, dm))
 
     return ret
@@ -258,7 +391,8 @@ def _call_packet_copy(i, **kwargs):
     # if skb->data + offset + num_bytes > skb->data_end: goto out_of_bounds
     ret.append(bi.JumpIfGreaterThan(bi.Reg.R4, bi.Reg.R2, out_of_bounds))
 
-    ret.extend(_memcpy(i, bi.Reg.R1, bi.Reg.R3, num_bytes.val))
+    align = _get_ptr_align(dst_ptr) if _UNALIGNED_PACKET_ACCESS else 1
+    ret.extend(_memcpy(i, bi.Reg.R1, bi.Reg.R3, num_bytes.val, align))
 
     ret.append(bi.Label(out_of_bounds))
 
@@ -266,14 +400,16 @@ def _call_packet_copy(i, **kwargs):
 
 
 def _call_memcpy(i, **kwargs):
-    fn, dst_addr, src_addr, num_bytes = i.src_vars
+    # NB: unlike C's, our memcpy takes the source first
+    fn, src_addr, dst_addr, num_bytes = i.src_vars
     if not isinstance(num_bytes, _mem.ConstVar):
         raise TranslationError(i.starts_line, 'memcpy amount must be constant')
 
+    align = min(_get_ptr_align(src_addr), _get_ptr_align(dst_addr))
     return (
-        _mov(src_addr, bi.Reg.R1) +
-        _mov(dst_addr, bi.Reg.R2) +
-        _memcpy(i, bi.Reg.R1, bi.Reg.R2, num_bytes.val)
+        _mov(dst_addr, bi.Reg.R1) +
+        _mov(src_addr, bi.Reg.R2) +
+        _memcpy(i, bi.Reg.R1, bi.Reg.R2, num_bytes.val, align)
     )
 
 
@@ -291,6 +427,23 @@ def _call_deref(i, **kwargs):
             _mov(bi.Mem(bi.Reg.R0, 0, sz), i.dst_vars[0]))
 
 
+# Helper number for ringbuf_reserve, which is a pseudo-function so that it
+# can return a pointer to the queue's data_type
+_RINGBUF_RESERVE = 131
+
+
+def _call_ringbuf_reserve(i, **kwargs):
+    q = i.src_vars[1]
+    ret = _lea(i, q, bi.Reg.R1, **kwargs) + [
+        bi.Mov(bi.Imm(ctypes.sizeof(q.val.data_type)), bi.Reg.R2),
+        bi.Mov(bi.Imm(0), bi.Reg.R3),
+        bi.Call(bi.Imm(_RINGBUF_RESERVE)),
+    ]
+    if len(i.dst_vars) > 0:
+        ret.extend(_mov(bi.Reg.R0, i.dst_vars[0]))
+    return ret
+
+
 def _call_mem_eq(i, **kwargs):
     if (not isinstance(i.src_vars[1], _mem.ConstVar) or
             not issubclass(i.src_vars[1].var_type, ctypes.Array)):
@@ -298,15 +451,28 @@ def _call_mem_eq(i, **kwargs):
             i.starts_line, 'first arg to mem_eq must be const ctypes.Array')
     ret = []
 
-    # stack=None because we shouldn't need to allocate anything
-    ret.extend(_lea(i, i.src_vars[2], bi.Reg.R2, stack=None))
+    var = i.src_vars[2]
+    if _is_ptr(var.var_type):
+        ret.extend(_mov(var, bi.Reg.R2))
+        reg, base_off, align = bi.Reg.R2, 0, _get_ptr_align(var)
+    elif isinstance(var, _stack.StackVar):
+        # Compare straight off of the stack pointer
+        reg, base_off, align = bi.Reg.RSP, var.offset, _STACK_ALIGN
+    else:
+        # stack=None because we shouldn't need to allocate anything
+        ret.extend(_lea(i, var, bi.Reg.R2, stack=None))
+        reg, base_off, align = bi.Reg.R2, 0, 1
 
+    img = bytes(i.src_vars[1].val)
     false, done = _make_tmp_label(), _make_tmp_label()
-    for off, v in enumerate(i.src_vars[1].val.value):
-        ret.extend([
-            bi.Mov(bi.Mem(bi.Reg.R2, off, bi.Size.Byte), bi.Reg.R1),
-            bi.JumpIfNotEqual(bi.Imm(v), bi.Reg.R1, false)
-        ])
+    for off, n, sz in _get_chunks(len(img), align, base_off):
+        # Loads zero-extend, so compare unsigned
+        imm = _get_reg_imm(int.from_bytes(img[off:off + n], 'little'), n)
+        ret.append(bi.Mov(bi.Mem(reg, base_off + off, sz), bi.Reg.R1))
+        if isinstance(imm, bi.Imm64):
+            ret.append(bi.Mov(imm, bi.Reg.R3))
+            imm = bi.Reg.R3
+        ret.append(bi.JumpIfNotEqual(imm, bi.Reg.R1, false))
 
     # If we made it here, it's a match
     ret.extend(_mov(bi.Imm(1), i.dst_vars[0]))
@@ -340,6 +506,8 @@ def _call_pseudo_function(i, **kwargs):
         return _call_load_skb_word(i, **kwargs)
     elif fn.name == 'mem_eq':
         return _call_mem_eq(i, **kwargs)
+    elif fn.name == 'ringbuf_reserve':
+        return _call_ringbuf_reserve(i, **kwargs)
     else:
         raise TranslationError(
             i.starts_line, 'Reference to invalid pseudo-function: {}'.format(
@@ -396,30 +564,61 @@ def _call_function(i, **kwargs):
     return ret
 
 
+_compare_jumps = {
+    '<': bi.JumpIfLessThan,
+    '<=': bi.JumpIfLessOrEqual,
+    '>': bi.JumpIfGreaterThan,
+    '>=': bi.JumpIfGreaterOrEqual,
+    '==': bi.JumpIfEqual,
+    '!=': bi.JumpIfNotEqual,
+}
+
+_swapped_compare_ops = {
+    '<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '==', '!=': '!=',
+}
+
+_inverted_compare_ops = {
+    '<': '>=', '<=': '>', '>': '<=', '>=': '<', '==': '!=', '!=': '==',
+}
+
+
+def _compare_jump(lhs, op, rhs, target):
+    '''Jump to target if lhs op rhs'''
+    # Only the source of a jump can be an immediate, so keep consts there
+    if (isinstance(lhs, _mem.ConstVar) and
+            not isinstance(rhs, _mem.ConstVar)):
+        lhs, rhs, op = rhs, lhs, _swapped_compare_ops[op]
+
+    if isinstance(lhs, _regs.RegVar):
+        setup, dst = [], lhs.reg
+    else:
+        setup, dst = _mov(lhs, bi.Reg.R1), bi.Reg.R1
+    Op = _compare_jumps[op]
+    src_setup, src = _get_alu_src(rhs, Op, bi.Reg.R2)
+    return setup + src_setup + [Op(src, dst, target)]
+
+
+def _cond_jump(i, when):
+    '''Jump to i's target when its src, or the comparison of its srcs if
+    it was fused with a COMPARE_OP, is when
+    '''
+    target = 'label_{}'.format(i.argval)
+    if i.compare_op is not None:
+        op = i.compare_op
+        if not when:
+            op = _inverted_compare_ops[op]
+        return _compare_jump(i.src_vars[0], op, i.src_vars[1], target)
+    op = '!=' if when else '=='
+    return _compare_jump(
+        i.src_vars[0], op, _mem.ConstVar(ctypes.c_uint64(0)), target)
+
+
 @_opcode_translate(dis.OpCode.COMPARE_OP)
 def _compare_op(i, **kwargs):
     lhs, rhs = i.src_vars
-
-    op = i.argval
-    if op == '<':
-        lhs, rhs = rhs, lhs
-        op = '>'
-    elif op == '<=':
-        lhs, rhs = rhs, lhs
-        op = '>='
-
-    jmp_type = {
-        '>': bi.JumpIfGreaterThan,
-        '>=': bi.JumpIfGreaterOrEqual,
-        '==': bi.JumpIfEqual,
-        '!=': bi.JumpIfNotEqual,
-    }[op]
-
     true, done = _make_tmp_label(), _make_tmp_label()
     return (
-        _mov(lhs, bi.Reg.R1) +
-        _mov(rhs, bi.Reg.R2) +
-        [jmp_type(bi.Reg.R1, bi.Reg.R2, true)] +
+        _compare_jump(lhs, i.argval, rhs, true) +
         _mov(bi.Imm(0), i.dst_vars[0]) +
         [bi.Jump(done)] +
         [bi.Label(true)] +
@@ -430,18 +629,32 @@ def _compare_op(i, **kwargs):
 
 @_opcode_translate(dis.OpCode.POP_JUMP_IF_FALSE)
 def _pop_jump_if_false(i, **kwargs):
-    return (
-        _mov(i.src_vars[0], bi.Reg.R1) +
-        [bi.JumpIfEqual(bi.Imm(0), bi.Reg.R1, 'label_{}'.format(i.argval))]
-    )
+    return _cond_jump(i, False)
 
 
 @_opcode_translate(dis.OpCode.POP_JUMP_IF_TRUE)
 def _pop_jump_if_true(i, **kwargs):
-    return (
-        _mov(i.src_vars[0], bi.Reg.R1) +
-        [bi.JumpIfNotEqual(bi.Imm(0), bi.Reg.R1, 'label_{}'.format(i.argval))]
-    )
+    return _cond_jump(i, True)
+
+
+def _jump_or_pop(i, when):
+    # When fused, the value left behind if we jump is the comparison's
+    # result, which is when. Otherwise it's popped, so setting it early is
+    # harmless.
+    setup = []
+    if i.compare_op is not None:
+        setup = _mov(bi.Imm(int(when)), i.dst_vars[0])
+    return setup + _cond_jump(i, when)
+
+
+@_opcode_translate(dis.OpCode.JUMP_IF_FALSE_OR_POP)
+def _jump_if_false_or_pop(i, **kwargs):
+    return _jump_or_pop(i, False)
+
+
+@_opcode_translate(dis.OpCode.JUMP_IF_TRUE_OR_POP)
+def _jump_if_true_or_pop(i, **kwargs):
+    return _jump_or_pop(i, True)
 
 
 def _is_ptr(var_type):
@@ -461,56 +674,93 @@ def _load_fast(i, **kwargs):
     return _mov(i.src_vars[0], i.dst_vars[0])
 
 
+@_opcode_translate(dis.OpCode.LOAD_CONST)
+def _load_const(i, **kwargs):
+    # Only left behind for vars that have other sources as well
+    return _mov(i.src_vars[0], i.dst_vars[0])
+
+
+def _get_alu_src(var, Op, scratch):
+    '''Returns setup instructions and the operand to use for var as the
+    source of an alu op, avoiding a move where we can
+    '''
+    if isinstance(var, _regs.RegVar):
+        return [], var.reg
+    elif (isinstance(var, _mem.ConstVar) and
+            issubclass(var.var_type, _ctypes._SimpleCData)):
+        imm = _get_reg_imm(var.val, ctypes.sizeof(var.var_type))
+        # The verifier rejects division by an immediate zero
+        if isinstance(imm, bi.Imm) and not (
+                Op in [bi.Divide, bi.Modulo] and imm.value == 0):
+            return [], imm
+    return _mov(var, scratch), scratch
+
+
 def _binary_op(i, Op):
+    lhs, rhs, dv = i.src_vars[0], i.src_vars[1], i.dst_vars[0]
+
+    # Work in the destination register if there is one. It can't be the
+    # same as rhs's, because their live ranges overlap here.
+    dst_reg = dv.reg if isinstance(dv, _regs.RegVar) else bi.Reg.R0
+    setup, src = _get_alu_src(rhs, Op, bi.Reg.R1)
     return (
-        _mov(i.src_vars[0], bi.Reg.R0) +
-        _mov(i.src_vars[1], bi.Reg.R1) +
-        [Op(bi.Reg.R1, bi.Reg.R0)] +
-        _mov(bi.Reg.R0, i.dst_vars[0])
+        _mov(lhs, dst_reg) +
+        setup +
+        [Op(src, dst_reg)] +
+        _mov(dst_reg, dv)
     )
 
 
 @_opcode_translate(dis.OpCode.BINARY_TRUE_DIVIDE)
+@_opcode_translate(dis.OpCode.INPLACE_TRUE_DIVIDE)
 def _binary_true_divide(i, **kwargs):
     return _binary_op(i, bi.Divide)
 
 
 @_opcode_translate(dis.OpCode.BINARY_FLOOR_DIVIDE)
+@_opcode_translate(dis.OpCode.INPLACE_FLOOR_DIVIDE)
 def _binary_floor_divide(i, **kwargs):
     return _binary_op(i, bi.Divide)
 
 
 @_opcode_translate(dis.OpCode.BINARY_MULTIPLY)
+@_opcode_translate(dis.OpCode.INPLACE_MULTIPLY)
 def _binary_multiply(i, **kwargs):
     return _binary_op(i, bi.Multiply)
 
 
 @_opcode_translate(dis.OpCode.BINARY_ADD)
+@_opcode_translate(dis.OpCode.INPLACE_ADD)
 def _binary_add(i, **kwargs):
     return _binary_op(i, bi.Add)
 
 
 @_opcode_translate(dis.OpCode.BINARY_SUBTRACT)
+@_opcode_translate(dis.OpCode.INPLACE_SUBTRACT)
 def _binary_subtract(i, **kwargs):
     return _binary_op(i, bi.Sub)
 
 
 @_opcode_translate(dis.OpCode.BINARY_AND)
+@_opcode_translate(dis.OpCode.INPLACE_AND)
 def _binary_and(i, **kwargs):
     return _binary_op(i, bi.BitAnd)
 
 
 @_opcode_translate(dis.OpCode.BINARY_OR)
+@_opcode_translate(dis.OpCode.INPLACE_OR)
 def _binary_or(i, **kwargs):
     return _binary_op(i, bi.BitOr)
 
 
 @_opcode_translate(dis.OpCode.BINARY_RSHIFT)
+@_opcode_translate(dis.OpCode.INPLACE_RSHIFT)
 def _binary_rshift(i, **kwargs):
     return _binary_op(i, bi.RightShift)
 
 
 @_opcode_translate(dis.OpCode.BINARY_LSHIFT)
+@_opcode_translate(dis.OpCode.INPLACE_LSHIFT)
 def _binary_lshift(i, **kwargs):
     return _binary_op(i, bi.LeftShift)
 
@@ -582,14 +832,26 @@ def _load_attr(i, **kwargs):
 @_opcode_translate(dis.OpCode.STORE_ATTR)
 def _store_attr(i, **kwargs):
     val, obj = i.src_vars
-    reg = _get_var_reg(obj)
-    off = getattr(obj.var_type, i.argval).offset
-    if isinstance(obj, _stack.StackVar):
-        off += obj.offset
-    for f, t in obj.var_type._fields_:
+    setup = []
+    if _is_ptr(obj.var_type):
+        # Through a pointer, e.g. into a map value or ring buffer record.
+        # Storing val only needs R0.
+        obj_type = obj.var_type.var_type
+        if isinstance(obj, _regs.RegVar):
+            reg = obj.reg
+        else:
+            setup, reg = _mov(obj, bi.Reg.R1), bi.Reg.R1
+        off = getattr(obj_type, i.argval).offset
+    else:
+        obj_type = obj.var_type
+        reg = _get_var_reg(obj)
+        off = getattr(obj_type, i.argval).offset
+        if isinstance(obj, _stack.StackVar):
+            off += obj.offset
+    for f, t in obj_type._fields_:
         if f == i.argval:
             sz = _get_cdata_size(t)
-            return _mov(val, bi.Mem(reg, off, sz))
+            return setup + _mov(val, bi.Mem(reg, off, sz))
     assert False, 'Unreachable. Programmer error?'
 
 
@@ -626,19 +888,78 @@ def _binary_subscr_arr(i):
     )
 
 
+def _get_map_type(m):
+    return m.var_type.var_type if _is_ptr(m.var_type) else m.var_type
+
+
+def _call_map_helper(i, m, fn, setup):
+    '''Call fn with map m in R1, after setup has loaded the rest of the
+    args. m is either a constant, or a pointer to a map that came out of a
+    map of maps. The latter may be null, in which case the call is skipped
+    and R0 is 0, just like a failed lookup.
+    '''
+    if isinstance(m, _mem.ConstVar):
+        return (_mov(bi.MapFdImm(m.val.fd), bi.Reg.R1) + setup +
+                [bi.Call(bi.Imm(fn.num))])
+    elif not (_is_ptr(m.var_type) and issubclass(
+            m.var_type.var_type, FileDescriptorDatastructure)):
+        raise TranslationError(
+            i.starts_line, 'Cannot subscript dynamically selected map')
+
+    missing = _make_tmp_label()
+    return setup + [bi.Mov(bi.Imm(0), bi.Reg.R0)] + _mov(m, bi.Reg.R1) + [
+        bi.JumpIfEqual(bi.Imm(0), bi.Reg.R1, missing),
+        bi.Call(bi.Imm(fn.num)),
+        bi.Label(missing),
+    ]
+
+
+def _lea_map_key(i, m, k, dst, stack, **kwargs):
+    '''Load the address of key k for map m into dst. LPM tries can be
+    subscripted by the data in their keys, in which case we build a key
+    with a full length prefix around it.
+    '''
+    # Anything that isn't a map is rejected by _call_map_helper
+    key_type = getattr(_get_map_type(m), 'KEY_TYPE', None)
+    data_type = getattr(key_type, 'DATA_TYPE', None)
+    kt = k.var_type.var_type if _is_ptr(k.var_type) else k.var_type
+    if data_type is None or kt is key_type:
+        return _lea(i, k, dst, stack=stack, **kwargs)
+    elif ctypes.sizeof(kt) != ctypes.sizeof(data_type):
+        raise TranslationError(
+            i.starts_line, 'Cannot look up {} in trie of {}'.format(
+                kt.__name__, data_type.__name__))
+
+    # R0 is scratch for copies, and the other arguments are loaded after
+    # the key, so R3 is free to hold the data's address
+    key = stack.alloc(key_type)
+    key_reg = _get_var_reg(key)
+    data_off = key.offset + key_type.data.offset
+    if isinstance(k, _stack.StackVar):
+        align = _types.get_offset_align(_STACK_ALIGN, k.offset)
+    elif _is_ptr(k.var_type):
+        align = _get_ptr_align(k)
+    else:
+        align = 1
+    align = min(align, _types.get_offset_align(_STACK_ALIGN, data_off))
+    ret = [bi.Mov(bi.Imm(8 * ctypes.sizeof(data_type)),
+                  bi.Mem(key_reg, key.offset + key_type.prefixlen.offset,
+                         bi.Size.Word))]
+    ret.extend(_lea(i, k, bi.Reg.R3, stack=stack, **kwargs))
+    for off, n, sz in _get_chunks(ctypes.sizeof(data_type), align):
+        ret.extend(_mov(bi.Mem(bi.Reg.R3, off, sz),
+                        bi.Mem(key_reg, data_off + off, sz)))
+    ret.extend(_lea(i, key, dst, stack=stack, **kwargs))
+    return ret
+
+
 def _binary_subscr_map(i, **kwargs):
     m, k, dv = i.src_vars[0], i.src_vars[1], i.dst_vars[0]
-    if not isinstance(m, _mem.ConstVar):
-        raise TranslationError(
-            i.starts_line, 'Cannot subscript dynamically select map')
 
     found, done = _make_tmp_label(), _make_tmp_label()
-    ret = []
-    ret.extend(_mov(bi.MapFdImm(m.val.fd), bi.Reg.R1))
-    ret.extend(_lea(i, k, bi.Reg.R2, **kwargs))
-    ret.extend([
-        bi.Call(bi.Imm(funcs.map_lookup_elem.num)),
-    ])
+    ret = _call_map_helper(
+        i, m, funcs.map_lookup_elem,
+        _lea_map_key(i, m, k, bi.Reg.R2, **kwargs))
 
 
     if _is_ptr(dv.var_type):
@@ -650,8 +971,7 @@ def _binary_subscr_map(i, **kwargs):
         ])
 
         # Move default value
-        dr = _get_var_reg(dv)
-        ret.extend(_mov_const(dv.var_type, m.val.DEFAULT_VALUE, dr, dv.offset))
+        ret.extend(_mov(_mem.ConstVar(_get_map_type(m).DEFAULT_VALUE), dv))
 
         ret.extend([
             bi.Jump(done),
@@ -694,17 +1014,11 @@ def _store_subscr_arr(i):
 
 def _store_subscr_map(i, **kwargs):
     v, m, k = i.src_vars
-    if not isinstance(m, _mem.ConstVar):
-        raise TranslationError(
-            i.starts_line, 'Cannot subscript dynamically selected map')
-    return (
-        [bi.Mov(bi.MapFdImm(m.val.fd), bi.Reg.R1)] +
-        _lea(i, k, bi.Reg.R2, **kwargs) +
-        _lea(i, v, bi.Reg.R3, **kwargs) + [
-            bi.Mov(bi.Imm(0), bi.Reg.R4),
-            bi.Call(bi.Imm(funcs.map_update_elem.num))
-        ]
-    )
+    return _call_map_helper(
+        i, m, funcs.map_update_elem,
+        _lea_map_key(i, m, k, bi.Reg.R2, **kwargs) +
+        _lea(i, v, bi.Reg.R3, **kwargs) +
+        [bi.Mov(bi.Imm(0), bi.Reg.R4)])
 
 
 @_opcode_translate(dis.OpCode.STORE_SUBSCR)
@@ -717,29 +1031,13 @@ def _store_subscr(i, **kwargs):
 
 @_opcode_translate(dis.OpCode.DELETE_SUBSCR)
 def _delete_subscr(i, **kwargs):
-    if issubclass(i.src_vars[1].var_type, ctypes.Array):
+    if issubclass(_get_map_type(i.src_vars[0]), ctypes.Array):
         raise TranslationError(i.starts_line, 'Cannot delete from array')
 
     m, k = i.src_vars
-    if not isinstance(m, _mem.ConstVar):
-        raise TranslationError(
-            i.starts_line, 'Cannot delete from dynamically selected map')
-
-    return (
-        [bi.Mov(bi.MapFdImm(m.val.fd), bi.Reg.R1)] +
-        _lea(i, k, bi.Reg.R2, **kwargs) +
-        [bi.Call(bi.Imm(funcs.map_delete_elem.num))]
-    )
-
-
-@_opcode_translate(dis.OpCode.INPLACE_ADD)
-def _inplace_add(i, **kwargs):
-    return (
-        _mov(i.src_vars[0], bi.Reg.R0) +
-        _mov(i.src_vars[1], bi.Reg.R1) +
-        [bi.Add(bi.Reg.R1, bi.Reg.R0)] +
-        _mov(bi.Reg.R0, i.dst_vars[0])
-    )
+    return _call_map_helper(
+        i, m, funcs.map_delete_elem,
+        _lea_map_key(i, m, k, bi.Reg.R2, **kwargs))
 
 
 def _label(i):
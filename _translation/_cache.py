@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''On-disk cache of compiled programs.
+
+Translation is a pure function of the function's bytecode, the values its
+globals and closure variables are pinned to, the context type and the
+program type. We hash all of those into a key and store the raw
+instructions under it, along with a relocation table for the map fd
+immediates, because the fds themselves differ from run to run.
+'''
+
+import builtins
+import ctypes
+import _ctypes
+import hashlib
+import os
+import pickle
+import socket
+import struct
+import sys
+import types
+
+from py2bpf import funcs
+from py2bpf._bpf import _instructions as bi
+from py2bpf._translation import _folding, _dis_plus as dis
+from py2bpf._translation._datastructures import FileDescriptorDatastructure
+
+_CACHE_FORMAT_VERSION = 1
+
+# BPF_LD | BPF_IMM | BPF_DW with src set to BPF_PSEUDO_MAP_FD
+_LD_IMM64 = bi._Op.BPF_LD | bi._Op.BPF_IMM | bi._Op.BPF_DW
+_PSEUDO_MAP_FD = 1
+
+
+class _Uncacheable(Exception):
+    '''Raised when something that translation depends on can't be keyed'''
+    pass
+
+
+# Builtins that constant folding may call, whose results depend on nothing
+# but their arguments. Calls to any others can't be keyed.
+_PURE_BUILTINS = [
+    abs, all, any, bin, chr, divmod, hex, isinstance, issubclass, len, max,
+    min, oct, ord, pow, round, sorted, sum,
+    ctypes.alignment, ctypes.sizeof,
+    socket.htonl, socket.htons, socket.inet_aton, socket.inet_ntoa,
+    socket.inet_ntop, socket.inet_pton, socket.ntohl, socket.ntohs,
+    struct.calcsize, struct.pack, struct.unpack,
+]
+
+
+class CompiledProg:
+    '''Raw instructions which reference datastructures by index rather than
+    by fd, so that they outlive the fds they were compiled against
+    '''
+    def __init__(self, raw, relocs, insns_to_info):
+        self.raw = raw
+        self.relocs = relocs
+        self.insns_to_info = insns_to_info
+
+    def to_raw_instructions(self, datastructures):
+        num_insns = len(self.raw) // ctypes.sizeof(bi._Insn)
+        insns = (bi._Insn * num_insns).from_buffer_copy(self.raw)
+        for insn_idx, ds_idx in self.relocs:
+            fd = datastructures[ds_idx].fd
+            insns[insn_idx].imm = fd & 0xFFFFFFFF
+            insns[insn_idx + 1].imm = fd >> 32
+        return insns
+
+
+def from_raw_instructions(raw_insns, insns_to_info, datastructures,
+                          strict=True):
+    '''Build a CompiledProg, replacing map fd immediates with relocations
+    against datastructures. Unless strict, fds that aren't in datastructures
+    are left as they are.
+    '''
+    fd_to_idx = {ds.fd: idx for idx, ds in enumerate(datastructures)}
+    relocs = []
+    for idx, insn in enumerate(raw_insns):
+        if insn.code == _LD_IMM64 and insn.src == _PSEUDO_MAP_FD:
+            if insn.imm not in fd_to_idx:
+                if not strict:
+                    continue
+                raise _Uncacheable('fd {} not reachable from globals'.format(
+                    insn.imm))
+            relocs.append((idx, fd_to_idx[insn.imm]))
+    return CompiledProg(bytes(raw_insns), relocs, insns_to_info)
+
+
+def _describe_type(t, datastructures):
+    if issubclass(t, _ctypes._SimpleCData):
+        return ('simple', t.__name__, t._type_, ctypes.sizeof(t))
+    elif issubclass(t, ctypes.Array):
+        return ('array', _describe_type(t._type_, datastructures), t._length_)
+    elif issubclass(t, (ctypes.Structure, ctypes.Union)):
+        # Fields may carry a third element for bitfield widths
+        fields = tuple(
+            (f[0], _describe_type(f[1], datastructures),
+             getattr(t, f[0]).offset, tuple(f[2:]))
+            for f in t._fields_)
+        overrides = getattr(t, '_dest_type_overrides_', {})
+        return ('struct', t.__name__, ctypes.sizeof(t), fields, tuple(
+            (k, _describe_type(v, datastructures))
+            for k, v in sorted(overrides.items())))
+    elif issubclass(t, FileDescriptorDatastructure):
+        return ('datastructure', t.__module__, t.__qualname__, tuple(
+            (k, _describe(getattr(t, k), datastructures))
+            for k in sorted(dir(t)) if k.isupper()))
+    elif getattr(builtins, t.__name__, None) is t:
+        return ('builtin', t.__name__)
+    raise _Uncacheable('type {}'.format(t))
+
+
+def _describe_code(code, datastructures):
+    return ('code', code.co_argcount, code.co_kwonlyargcount, code.co_flags,
+            code.co_code, tuple(_describe(c, datastructures)
+                                for c in code.co_consts),
+            code.co_names, code.co_varnames, code.co_freevars,
+            code.co_cellvars, code.co_firstlineno, code.co_lnotab)
+
+
+def _describe(val, datastructures, functions=()):
+    '''Describe val as a tuple of primitives which changes whenever val would
+    translate differently. functions are those being described already, so
+    that recursive ones terminate.
+    '''
+    if val is None or isinstance(val, (bool, int, float, str, bytes)):
+        return (type(val).__name__, val)
+    elif isinstance(val, (tuple, list, frozenset)):
+        return (type(val).__name__,) + tuple(
+            _describe(v, datastructures, functions) for v in val)
+    elif isinstance(val, type):
+        return _describe_type(val, datastructures)
+    elif isinstance(val, (_ctypes._SimpleCData, ctypes.Array,
+                          ctypes.Structure, ctypes.Union)):
+        return ('cdata', _describe_type(type(val), datastructures), bytes(val))
+    elif isinstance(val, FileDescriptorDatastructure):
+        if all(ds is not val for ds in datastructures):
+            datastructures.append(val)
+        # Queues' data_type decides what ringbuf_reserve returns
+        return ('fd', _describe_type(type(val), datastructures),
+                _describe(getattr(val, 'data_type', None), datastructures))
+    elif isinstance(val, (funcs.Func, funcs.PseudoFunc)):
+        return (type(val).__name__, val.name, getattr(val, 'num', None),
+                val.num_args, _describe_type(val.return_type, datastructures),
+                tuple(getattr(val, 'fill_array_size_args', [])))
+    elif isinstance(val, types.CodeType):
+        return _describe_code(val, datastructures)
+    elif isinstance(val, types.FunctionType):
+        # Called at fold time, so what it returns depends on its code and
+        # on everything it reads from its globals and closure
+        if any(f is val for f in functions):
+            return ('function', val.__module__, val.__qualname__)
+        functions += (val,)
+        return ('function', val.__module__, val.__qualname__,
+                _describe_code(val.__code__, datastructures),
+                _describe(val.__defaults__, datastructures, functions),
+                tuple(_describe(v, datastructures, functions)
+                      for v in _get_called_values(val)))
+    elif isinstance(val, types.BuiltinFunctionType):
+        if all(f is not val for f in _PURE_BUILTINS):
+            raise _Uncacheable('impure builtin {}'.format(val.__qualname__))
+        return ('builtin', getattr(val, '__module__', None), val.__qualname__)
+    raise _Uncacheable('value {}'.format(repr(val)))
+
+
+def _follow_attrs(val, instructions):
+    '''Follow the attribute loads at the start of instructions off of val'''
+    for j in instructions:
+        if j.opcode != dis.OpCode.LOAD_ATTR:
+            break
+        try:
+            val = getattr(val, j.argval)
+        except AttributeError:
+            raise _Uncacheable('{}.{}'.format(repr(val), j.argval))
+    return val
+
+
+def _get_pinned_values(fn):
+    '''Resolve every global and closure load in fn, following attribute
+    loads off of them the way that constant folding will
+    '''
+    instructions = dis.strip_extended_args(
+        dis.get_instructions(fn.__code__))
+    values = []
+    for idx, i in enumerate(instructions):
+        if i.opcode not in [dis.OpCode.LOAD_GLOBAL, dis.OpCode.LOAD_DEREF]:
+            continue
+        val = _folding.get_global_value(fn, i)
+        values.append(_follow_attrs(val, instructions[idx + 1:]))
+    return values
+
+
+def _get_called_values(fn):
+    '''Like _get_pinned_values, for a function called at fold time. Code
+    nested in it (lambdas, comprehensions) reads the same globals and
+    closure, so that's resolved too. Loads of cells that fn creates itself
+    are of its own locals, so they're skipped.
+    '''
+    closure = dict(zip(fn.__code__.co_freevars, fn.__closure__ or ()))
+    values = []
+    codes = [fn.__code__]
+    while len(codes) > 0:
+        code = codes.pop()
+        codes.extend(c for c in code.co_consts
+                     if isinstance(c, types.CodeType))
+        instructions = dis.strip_extended_args(dis.get_instructions(code))
+        for idx, i in enumerate(instructions):
+            if i.opcode == dis.OpCode.LOAD_GLOBAL:
+                if i.argval in fn.__globals__:
+                    val = fn.__globals__[i.argval]
+                elif hasattr(builtins, i.argval):
+                    val = getattr(builtins, i.argval)
+                else:
+                    raise NameError(
+                        'name \'{}\' not defined'.format(i.argval))
+            elif i.opcode == dis.OpCode.LOAD_DEREF:
+                if i.argval not in closure:
+                    continue
+                try:
+                    val = closure[i.argval].cell_contents
+                except ValueError:
+                    raise NameError(
+                        'name \'{}\' not defined'.format(i.argval))
+            else:
+                continue
+            values.append(_follow_attrs(val, instructions[idx + 1:]))
+    return values
+
+
+_compiler_digest = None
+
+
+def _get_compiler_digest():
+    '''Hash of our own translation sources, so upgrading py2bpf invalidates
+    everything it compiled before
+    '''
+    global _compiler_digest
+    if _compiler_digest is None:
+        h = hashlib.sha256()
+        pkg_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for d in [pkg_dir, os.path.join(pkg_dir, '_bpf'),
+                  os.path.join(pkg_dir, '_translation')]:
+            for name in sorted(os.listdir(d)):
+                if name.endswith('.py'):
+                    with open(os.path.join(d, name), 'rb') as f:
+                        h.update(name.encode())
+                        h.update(f.read())
+        _compiler_digest = h.hexdigest()
+    return _compiler_digest
+
+
+def get_key(prog_type, ctx_type, fn, options=()):
+    '''Returns (key, datastructures), where datastructures are the fd-backed
+    objects that relocations index into. key is None if fn can't be cached.
+    options is a tuple of anything else that changes translation.
+    '''
+    datastructures = []
+    try:
+        desc = (
+            _CACHE_FORMAT_VERSION,
+            tuple(sys.version_info),
+            _get_compiler_digest(),
+            int(prog_type),
+            _describe_type(ctx_type, datastructures),
+            _describe_code(fn.__code__, datastructures),
+            _describe(options, datastructures),
+            tuple(_describe(v, datastructures)
+                  for v in _get_pinned_values(fn)),
+        )
+    except (_Uncacheable, NameError):
+        return None, datastructures
+    return hashlib.sha256(repr(desc).encode()).hexdigest(), datastructures
+
+
+def _get_path(cache_dir, key):
+    return os.path.join(cache_dir, '{}.bpf'.format(key))
+
+
+def load(cache_dir, key):
+    '''Returns the CompiledProg stored under key, or None'''
+    try:
+        with open(_get_path(cache_dir, key), 'rb') as f:
+            raw, relocs, insns_to_info = pickle.load(f)
+    except Exception:
+        # Missing, unreadable, and corrupt entries are all just misses
+        return None
+    return CompiledProg(raw, relocs, insns_to_info)
+
+
+def store(cache_dir, key, raw_insns, insns_to_info, datastructures):
+    '''Atomically store the program under key. Programs that reference
+    datastructures we can't relocate are skipped, and failure to write is
+    not fatal.
+    '''
+    try:
+        compiled = from_raw_instructions(
+            raw_insns, insns_to_info, datastructures)
+    except _Uncacheable:
+        return
+
+    path = _get_path(cache_dir, key)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(
+                (compiled.raw, compiled.relocs, compiled.insns_to_info), f)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
@@ -45,3 +45,35 @@ def opcode_key_wrapper(f):
                 raise ValueError(msg) from e
 
     return g
+
+
+def strip_extended_args(instructions):
+    '''dis already folds EXTENDED_ARG into the arg of the instruction that
+    follows it, so drop them, moving any jump targets and line starts on
+    to the instruction that they extend.
+    '''
+    ret = []
+    redirects = {}
+    pending = []
+    for i in instructions:
+        if i.opcode == OpCode.EXTENDED_ARG:
+            pending.append(i)
+            continue
+
+        if len(pending) > 0:
+            starts_line = pending[0].starts_line
+            if starts_line is None:
+                starts_line = i.starts_line
+            is_jump_target = any([p.is_jump_target for p in pending + [i]])
+            i = i._replace(
+                starts_line=starts_line, is_jump_target=is_jump_target)
+            for p in pending:
+                redirects[p.offset] = i.offset
+            pending = []
+        ret.append(i)
+
+    return [
+        i._replace(argval=redirects[i.argval])
+        if i.opcode in hasjmp and i.argval in redirects else i
+        for i in ret
+    ]
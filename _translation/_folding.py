@@ -12,9 +12,12 @@ loading globals into constants and applying constant folding.
 
 import collections
 import ctypes
-import py2bpf.datastructures
+import _ctypes
+import heapq
+import operator
 import py2bpf.funcs
 from py2bpf._translation import _vars, _dis_plus as dis
+from py2bpf._translation._datastructures import RuntimeDatastructure
 
 
 def _make_const(old, const_val):
@@ -27,22 +30,28 @@ def _make_const(old, const_val):
     return vi
 
 
+def get_global_value(src_fn, i):
+    '''Resolve the value loaded by a LOAD_GLOBAL or LOAD_DEREF instruction'''
+    if i.opcode == dis.OpCode.LOAD_GLOBAL:
+        if i.argval in src_fn.__globals__:
+            return src_fn.__globals__[i.argval]
+        elif i.argval in __builtins__:
+            return __builtins__[i.argval]
+        else:
+            raise NameError('name \'{}\' not defined'.format(i.argval))
+    elif i.opcode == dis.OpCode.LOAD_DEREF:
+        try:
+            return src_fn.__closure__[i.arg].cell_contents
+        except ValueError:
+            raise NameError('name \'{}\' not defined'.format(i.argval))
+    assert False, 'Programmer error: {} is not a global load'.format(i.opname)
+
+
 def pin_globals_to_consts(src_fn, vis):
     ret = []
     for i in vis:
-        if i.opcode == dis.OpCode.LOAD_GLOBAL:
-            if i.argval in src_fn.__globals__:
-                ret.append(_make_const(i, src_fn.__globals__[i.argval]))
-            elif i.argval in __builtins__:
-                ret.append(_make_const(i, __builtins__[i.argval]))
-            else:
-                raise NameError('name \'{}\' not defined'.format(i.argval))
-        elif i.opcode == dis.OpCode.LOAD_DEREF:
-            try:
-                v = src_fn.__closure__[i.arg].cell_contents
-            except ValueError:
-                raise NameError('name \'{}\' not defined'.format(i.argval))
-            ret.append(_make_const(i, v))
+        if i.opcode in [dis.OpCode.LOAD_GLOBAL, dis.OpCode.LOAD_DEREF]:
+            ret.append(_make_const(i, get_global_value(src_fn, i)))
         else:
             ret.append(i)
 
@@ -62,90 +71,295 @@ def reinterpret_const_strings(vis):
     return ret
 
 
-def fold_consts(vis):
-    '''Fold constants within instructions. Leaves dead LOAD_CONSTs around'''
-    class Const:
-        def __init__(self, val):
-            self.val = val
+_binary_ops = {
+    dis.OpCode.BINARY_TRUE_DIVIDE: operator.truediv,
+    dis.OpCode.BINARY_FLOOR_DIVIDE: operator.floordiv,
+    dis.OpCode.BINARY_MULTIPLY: operator.mul,
+    dis.OpCode.BINARY_ADD: operator.add,
+    dis.OpCode.BINARY_SUBTRACT: operator.sub,
+    dis.OpCode.BINARY_AND: operator.and_,
+    dis.OpCode.BINARY_OR: operator.or_,
+    dis.OpCode.BINARY_LSHIFT: operator.lshift,
+    dis.OpCode.BINARY_RSHIFT: operator.rshift,
+    # We don't want to mutate anything in place at translation time, so
+    # these are evaluated like their BINARY_ equivalents
+    dis.OpCode.INPLACE_TRUE_DIVIDE: operator.truediv,
+    dis.OpCode.INPLACE_FLOOR_DIVIDE: operator.floordiv,
+    dis.OpCode.INPLACE_MULTIPLY: operator.mul,
+    dis.OpCode.INPLACE_ADD: operator.add,
+    dis.OpCode.INPLACE_SUBTRACT: operator.sub,
+    dis.OpCode.INPLACE_AND: operator.and_,
+    dis.OpCode.INPLACE_OR: operator.or_,
+    dis.OpCode.INPLACE_LSHIFT: operator.lshift,
+    dis.OpCode.INPLACE_RSHIFT: operator.rshift,
+}
+
+_compare_ops = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+    'is': operator.is_,
+    'is not': operator.is_not,
+}
+
+# Only these are safe to propagate through named variables, because
+# anything else could be modified between the store and the load
+_immutable_scalar_types = (bool, int, float, str, bytes, type(None))
+
+
+class _Unfoldable(Exception):
+    pass
+
+
+def _unbox(val):
+    # ctypes primitives don't do math or compare by value
+    if isinstance(val, _ctypes._SimpleCData):
+        return val.value
+    return val
+
+
+def _check_u64(*vals):
+    '''bpf does integer math in unsigned 64-bit registers, wrapping as it
+    goes, and compares unsigned. Python ints are unbounded and signed, so we
+    only fold where the two agree: ints that fit in a u64.
+    '''
+    for v in vals:
+        if isinstance(v, int) and not 0 <= v < 1 << 64:
+            raise _Unfoldable()
+
+
+_shift_ops = set([
+    dis.OpCode.BINARY_LSHIFT, dis.OpCode.BINARY_RSHIFT,
+    dis.OpCode.INPLACE_LSHIFT, dis.OpCode.INPLACE_RSHIFT,
+])
 
-        def __repr__(self):
-            return 'Const({})'.format(repr(self.val))
 
-    class Multi:
-        pass
+def _eval(i, srcs):
+    '''Evaluate i with const srcs, or raise _Unfoldable'''
+    if i.opcode == dis.OpCode.CALL_FUNCTION:
+        # srcs = [fn] + [args] + [keyword, arg, ...]
+        nargs, nkwargs = (i.arg & 0xff), (i.arg >> 8)
+        fn = srcs[0]
+        if (isinstance(fn, py2bpf.funcs.Func) or
+                isinstance(fn, py2bpf.funcs.PseudoFunc)):
+            # This is a bpf function, so don't try to fold it
+            raise _Unfoldable()
+        args = srcs[1:nargs + 1]
+        kwargs = {
+            srcs[nargs + 1 + i]: srcs[nargs + 2 + i] for i in range(nkwargs)
+        }
+        return fn(*args, **kwargs)
+    elif i.opcode == dis.OpCode.LOAD_ATTR:
+        return getattr(srcs[0], i.argval)
+    elif i.opcode == dis.OpCode.BINARY_SUBSCR:
+        return srcs[0][srcs[1]]
+    elif i.opcode in _binary_ops:
+        a, b = _unbox(srcs[0]), _unbox(srcs[1])
+        _check_u64(a, b)
+        if i.opcode in _shift_ops and isinstance(b, int) and b >= 64:
+            # Out of range for bpf, which the verifier rejects
+            raise _Unfoldable()
+        ret = _binary_ops[i.opcode](a, b)
+        _check_u64(ret)
+        return ret
+    elif i.opcode == dis.OpCode.COMPARE_OP and i.argval in _compare_ops:
+        a, b = _unbox(srcs[0]), _unbox(srcs[1])
+        if i.argval in ['<', '<=', '==', '!=', '>', '>=']:
+            _check_u64(a, b)
+        return _compare_ops[i.argval](a, b)
+    raise _Unfoldable()
 
-    # We build var_map, which for every variable specifies whether it has
-    # multiple sources, a single const source, or a single non-const
-    # source. Yay for fake algebraic types!
-    var_map = collections.defaultdict(list)
+
+class _Const:
+    def __init__(self, val):
+        self.val = val
+
+    def __repr__(self):
+        return '_Const({})'.format(repr(self.val))
+
+
+def _is_same_scalar(a, b):
+    return (type(a.val) == type(b.val) and
+            isinstance(a.val, _immutable_scalar_types) and a.val == b.val)
+
+
+def _merge(sources):
+    '''Returns the _Const all of sources agree on, or None'''
+    if len(sources) == 0 or not all([isinstance(s, _Const) for s in sources]):
+        return None
+    elif len(sources) == 1 or all(
+            [_is_same_scalar(sources[0], s) for s in sources[1:]]):
+        return sources[0]
+    return None
+
+
+def _merge_states(states):
+    '''Merge the named variable values from several predecessors'''
+    names = set.intersection(*[set(s) for s in states])
+    return {n: _merge([s[n] for s in states]) for n in names}
+
+
+def _fold_consts_once(vis):
+    # For every var collect what each of its sources would set it to: a
+    # _Const, or None if it's not known until runtime.
+    var_sources = collections.defaultdict(list)
     for i in vis:
-        v = Const(i.argval) if i.opcode == dis.OpCode.LOAD_CONST else None
+        v = _Const(i.argval) if i.opcode == dis.OpCode.LOAD_CONST else None
         for dv in i.dst_vars:
-            var_map[dv].append(v)
-    var_map = {
-        k: Multi() if len(v) > 1 and isinstance(v[0], Const) else v[0]
-        for k, v in var_map.items()
-    }
+            var_sources[dv].append(v)
+    var_map = {k: _merge(v) for k, v in var_sources.items()}
 
-    # Now that we have the var map, we simply walk through looking for
-    # opportunities to fold ops with all Const sources.
+    # Named variables can be stored more than once, so we track their values
+    # as we walk forward, merging at jump targets. Names that are missing
+    # (e.g. arguments) aren't known until runtime.
     ret = []
+    fast_map, falls_through = {}, True
+    pending, targets = collections.defaultdict(list), []
     for i in vis:
-        srcs = [var_map[sv] for sv in i.src_vars]
-        if len(srcs) == 0:
+        states = [fast_map] if falls_through else []
+        while len(targets) > 0 and targets[0] <= i.offset:
+            states.extend(pending.pop(heapq.heappop(targets), []))
+        fast_map = _merge_states(states) if len(states) > 0 else {}
+
+        if i.opcode in dis.hasjmp:
+            heapq.heappush(targets, i.argval)
+            pending[i.argval].append(dict(fast_map))
+        falls_through = i.opcode not in [
+            dis.OpCode.JUMP_FORWARD,
+            dis.OpCode.JUMP_ABSOLUTE,
+            dis.OpCode.RETURN_VALUE,
+        ]
+
+        if i.opcode == dis.OpCode.STORE_FAST:
+            c = var_map.get(i.src_vars[0])
+            if c is not None and not isinstance(c.val, _immutable_scalar_types):
+                c = None
+            fast_map[i.argval] = c
             ret.append(i)
             continue
-        elif not all([isinstance(s, Const) for s in srcs]):
-            ret.append(i)
+        elif (i.opcode == dis.OpCode.LOAD_FAST and
+                fast_map.get(i.argval) is not None):
+            val = fast_map[i.argval].val
+            ret.append(_make_const(i, val))
+            for dv in i.dst_vars:
+                if len(var_sources[dv]) == 1:
+                    var_map[dv] = _Const(val)
             continue
-        elif isinstance(srcs[0].val, py2bpf.datastructures.BpfMap):
+
+        srcs = [var_map.get(sv) for sv in i.src_vars]
+        if (len(srcs) == 0 or
+                not all([isinstance(s, _Const) for s in srcs]) or
+                any([isinstance(s.val, RuntimeDatastructure)
+                     for s in srcs])):
             ret.append(i)
             continue
 
-        srcs = [c.val for c in srcs]
-        if i.opcode == dis.OpCode.BINARY_TRUE_DIVIDE:
-            val = srcs[0] / srcs[1]
-        elif i.opcode == dis.OpCode.BINARY_FLOOR_DIVIDE:
-            val = srcs[0] // srcs[1]
-        elif i.opcode == dis.OpCode.BINARY_MULTIPLY:
-            val = srcs[0] * srcs[1]
-        elif i.opcode == dis.OpCode.BINARY_ADD:
-            val = srcs[0] + srcs[1]
-        elif i.opcode == dis.OpCode.BINARY_SUBTRACT:
-            val = srcs[0] - srcs[1]
-        elif i.opcode == dis.OpCode.LOAD_ATTR:
-            val = getattr(srcs[0], i.argval)
-        elif i.opcode == dis.OpCode.BINARY_SUBSCR:
-            val = srcs[0][srcs[1]]
-        elif i.opcode == dis.OpCode.CALL_FUNCTION:
-            # srcs = [fn] + [args] + [keyword, arg, ...]
-            nargs, nkwargs = (i.arg & 0xff), (i.arg >> 8)
-            fn = srcs[0]
-            if (isinstance(fn, py2bpf.funcs.Func) or
-                    isinstance(fn, py2bpf.funcs.PseudoFunc)):
-                # This is a bpf function, so don't try to fold it
-                ret.append(i)
-                continue
-            args = srcs[1:nargs + 1]
-            kwargs = {
-                srcs[nargs + 1 + i]: srcs[nargs + 2 + i] for i in range(nkwargs)
-            }
-            val = fn(*args, **kwargs)
-        else:
-            # Unable to fold this operation
+        try:
+            val = _eval(i, [s.val for s in srcs])
+        except _Unfoldable:
             ret.append(i)
             continue
 
         ret.append(_make_const(i, val))
-        # We can update the var_map to Const if it was not Multi, because
-        # we know that we're the only source.
+        # If this is the only source, consumers later on can fold this pass
+        for dv in i.dst_vars:
+            if len(var_sources[dv]) == 1:
+                var_map[dv] = _Const(val)
+
+    # Stores of consts to names that are never loaded anymore are dead
+    loaded = set([i.argval for i in ret if i.opcode == dis.OpCode.LOAD_FAST])
+    return [
+        i for i in ret
+        if i.opcode != dis.OpCode.STORE_FAST or i.argval in loaded or
+        var_map.get(i.src_vars[0]) is None
+    ]
+
+
+def fold_consts(vis):
+    '''Propagate constants through vars and immutable named variables, and
+    fold operations on them, until nothing changes. Leaves dead LOAD_CONSTs
+    around.
+    '''
+    while True:
+        new_vis = _fold_consts_once(vis)
+        if len(new_vis) == len(vis) and all(
+                [a is b for a, b in zip(new_vis, vis)]):
+            return new_vis
+        vis = new_vis
+
+
+def _make_jump(old):
+    vi = _vars.VarInstruction(old, src_vars=[], dst_vars=[])
+    vi.opcode = dis.OpCode.JUMP_FORWARD
+    vi.opname = 'JUMP_FORWARD'
+    return vi
+
+
+def _get_const_vars(vis):
+    '''Map from var to value, for vars whose only source is a LOAD_CONST'''
+    sources = collections.defaultdict(list)
+    for i in vis:
         for dv in i.dst_vars:
-            if not isinstance(var_map[dv], Multi):
-                var_map[dv] = Const(val)
+            sources[dv].append(i)
+    return {
+        v: srcs[0].argval for v, srcs in sources.items()
+        if len(srcs) == 1 and srcs[0].opcode == dis.OpCode.LOAD_CONST
+    }
 
+
+def _remove_unreachable(vis):
+    ret = []
+    targets = []
+    falls_through = True
+    for i in vis:
+        reached = falls_through
+        while len(targets) > 0 and targets[0] <= i.offset:
+            heapq.heappop(targets)
+            reached = True
+        if not reached:
+            continue
+
+        ret.append(i)
+        if i.opcode in dis.hasjmp:
+            heapq.heappush(targets, i.argval)
+        falls_through = i.opcode not in [
+            dis.OpCode.JUMP_FORWARD,
+            dis.OpCode.JUMP_ABSOLUTE,
+            dis.OpCode.RETURN_VALUE,
+        ]
     return ret
 
 
+def prune_const_branches(vis):
+    '''Resolve conditional jumps on constants into unconditional jumps or
+    fall-throughs, and remove whatever that leaves unreachable. Losing an
+    arm can leave a var with a single const source, so we fold again and
+    repeat until nothing changes.
+    '''
+    while True:
+        const_vars = _get_const_vars(vis)
+        ret = []
+        for i in vis:
+            if (i.opcode not in [dis.OpCode.POP_JUMP_IF_FALSE,
+                                 dis.OpCode.POP_JUMP_IF_TRUE] or
+                    i.src_vars[0] not in const_vars):
+                ret.append(i)
+            elif (bool(const_vars[i.src_vars[0]]) ==
+                    (i.opcode == dis.OpCode.POP_JUMP_IF_TRUE)):
+                ret.append(_make_jump(i))
+            # Otherwise, it never jumps, so we just fall through
+
+        if len(ret) == len(vis) and all(
+                [a is b for a, b in zip(ret, vis)]):
+            return vis
+        vis = fold_consts(_remove_unreachable(ret))
+
+
 def remove_unread_consts(vis):
     '''Remove LOAD_CONST's that are unreferenced'''
     read_vars = set()
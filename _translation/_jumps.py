@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''Fuse comparisons into the conditional jumps that consume them.
+
+Left alone, every `if a == b` materializes a 0/1 boolean with two jumps, and
+then tests that boolean against zero. bpf can compare two operands and jump
+in a single instruction, so when a COMPARE_OP's result only feeds the jump
+right after it, we give the jump the comparison's operands instead.
+'''
+
+import collections
+
+from py2bpf._translation import _dis_plus as dis
+
+_fusable_compare_ops = set(['<', '<=', '==', '!=', '>', '>='])
+
+_pop_jumps = set([
+    dis.OpCode.POP_JUMP_IF_FALSE,
+    dis.OpCode.POP_JUMP_IF_TRUE,
+])
+
+_or_pop_jumps = set([
+    dis.OpCode.JUMP_IF_FALSE_OR_POP,
+    dis.OpCode.JUMP_IF_TRUE_OR_POP,
+])
+
+
+def _can_fuse(cmp, jmp, num_reads, jump_targets):
+    if (cmp.opcode != dis.OpCode.COMPARE_OP or
+            cmp.argval not in _fusable_compare_ops or
+            jmp.opcode not in _pop_jumps | _or_pop_jumps or
+            jmp.offset in jump_targets or
+            jmp.src_vars != cmp.dst_vars):
+        return False
+    # The result of JUMP_IF_*_OR_POP is read after the jump, but we know
+    # what it is if the jump is taken, so only POP_JUMP_IF_* needs to be the
+    # sole reader.
+    return jmp.opcode in _or_pop_jumps or num_reads[cmp.dst_vars[0]] == 1
+
+
+def fuse_compare_jumps(vis):
+    '''Replace COMPARE_OP + conditional jump pairs with a single conditional
+    jump on the comparison's operands, marked by compare_op. Fused
+    JUMP_IF_*_OR_POP keep the comparison's dst, which the jump has to set
+    to the result when it's taken.
+    '''
+    num_reads = collections.Counter()
+    jump_targets = set()
+    for i in vis:
+        num_reads.update(i.src_vars)
+        if i.opcode in dis.hasjmp:
+            jump_targets.add(i.argval)
+
+    ret = []
+    for i in vis:
+        if len(ret) == 0 or not _can_fuse(
+                ret[-1], i, num_reads, jump_targets):
+            ret.append(i)
+            continue
+
+        cmp = ret.pop()
+        i.src_vars = cmp.src_vars
+        if i.opcode in _or_pop_jumps:
+            i.dst_vars = cmp.dst_vars
+        i.compare_op = cmp.argval
+        i.argrepr = cmp.argrepr
+        i.starts_line = cmp.starts_line
+        ret.append(i)
+
+    return ret
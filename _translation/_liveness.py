@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''Live range analysis over VarInstructions.
+
+bpf only allows forward jumps, so along every execution path instructions
+run in increasing order. That means that a variable is live, at most, over
+the interval between the first instruction that mentions it and the last
+one. Intervals can be conservative around branches, but they're never
+wrong.
+'''
+
+import _ctypes
+
+import py2bpf.funcs
+from py2bpf._translation import _mem, _types, _vars, _dis_plus as dis
+
+
+def get_var_key(var):
+    '''Returns a hashable key identifying the storage for var, or None if var
+    doesn't need storage of its own
+    '''
+    if isinstance(var, _vars.Var):
+        return var
+    elif isinstance(var, _mem.FastVar):
+        return ('fast', var.name)
+    return None
+
+
+def _is_addrof(i):
+    if i.opcode != dis.OpCode.CALL_FUNCTION or len(i.src_vars) < 2:
+        return False
+    fn_var = i.src_vars[0]
+    return (isinstance(fn_var, _mem.ConstVar) and
+            isinstance(fn_var.val, py2bpf.funcs.PseudoFunc) and
+            fn_var.val.name == 'addrof')
+
+
+def get_escaping_vars(vis):
+    '''Returns the keys of variables whose address outlives the instruction
+    that takes it, i.e. by addrof or by a pointer into a struct or array.
+    Those have to keep their storage until the end of the program.
+    '''
+    escaping = set()
+    for i in vis:
+        if _is_addrof(i):
+            escaping.add(get_var_key(i.src_vars[1]))
+        if any([issubclass(dv.var_type, _types.Ptr) for dv in i.dst_vars]):
+            for sv in i.src_vars:
+                if not issubclass(sv.var_type, _ctypes._SimpleCData):
+                    escaping.add(get_var_key(sv))
+    escaping.discard(None)
+    return escaping
+
+
+def get_live_ranges(vis):
+    '''Returns a map from var key to the (first, last) indices into vis where
+    the var is live
+    '''
+    ranges = {}
+    for idx, i in enumerate(vis):
+        for v in i.src_vars + i.dst_vars:
+            k = get_var_key(v)
+            if k is None:
+                continue
+            first, _ = ranges.get(k, (idx, idx))
+            ranges[k] = (first, idx)
+
+    for k in get_escaping_vars(vis):
+        ranges[k] = (ranges[k][0], len(vis))
+
+    return ranges
@@ -10,6 +10,7 @@
 where they live in memory.
 '''
 
+import collections
 import ctypes
 import _ctypes
 import py2bpf.exception
@@ -70,24 +71,28 @@ def convert_primitive_var_types(vis):
 
 
 def replace_load_consts(vis):
+    num_setters = collections.Counter()
+    for i in vis:
+        num_setters.update(i.dst_vars)
+
     const_map = {}
-    seen_dst_vars = set()
+    ret = []
     for i in vis:
-        assert all([dv not in const_map for dv in i.dst_vars])
         if i.opcode == dis.OpCode.LOAD_CONST:
-            assert i.dst_vars[0] not in seen_dst_vars, 'Multiple setters?'
-
             const_type = i.dst_vars[0].var_type
             const_val = i.argval
             if type(const_val) != const_type:
                 const_val = const_type(const_val)
-            const_map[i.dst_vars[0]] = ConstVar(const_val)
+            if num_setters[i.dst_vars[0]] == 1:
+                const_map[i.dst_vars[0]] = ConstVar(const_val)
+                continue
+            # Where control flow joins, e.g. `a or 0`, the var has other
+            # setters, so this has to stay as a move.
+            i.src_vars = [ConstVar(const_val)]
+        ret.append(i)
 
-    ret = []
-    for i in vis:
-        if i.opcode != dis.OpCode.LOAD_CONST:
-            i.src_vars = [const_map.get(sv, sv) for sv in i.src_vars]
-            ret.append(i)
+    for i in ret:
+        i.src_vars = [const_map.get(sv, sv) for sv in i.src_vars]
     return ret
 
 
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''This module exists to keep variables in registers instead of on the stack
+
+The templates in _bpf/_template_jit.py use R0-R4 as scratch, R5 only for
+the fifth argument of helper calls, and R6 for the context. That leaves us
+R7-R9, which helpers preserve, and R5, which is fine for anything that
+isn't live across a helper call or skb load.
+'''
+
+import ctypes
+import _ctypes
+
+import py2bpf.funcs
+from py2bpf._bpf import _instructions as bi
+from py2bpf._translation import _liveness, _mem, _types, _dis_plus as dis
+from py2bpf._translation._datastructures import FileDescriptorDatastructure
+
+_CALLEE_SAVED_REGS = [bi.Reg.R7, bi.Reg.R8, bi.Reg.R9]
+_CALLER_SAVED_REGS = [bi.Reg.R5]
+
+
+class RegVar:
+    '''For variables located in registers'''
+    def __init__(self, var_type, reg):
+        self.var_type = var_type
+        self.reg = reg
+
+    def __str__(self):
+        return 'RegVar<{}>({})'.format(self.var_type.__name__, self.reg.name)
+
+
+def _is_map_subscr(i):
+    if i.opcode == dis.OpCode.BINARY_SUBSCR:
+        vt = i.src_vars[0].var_type
+    elif i.opcode in [dis.OpCode.STORE_SUBSCR, dis.OpCode.DELETE_SUBSCR]:
+        vt = i.src_vars[1].var_type
+    else:
+        return False
+    if issubclass(vt, _types.Ptr):
+        vt = vt.var_type
+    return not issubclass(vt, ctypes.Array)
+
+
+def _clobbers_caller_saved(i):
+    '''Whether the template for i calls a helper or loads from the skb,
+    either of which clobber R1-R5
+    '''
+    if _is_map_subscr(i):
+        return True
+    elif i.opcode != dis.OpCode.CALL_FUNCTION:
+        return False
+    fn = i.src_vars[0]
+    if not isinstance(fn, _mem.ConstVar):
+        return False
+    elif isinstance(fn.val, py2bpf.funcs.Func):
+        return True
+    return (isinstance(fn.val, py2bpf.funcs.PseudoFunc) and
+            (fn.val.name.startswith('load_skb_') or
+             fn.val.name == 'ringbuf_reserve'))
+
+
+def _get_memory_bound_vars(vis):
+    '''Returns keys of vars which templates need the address of'''
+    bound = _liveness.get_escaping_vars(vis)
+    for i in vis:
+        if _is_map_subscr(i):
+            # Keys, and values for stores, are passed to helpers by address
+            bound.update(_liveness.get_var_key(sv) for sv in i.src_vars)
+        elif i.opcode == dis.OpCode.STORE_FAST:
+            sv, dv = i.src_vars[0], i.dst_vars[0]
+            if (issubclass(dv.var_type, _types.Ptr) and
+                    not issubclass(sv.var_type, _types.Ptr)):
+                bound.add(_liveness.get_var_key(sv))
+    bound.discard(None)
+    return bound
+
+
+def _is_register_type(var_type):
+    return (issubclass(var_type, _ctypes._SimpleCData) and
+            not issubclass(var_type, FileDescriptorDatastructure) and
+            ctypes.sizeof(var_type) <= 8)
+
+
+def _overlaps(a, b):
+    return a[0] <= b[1] and b[0] <= a[1]
+
+
+def set_register_allocations(vis):
+    '''Convert the most used _vars.Var and _mem.FastVar to RegVar, so long as
+    nothing needs their address. Whatever doesn't fit is left for
+    _stack.set_stack_allocations.
+    '''
+    ranges = _liveness.get_live_ranges(vis)
+    bound = _get_memory_bound_vars(vis)
+
+    weights, var_types = {}, {}
+    for i in vis:
+        for v in i.src_vars + i.dst_vars:
+            k = _liveness.get_var_key(v)
+            if k is None:
+                continue
+            weights[k] = weights.get(k, 0) + 1
+            if not _is_register_type(v.var_type):
+                bound.add(k)
+            var_types.setdefault(k, v.var_type)
+
+    clobbers = [idx for idx, i in enumerate(vis) if _clobbers_caller_saved(i)]
+
+    # Greedily hand out registers to the hottest vars first
+    assigned = {reg: [] for reg in _CALLER_SAVED_REGS + _CALLEE_SAVED_REGS}
+    reg_map = {}
+    candidates = sorted(
+        (k for k in weights if k not in bound),
+        key=lambda k: (-weights[k], ranges[k]))
+    for k in candidates:
+        first, last = ranges[k]
+        regs = _CALLEE_SAVED_REGS
+        if not any(first < c < last for c in clobbers):
+            regs = _CALLER_SAVED_REGS + regs
+        for reg in regs:
+            if not any(_overlaps(ranges[k], r) for r in assigned[reg]):
+                assigned[reg].append(ranges[k])
+                reg_map[k] = RegVar(var_types[k], reg)
+                break
+
+    ret = []
+    for i in vis:
+        i.src_vars = [reg_map.get(_liveness.get_var_key(sv), sv)
+                      for sv in i.src_vars]
+        i.dst_vars = [reg_map.get(_liveness.get_var_key(dv), dv)
+                      for dv in i.dst_vars]
+        ret.append(i)
+
+    return ret
@@ -8,9 +8,10 @@
 
 '''This module exists to create stack allocations for variables'''
 
+import collections
 import ctypes
 
-from py2bpf._translation import _datastructures, _mem, _vars
+from py2bpf._translation import _datastructures, _liveness
 
 
 class StackVar:
@@ -25,56 +26,102 @@ class StackVar:
 
 
 class Stack:
-    '''Simple bump allocator for the stack'''
+    '''Allocator for the stack. Space handed back with free is reused by
+    later allocations that fit in it, and otherwise we bump further down.
+    '''
     def __init__(self):
         self.neg_stack_off = 0
+        self.max_neg_stack_off = 0
+        # Sorted, non-adjacent (start, end) ranges of free offsets above
+        # -neg_stack_off
+        self.free_list = []
+
+    def _release(self, start, end):
+        self.free_list.append((start, end))
+        self.free_list.sort()
+        merged = [self.free_list[0]]
+        for s, e in self.free_list[1:]:
+            if s <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(e, merged[-1][1]))
+            else:
+                merged.append((s, e))
+        self.free_list = merged
+
+        # Give space at the bottom back to the bump allocator
+        if self.free_list[0][0] == -self.neg_stack_off:
+            self.neg_stack_off = -self.free_list.pop(0)[1]
 
     def alloc(self, var_type):
         # Treat these as pointers for stack storage purposes
         if issubclass(var_type, _datastructures.FileDescriptorDatastructure):
             var_type = ctypes.c_voidp
 
+        size, al = ctypes.sizeof(var_type), ctypes.alignment(var_type)
+        for idx, (start, end) in enumerate(self.free_list):
+            # Offsets are negative, so rounding the magnitude down to the
+            # alignment moves us up into the range
+            off = -(-start & ~(al - 1))
+            if off + size <= end:
+                del self.free_list[idx]
+                if start < off:
+                    self._release(start, off)
+                if off + size < end:
+                    self._release(off + size, end)
+                return StackVar(var_type, off)
+
         # Round up to nearest multiple of alignment. This works
         # because alignment is always a power of 2
-        al = ctypes.alignment(var_type)
-        self.neg_stack_off += ctypes.sizeof(var_type)
+        old_neg_stack_off = self.neg_stack_off
+        self.neg_stack_off += size
         self.neg_stack_off += (al - 1)
         self.neg_stack_off &= ~(al - 1)
+        self.max_neg_stack_off = max(
+            self.max_neg_stack_off, self.neg_stack_off)
+        if -self.neg_stack_off + size < -old_neg_stack_off:
+            self._release(-self.neg_stack_off + size, -old_neg_stack_off)
         return StackVar(var_type, -self.neg_stack_off)
 
+    def free(self, stack_var):
+        self._release(stack_var.offset,
+                      stack_var.offset + ctypes.sizeof(stack_var.var_type))
+
+    def close(self):
+        '''Stop reusing freed space. Anything allocated after this point
+        has no lifetime information, so it can't share with anything.
+        '''
+        self.free_list = []
+        self.neg_stack_off = self.max_neg_stack_off
+
 
 def set_stack_allocations(vis):
-    '''Convert _vars.Var to StackVar. Allocate to the stack using a simple bump
-    allocator. This is less efficient, but we don't need to pay attention
-    to variable lifetime, which is rad.
+    '''Convert _vars.Var and _mem.FastVar to StackVar. Variables whose live
+    ranges don't overlap share stack space.
     '''
+    ranges = _liveness.get_live_ranges(vis)
+    last_uses = collections.defaultdict(list)
+    for k, (_, last) in ranges.items():
+        last_uses[last].append(k)
+
     ret = []
     stack = Stack()
-    trans_map = {}
-    fast_map = {}
-    for i in vis:
-        dst_vars = []
-        for dv in i.dst_vars:
-            if isinstance(dv, _vars.Var):
-                if dv not in trans_map:
-                    trans_map[dv] = stack.alloc(dv.var_type)
-                dst_vars.append(trans_map[dv])
-            elif isinstance(dv, _mem.FastVar):
-                if dv.name not in fast_map:
-                    fast_map[dv.name] = stack.alloc(dv.var_type)
-                dst_vars.append(fast_map[dv.name])
-            else:
-                dst_vars.append(dv)
-        src_vars = []
-        for sv in i.src_vars:
-            if isinstance(sv, _vars.Var):
-                src_vars.append(trans_map[sv])
-            elif isinstance(sv, _mem.FastVar):
-                src_vars.append(fast_map[sv.name])
-            else:
-                src_vars.append(sv)
-        i.dst_vars = dst_vars
-        i.src_vars = src_vars
+    alloc_map = {}
+
+    def convert(v):
+        k = _liveness.get_var_key(v)
+        if k is None:
+            return v
+        if k not in alloc_map:
+            alloc_map[k] = stack.alloc(v.var_type)
+        return alloc_map[k]
+
+    for idx, i in enumerate(vis):
+        # NB: dsts are allocated before srcs are freed, so the two never
+        # share space within an instruction
+        i.dst_vars = [convert(dv) for dv in i.dst_vars]
+        i.src_vars = [convert(sv) for sv in i.src_vars]
+        for k in last_uses[idx]:
+            stack.free(alloc_map[k])
         ret.append(i)
 
+    stack.close()
     return ret, stack
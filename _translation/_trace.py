@@ -13,37 +13,59 @@ Functions for tracing through streams of instructions
 import py2bpf._translation._dis_plus as dis
 
 
-def get_all_execution_paths(insns):
-    '''Trace all execution paths through the stream of instructions by
-    following jumps and returns.
+class BasicBlock:
+    '''A run of instructions with a single entry and a single exit'''
+    def __init__(self, index, insns):
+        self.index = index
+        self.insns = insns
+        self.jump_target = None
+        self.falls_through = False
+
+    def successors(self):
+        ret = []
+        if self.falls_through:
+            ret.append(self.index + 1)
+        if self.jump_target is not None:
+            ret.append(self.jump_target)
+        return ret
+
+    def __str__(self):
+        return 'BasicBlock({}, offsets={}-{})'.format(
+            self.index, self.insns[0].offset, self.insns[-1].offset)
+
+
+def get_basic_blocks(insns):
+    '''Split the stream of instructions into basic blocks, ordered by offset,
+    and link them by following jumps and returns. Because we only allow
+    forward jumps, every block's predecessors come before it.
     '''
-    def walk(offset, path):
-        path = path[:]  # Make a copy
-        for i in range(offset, len(insns)):
-            path.append(insns[i])
-            op = insns[i].opcode
-            if op == dis.OpCode.RETURN_VALUE:
-                yield path
-                return
-
-            if op in dis.hasjmp:
-                # NB: argval is the absolute offset even for relative jumps
-                jmp_offset = insns[i].argval
-                assert jmp_offset > insns[i].offset, 'only allow forward jumps'
-
-                found = False
-                for j in range(offset, len(insns)):
-                    if insns[j].offset == jmp_offset:
-                        for p in walk(j, path):
-                            yield p
-                        found = True
-                        break
-                assert found, 'Failed to find jump offset'
-
-                if op not in dis.hascondjmp:
-                    return
-
-        assert False, 'Unreachable ending'
-
-    for p in walk(0, []):
-        yield p
+    offset_to_idx = {i.offset: idx for idx, i in enumerate(insns)}
+
+    leaders = set([0])
+    for idx, i in enumerate(insns):
+        if i.opcode in dis.hasjmp:
+            # NB: argval is the absolute offset even for relative jumps
+            assert i.argval > i.offset, 'only allow forward jumps'
+            assert i.argval in offset_to_idx, 'Failed to find jump offset'
+            leaders.add(offset_to_idx[i.argval])
+        if i.opcode in dis.hasjmp or i.opcode == dis.OpCode.RETURN_VALUE:
+            if idx + 1 < len(insns):
+                leaders.add(idx + 1)
+
+    starts = sorted(leaders)
+    ends = starts[1:] + [len(insns)]
+    blocks = [BasicBlock(n, insns[s:e])
+              for n, (s, e) in enumerate(zip(starts, ends))]
+    start_to_block = {s: b for s, b in zip(starts, blocks)}
+
+    for b in blocks:
+        last = b.insns[-1]
+        if last.opcode in dis.hasjmp:
+            b.jump_target = start_to_block[offset_to_idx[last.argval]].index
+        if (last.opcode not in dis.hasjmp or
+                last.opcode in dis.hascondjmp):
+            b.falls_through = last.opcode != dis.OpCode.RETURN_VALUE
+        assert not b.falls_through or b.index + 1 < len(blocks), \
+            'Unreachable ending'
+
+    return blocks
@@ -11,7 +11,8 @@
 import sys
 
 from py2bpf._translation import (
-    _folding, _labels, _mem, _stack, _types, _vars, _dis_plus as dis)
+    _folding, _jumps, _labels, _mem, _regs, _stack, _types, _vars,
+    _dis_plus as dis)
 
 
 def _ensure_translatable_ops(instructions):
@@ -36,7 +37,17 @@ def _ensure_translatable_ops(instructions):
         dis.OpCode.DUP_TOP,
         dis.OpCode.DUP_TOP_TWO,
         dis.OpCode.INPLACE_ADD,
+        dis.OpCode.INPLACE_AND,
+        dis.OpCode.INPLACE_FLOOR_DIVIDE,
+        dis.OpCode.INPLACE_LSHIFT,
+        dis.OpCode.INPLACE_MULTIPLY,
+        dis.OpCode.INPLACE_OR,
+        dis.OpCode.INPLACE_RSHIFT,
+        dis.OpCode.INPLACE_SUBTRACT,
+        dis.OpCode.INPLACE_TRUE_DIVIDE,
         dis.OpCode.JUMP_FORWARD,
+        dis.OpCode.JUMP_IF_FALSE_OR_POP,
+        dis.OpCode.JUMP_IF_TRUE_OR_POP,
         dis.OpCode.LOAD_ATTR,
         dis.OpCode.LOAD_CONST,
         dis.OpCode.LOAD_DEREF,
@@ -75,7 +86,7 @@ def convert_to_register_ops(fn, ctx_type, verbose=False):
         if verbose:
             print(*args, **kwargs)
 
-    instructions = list(dis.get_instructions(fn.__code__))
+    instructions = dis.strip_extended_args(dis.get_instructions(fn.__code__))
     _ensure_translatable_ops(instructions)
 
     for i in instructions:
@@ -103,6 +114,11 @@ def convert_to_register_ops(fn, ctx_type, verbose=False):
     for vi in vis:
         verbose_fn(str(vi))
 
+    verbose_fn('\n== Prune constant branches')
+    vis = _folding.prune_const_branches(vis)
+    for vi in vis:
+        verbose_fn(str(vi))
+
     verbose_fn('\n== Reinterpret const strings')
     vis = _folding.reinterpret_const_strings(vis)
     for vi in vis:
@@ -123,6 +139,11 @@ def convert_to_register_ops(fn, ctx_type, verbose=False):
     for vi in vis:
         verbose_fn(str(vi))
 
+    verbose_fn('\n== Fuse compare jumps')
+    vis = _jumps.fuse_compare_jumps(vis)
+    for vi in vis:
+        verbose_fn(str(vi))
+
     verbose_fn('\n== replace arg loads')
     vis = _mem.replace_arg_loads(vis, arg_types)
     for vi in vis:
@@ -153,6 +174,11 @@ def convert_to_register_ops(fn, ctx_type, verbose=False):
     for vi in vis:
         verbose_fn(str(vi))
 
+    verbose_fn('\n== Set register allocations')
+    vis = _regs.set_register_allocations(vis)
+    for vi in vis:
+        verbose_fn(str(vi))
+
     verbose_fn('\n== Set stack allocations')
     vis, stack = _stack.set_stack_allocations(vis)
     for vi in vis:
@@ -21,9 +21,28 @@ class Ptr(ctypes.c_voidp):
     pass
 
 
-def make_ptr(var_type):
+# The kernel lays out map values on 8 byte boundaries
+MAP_VALUE_ALIGN = 8
+
+
+def get_offset_align(align, offset):
+    '''The alignment of an address offset bytes from one aligned to align'''
+    while offset % align != 0:
+        align //= 2
+    return align
+
+
+def make_ptr(var_type, align=None):
+    '''Make a pointer type to var_type. align is the alignment we know the
+    address to have, which defaults to that of var_type.
+    '''
+    if align is None:
+        try:
+            align = ctypes.alignment(var_type)
+        except TypeError:
+            align = 1
     name = 'Ptr_{}'.format(var_type.__name__)
-    return type(name, (Ptr,), dict(var_type=var_type))
+    return type(name, (Ptr,), dict(var_type=var_type, align=align))
 
 
 def set_dst_var_types(vis, arg_types):
@@ -53,6 +72,8 @@ def set_dst_var_types(vis, arg_types):
         dis.OpCode.INPLACE_SUBTRACT,
         dis.OpCode.INPLACE_OR,
         dis.OpCode.INPLACE_AND,
+        dis.OpCode.INPLACE_LSHIFT,
+        dis.OpCode.INPLACE_RSHIFT,
     ])
 
 
@@ -94,7 +115,10 @@ def set_dst_var_types(vis, arg_types):
     def get_attr_type(i):
         obj_type = var_types[i.src_vars[0]]
         if issubclass(obj_type, Ptr):
+            obj_align = obj_type.align
             obj_type = obj_type.var_type
+        else:
+            obj_align = ctypes.alignment(obj_type)
 
         # These overrides are used when we have a bpf field with type
         # uint32 but it's secretly manipulated into a pointer in the
@@ -108,7 +132,8 @@ def set_dst_var_types(vis, arg_types):
                 if issubclass(t, _ctypes._SimpleCData):
                     return t
                 else:
-                    return make_ptr(t)
+                    off = getattr(obj_type, f).offset
+                    return make_ptr(t, get_offset_align(obj_align, off))
 
         raise py2bpf.exception.TranslationError(
             i.starts_line, 'No field {} within type {}'.format(
@@ -121,18 +146,33 @@ def set_dst_var_types(vis, arg_types):
 
         if issubclass(vt, ctypes.Array):
             return vt._type_
+        elif issubclass(vt, py2bpf.datastructures.BpfMapOfMaps):
+            # A pointer to the inner map, which may be null
+            return make_ptr(vt.INNER_MAP, MAP_VALUE_ALIGN)
         elif issubclass(vt, py2bpf.datastructures.BpfMap):
             # Primitives by value, others by reference
             if issubclass(vt.VALUE_TYPE, _ctypes._SimpleCData):
                 return vt.VALUE_TYPE
             else:
-                return make_ptr(vt.VALUE_TYPE)
+                return make_ptr(vt.VALUE_TYPE, MAP_VALUE_ALIGN)
         else:
             raise py2bpf.exception.TranslationError(
                 i.starts_line,
                 'Binary subscription not supported for type {}'.format(
                     vt.__name__))
 
+    def get_call_type(i, fn):
+        if fn is not py2bpf.funcs.ringbuf_reserve:
+            return fn.return_type
+        q_i = var_setters.get(i.src_vars[1]) if len(i.src_vars) == 2 else None
+        if (q_i is None or q_i.opcode != dis.OpCode.LOAD_CONST or
+                not isinstance(q_i.argval,
+                               py2bpf.datastructures.RingBufQueue)):
+            raise py2bpf.exception.TranslationError(
+                i.starts_line, 'ringbuf_reserve takes a RingBufQueue')
+        # Records are 8 byte aligned
+        return make_ptr(q_i.argval.data_type, 8)
+
     for i in vis:
         if i.opcode == dis.OpCode.LOAD_GLOBAL:
             raise py2bpf.exception.TranslationError(
@@ -159,6 +199,10 @@ def set_dst_var_types(vis, arg_types):
             pass
         elif i.opcode == dis.OpCode.POP_JUMP_IF_TRUE:
             pass
+        elif i.opcode == dis.OpCode.JUMP_IF_FALSE_OR_POP:
+            pass
+        elif i.opcode == dis.OpCode.JUMP_IF_TRUE_OR_POP:
+            pass
         elif i.opcode == dis.OpCode.JUMP_FORWARD:
             pass
         elif i.opcode == dis.OpCode.RETURN_VALUE:
@@ -187,7 +231,7 @@ def set_dst_var_types(vis, arg_types):
                 raise py2bpf.exception.TranslationError(
                     i.starts_line,
                     'Can only invoke py2bpf.funcs.Func or PseudoFunc')
-            update_single_dst(i, fn.return_type)
+            update_single_dst(i, get_call_type(i, fn))
         else:
             raise py2bpf.exception.TranslationError(
                 i.starts_line,
@@ -11,7 +11,6 @@ sources and dests from implicit stack locations to explicit variables. This
 simplifies future type inferencing and stack allocations
 '''
 
-import collections
 from py2bpf._translation import _trace, _dis_plus as dis
 
 
@@ -49,6 +48,9 @@ class VarInstruction:
         self.offset = instruction.offset
         self.starts_line = instruction.starts_line
         self.is_jump_target = instruction.is_jump_target
+        # Set on conditional jumps that test a comparison of their two
+        # src_vars directly, see _jumps.fuse_compare_jumps
+        self.compare_op = None
 
         self.src_vars = src_vars
         if src_vars is None:
@@ -85,6 +87,14 @@ def _num_pushes(i):
         dis.OpCode.RETURN_VALUE: 0,
         dis.OpCode.COMPARE_OP: 1,
         dis.OpCode.INPLACE_ADD: 1,
+        dis.OpCode.INPLACE_TRUE_DIVIDE: 1,
+        dis.OpCode.INPLACE_FLOOR_DIVIDE: 1,
+        dis.OpCode.INPLACE_MULTIPLY: 1,
+        dis.OpCode.INPLACE_SUBTRACT: 1,
+        dis.OpCode.INPLACE_AND: 1,
+        dis.OpCode.INPLACE_OR: 1,
+        dis.OpCode.INPLACE_LSHIFT: 1,
+        dis.OpCode.INPLACE_RSHIFT: 1,
         dis.OpCode.LOAD_ATTR: 1,
         dis.OpCode.STORE_ATTR: 0,
         dis.OpCode.BINARY_SUBSCR: 1,
@@ -123,6 +133,14 @@ def _num_pops(i):
         dis.OpCode.RETURN_VALUE: 1,
         dis.OpCode.COMPARE_OP: 2,
         dis.OpCode.INPLACE_ADD: 2,
+        dis.OpCode.INPLACE_TRUE_DIVIDE: 2,
+        dis.OpCode.INPLACE_FLOOR_DIVIDE: 2,
+        dis.OpCode.INPLACE_MULTIPLY: 2,
+        dis.OpCode.INPLACE_SUBTRACT: 2,
+        dis.OpCode.INPLACE_AND: 2,
+        dis.OpCode.INPLACE_OR: 2,
+        dis.OpCode.INPLACE_LSHIFT: 2,
+        dis.OpCode.INPLACE_RSHIFT: 2,
         dis.OpCode.LOAD_ATTR: 1,
         dis.OpCode.STORE_ATTR: 2,
         dis.OpCode.BINARY_SUBSCR: 2,
@@ -139,16 +157,49 @@ def _num_pops(i):
 
 
 def assign_vars(instructions):
-    '''Given a list of instructions, set src_vars and dst_vars by tracing
-    through all execution paths
+    '''Given a list of instructions, set src_vars and dst_vars by simulating
+    the stack over the control flow graph
     '''
 
-    # Go through all execution paths and note sources and destinations by
-    # simulating the state of the stack for any given execution trace.
-    srcs = collections.defaultdict(list)
-    for path in _trace.get_all_execution_paths(instructions):
-        stack = []
-        for i in path:
+    # Each stack entry is the offset of the instruction that pushed it. Where
+    # control flow joins, the same stack slot may have been pushed by
+    # different instructions, so we union those instructions together: they
+    # have to write the same variable.
+    parents = {}
+
+    def find(op_off):
+        while parents[op_off] != op_off:
+            parents[op_off] = parents[parents[op_off]]
+            op_off = parents[op_off]
+        return op_off
+
+    def union(op_off1, op_off2):
+        root1, root2 = find(op_off1), find(op_off2)
+        if root1 != root2:
+            parents[max(root1, root2)] = min(root1, root2)
+
+    blocks = _trace.get_basic_blocks(instructions)
+    entry_stacks = {0: []}
+
+    def merge_into(block_idx, stack):
+        if block_idx not in entry_stacks:
+            entry_stacks[block_idx] = stack[:]
+            return
+        entry_stack = entry_stacks[block_idx]
+        assert len(entry_stack) == len(stack), 'Stack depth mismatch at join'
+        for op_off1, op_off2 in zip(entry_stack, stack):
+            union(op_off1, op_off2)
+
+    # Jumps only go forward, so visiting blocks in order means that every
+    # predecessor of a block has been merged into it before we get there,
+    # and each block is simulated exactly once. Blocks that are never
+    # merged into are unreachable.
+    srcs = {}
+    for b in blocks:
+        if b.index not in entry_stacks:
+            continue
+        stack = entry_stacks.pop(b.index)
+        for i in b.insns:
             # Handle special snowflake ops that manipulate stack first
             if i.opcode == dis.OpCode.ROT_TWO:
                 tos = stack.pop()
@@ -165,38 +216,49 @@ def assign_vars(instructions):
                 stack.pop()
             elif i.opcode == dis.OpCode.DUP_TOP_TWO:
                 stack.extend(stack[-2:])
+            elif i.opcode in [dis.OpCode.JUMP_IF_TRUE_OR_POP,
+                              dis.OpCode.JUMP_IF_FALSE_OR_POP]:
+                # TOS stays on the stack if we jump, and is popped if we
+                # fall through. This is always the end of the block.
+                srcs[i.offset] = stack[-1:]
+                stack = stack[:-1]
             else:
                 # Grab sources for this instruction
                 pops = _num_pops(i)
                 if pops > 0:
-                    srcs[i.offset].append(stack[-pops:])
+                    srcs[i.offset] = stack[-pops:]
                     stack = stack[:-pops]
                 # Provide pushes for this instruction
                 pushes = _num_pushes(i)
                 if pushes > 0:
+                    parents[i.offset] = i.offset
                     stack.extend([i.offset] * pushes)
 
-    # srcs now contains the potential source instructions for every op. Now
-    # we coalesce the destinations for every op into single variables. If
-    # an instruction has two possible inputs, it means that we'll insure
-    # that both inputs output to the same variable.
+        last = b.insns[-1]
+        for succ in b.successors():
+            if (succ == b.jump_target and
+                    last.opcode in [dis.OpCode.JUMP_IF_TRUE_OR_POP,
+                                    dis.OpCode.JUMP_IF_FALSE_OR_POP]):
+                merge_into(succ, stack + srcs[last.offset])
+            else:
+                merge_into(succ, stack)
 
     # Sort by op offset to make numbering less arbitrary
     src_lists = [t[1] for t in sorted(srcs.items(), key=lambda t: t[0])]
 
     next_var_num = 1
-    op_to_dest = {}
+    root_to_dest = {}
     for src_list in src_lists:
-        for op_off in src_list[0]:
-            if op_off not in op_to_dest:
-                op_to_dest[op_off] = Var(next_var_num)
+        for op_off in src_list:
+            root = find(op_off)
+            if root not in root_to_dest:
+                root_to_dest[root] = Var(next_var_num)
                 next_var_num += 1
-        for alt_src in src_list[1:]:
-            for op_off1, op_off2 in zip(src_list[0], alt_src):
-                if op_off2 in op_to_dest:
-                    assert op_to_dest[op_off1] == op_to_dest[op_off2]
-                else:
-                    op_to_dest[op_off2] = op_to_dest[op_off1]
+
+    op_to_dest = {
+        op_off: root_to_dest[find(op_off)]
+        for op_off in parents if find(op_off) in root_to_dest
+    }
 
     # Now that we've canonicalized the destination variables of each op
     # with the op_to_dest map, assign the src and dst vars.
@@ -209,8 +271,7 @@ def assign_vars(instructions):
             continue
 
         if i.offset in srcs:
-            src_vars = [
-                op_to_dest[src_off] for src_off in srcs[i.offset][0]]
+            src_vars = [op_to_dest[src_off] for src_off in srcs[i.offset]]
         else:
             src_vars = []
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''Measure the per-operation latency of userspace map operations.
+
+Run it from the directory above py2bpf, as root:
+
+    python3 -m py2bpf.benchmarks.map_ops
+'''
+
+import argparse
+import ctypes
+import time
+
+import py2bpf.datastructures
+
+
+def _time_per_op(fn, num_ops):
+    start = time.perf_counter()
+    fn(num_ops)
+    return (time.perf_counter() - start) / num_ops
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ops', type=int, default=100000)
+    parser.add_argument('--entries', type=int, default=1024)
+    args = parser.parse_args()
+
+    m = py2bpf.datastructures.create_map(
+        ctypes.c_uint32, ctypes.c_uint64, args.entries)
+    keys = [ctypes.c_uint32(k) for k in range(args.entries)]
+    value = ctypes.c_uint64(1)
+    for k in keys:
+        m.update(k, value)
+
+    def update(n):
+        for i in range(n):
+            m.update(keys[i % args.entries], value)
+
+    def lookup(n):
+        for i in range(n):
+            m.lookup(keys[i % args.entries])
+
+    def get_next_key(n):
+        for i in range(n):
+            m.get_next_key(keys[i % args.entries])
+
+    def delete(n):
+        # Put each key back, so that there's always something to delete
+        for i in range(n):
+            k = keys[i % args.entries]
+            m.delete(k)
+            m.update(k, value)
+
+    try:
+        update_latency = _time_per_op(update, args.ops)
+        for name, fn in [('lookup', lookup), ('update', update),
+                         ('get_next_key', get_next_key)]:
+            print('{:>14}: {:8.0f} ns/op'.format(
+                name, _time_per_op(fn, args.ops) * 1e9))
+        print('{:>14}: {:8.0f} ns/op'.format(
+            'delete', (_time_per_op(delete, args.ops) - update_latency) * 1e9))
+    finally:
+        m.close()
+
+
+if __name__ == '__main__':
+    main()
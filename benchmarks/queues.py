@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''Compare BpfQueue and RingBufQueue: how much memory they map, and how
+fast events get through them. Events come from a socket filter which emits
+one for every loopback udp packet we send ourselves. With numpy, BpfQueue is
+also drained with get_array.
+
+Run it from the directory above py2bpf, as root:
+
+    python3 -m py2bpf.benchmarks.queues
+'''
+
+import argparse
+import ctypes
+import socket
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import py2bpf.datastructures
+import py2bpf.funcs
+import py2bpf.prog
+import py2bpf.socket_filter
+
+_SO_ATTACH_BPF = 50
+
+
+class Event(ctypes.Structure):
+    _fields_ = [
+        ('len', ctypes.c_uint32),
+        ('ifindex', ctypes.c_uint32),
+        ('ts', ctypes.c_uint64),
+    ]
+
+
+def _make_perf_queue(num_pages):
+    q = py2bpf.datastructures.BpfQueue(Event, num_pages=num_pages)
+
+    def fn(skb):
+        ev = Event()
+        ev.len = skb.len
+        ev.ifindex = skb.ifindex
+        ev.ts = py2bpf.funcs.ktime_get_ns()
+        cpu = py2bpf.funcs.get_smp_processor_id()
+        py2bpf.funcs.perf_event_output(skb, q, cpu, ev)
+        return 0
+
+    mapped = len(q.queues) * num_pages * q.get_cpu_queue(0).pagesz
+    return q, fn, mapped
+
+
+def _make_ring_buf_output(num_pages):
+    q = py2bpf.datastructures.RingBufQueue(Event, num_pages=num_pages)
+
+    def fn(skb):
+        ev = Event()
+        ev.len = skb.len
+        ev.ifindex = skb.ifindex
+        ev.ts = py2bpf.funcs.ktime_get_ns()
+        py2bpf.funcs.ringbuf_output(q, ev, 0)
+        return 0
+
+    return q, fn, 2 * q.pagesz + q.size
+
+
+def _make_ring_buf_reserve(num_pages):
+    q = py2bpf.datastructures.RingBufQueue(Event, num_pages=num_pages)
+
+    def fn(skb):
+        ev = py2bpf.funcs.ringbuf_reserve(q)
+        if ev:
+            ev.len = skb.len
+            ev.ifindex = skb.ifindex
+            ev.ts = py2bpf.funcs.ktime_get_ns()
+            py2bpf.funcs.ringbuf_submit(ev, 0)
+        return 0
+
+    return q, fn, 2 * q.pagesz + q.size
+
+
+def _run(make_queue, drain, num_pages, num_events, batch):
+    q, fn, mapped = make_queue(num_pages)
+    drain = getattr(q, drain)
+    prog = py2bpf.prog.create_prog(
+        py2bpf.prog.ProgType.SOCKET_FILTER,
+        py2bpf.socket_filter.SkBuffContext, fn)
+    raw = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        raw.setsockopt(socket.SOL_SOCKET, _SO_ATTACH_BPF, prog.fd)
+
+        received, drain_time = 0, 0
+        start = time.perf_counter()
+        for sent in range(0, num_events, batch):
+            for _ in range(min(batch, num_events - sent)):
+                udp.sendto(b'x', ('127.0.0.1', 9))
+            drain_start = time.perf_counter()
+            received += len(drain(timeout_ms=0))
+            drain_time += time.perf_counter() - drain_start
+        elapsed = time.perf_counter() - start
+    finally:
+        udp.close()
+        raw.close()
+        prog.close()
+        q.close()
+
+    return mapped, received, elapsed, drain_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=64,
+                        help='Events to send between drains')
+    parser.add_argument('--pages', type=int, default=8,
+                        help='Data pages per queue (per cpu for BpfQueue)')
+    args = parser.parse_args()
+
+    print('{:>16} {:>10} {:>10} {:>12} {:>14}'.format(
+        '', 'mapped', 'received', 'events/s', 'drain ns/event'))
+    queues = [
+        ('BpfQueue', _make_perf_queue, 'get_items', args.pages + 1),
+        ('ringbuf_output', _make_ring_buf_output, 'get_items', args.pages),
+        ('ringbuf_reserve', _make_ring_buf_reserve, 'get_items', args.pages),
+    ]
+    if numpy is not None:
+        queues.insert(
+            1, ('BpfQueue array', _make_perf_queue, 'get_array',
+                args.pages + 1))
+
+    for name, make_queue, drain, num_pages in queues:
+        mapped, received, elapsed, drain_time = _run(
+            make_queue, drain, num_pages, args.events, args.batch)
+        print('{:>16} {:>9}K {:>10} {:>12.0f} {:>14.0f}'.format(
+            name, mapped // 1024, received, received / elapsed,
+            drain_time / max(received, 1) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,26 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
+import collections
 import ctypes
 import enum
 import errno
 import fcntl
+import ipaddress
 import mmap
 import multiprocessing
 import os
 import resource
 import select
+import struct
+import threading
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import py2bpf._bpf._obj as _obj
 import py2bpf._bpf._syscall as _syscall
 import py2bpf._bpf._perf_event as pe
 from py2bpf._translation._datastructures import (
@@ -31,6 +41,22 @@ class BpfMapType(enum.IntEnum):
     PERCPU_HASH = 5
     PERCPU_ARRAY = 6
     STACK_TRACE = 7
+    CGROUP_ARRAY = 8
+    LRU_HASH = 9
+    LRU_PERCPU_HASH = 10
+    LPM_TRIE = 11
+    ARRAY_OF_MAPS = 12
+    HASH_OF_MAPS = 13
+    RINGBUF = 27
+
+
+class BpfMapFlags(enum.IntFlag):
+    # Allocate entries as they're added, rather than all up front. Required
+    # by LPM tries.
+    NO_PREALLOC = 1 << 0
+    # LRU maps only: one LRU list per cpu instead of one shared by all
+    NO_COMMON_LRU = 1 << 1
+    MMAPABLE = 1 << 10
 
 
 class _BpfAttrMapCreate(ctypes.Structure):
@@ -40,33 +66,89 @@ class _BpfAttrMapCreate(ctypes.Structure):
         ('value_size', ctypes.c_uint),
         ('max_entries', ctypes.c_uint),
         ('map_flags', ctypes.c_uint),
+        ('inner_map_fd', ctypes.c_uint),
+    ]
+
+
+class _BpfMapInfo(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint),
+        ('id', ctypes.c_uint),
+        ('key_size', ctypes.c_uint),
+        ('value_size', ctypes.c_uint),
+        ('max_entries', ctypes.c_uint),
+        ('map_flags', ctypes.c_uint),
+        ('name', ctypes.c_char * 16),
     ]
 
 
 class _BpfAttrMapElem(ctypes.Structure):
     _fields_ = [
         ('map_fd', ctypes.c_uint),
-        ('key', ctypes.c_char_p),
-        ('value_or_next_key', ctypes.c_char_p),
-        ('flags', ctypes.c_char_p),
+        ('key', ctypes.c_uint64),
+        ('value_or_next_key', ctypes.c_uint64),
+        ('flags', ctypes.c_uint64),
     ]
 
 
+class _ElemAttrs(threading.local):
+    '''A _BpfAttrMapElem per map and thread, so that map operations don't
+    build a new one each time, and concurrent ones don't trample each other
+    '''
+    def __init__(self, fd):
+        self.attr = _BpfAttrMapElem(map_fd=fd)
+        self.attr_p = ctypes.byref(self.attr)
+
+
+_ELEM_ATTR_SIZE = ctypes.sizeof(_BpfAttrMapElem)
+
+
+class _BpfAttrMapBatch(ctypes.Structure):
+    _fields_ = [
+        ('in_batch', ctypes.c_uint64),
+        ('out_batch', ctypes.c_uint64),
+        ('keys', ctypes.c_uint64),
+        ('values', ctypes.c_uint64),
+        ('count', ctypes.c_uint),
+        ('map_fd', ctypes.c_uint),
+        ('elem_flags', ctypes.c_uint64),
+        ('flags', ctypes.c_uint64),
+    ]
+
+
+# Kernels without batch operations (before 5.6), or maps that don't support
+# them, fail with one of these. ENOTSUPP is kernel-internal, but leaks out.
+_ENOTSUPP = 524
+_batch_unsupported_errnos = set([errno.EINVAL, errno.EOPNOTSUPP, _ENOTSUPP])
+
+# Maps whose elements can't be deleted, so deleting batches can't fall back
+# to deleting one element at a time
+_undeletable_map_types = set([BpfMapType.ARRAY, BpfMapType.PERCPU_ARRAY])
+
+_DEFAULT_CHUNK_SIZE = 256
+
+
 class _MapCmd(enum.IntEnum):
     CREATE = 0
     LOOKUP_ELEM = 1
     UPDATE_ELEM = 2
     DELETE_ELEM = 3
     GET_NEXT_KEY = 4
+    LOOKUP_BATCH = 24
+    LOOKUP_AND_DELETE_BATCH = 25
+    UPDATE_BATCH = 26
+    DELETE_BATCH = 27
 
 
-def _map_create(map_type, key_size, value_size, max_entries):
+def _map_create(map_type, key_size, value_size, max_entries, map_flags=0,
+                inner_map_fd=0):
     attr = _BpfAttrMapCreate(
         map_type=map_type,
         key_size=key_size,
         value_size=value_size,
         max_entries=max_entries,
-        map_flags=0
+        map_flags=map_flags,
+        inner_map_fd=inner_map_fd,
     )
     fd = _syscall.bpf(_MapCmd.CREATE, ctypes.pointer(attr), ctypes.sizeof(attr))
     if fd < 0:
@@ -77,12 +159,10 @@ def _map_create(map_type, key_size, value_size, max_entries):
 
 
 def _update_elem(fd, key, value):
-    key_p = ctypes.cast(ctypes.pointer(key), ctypes.c_char_p)
-    value_p = ctypes.cast(ctypes.pointer(value), ctypes.c_char_p)
     attr = _BpfAttrMapElem(
         map_fd=fd,
-        key=key_p,
-        value_or_next_key=value_p,
+        key=ctypes.addressof(key),
+        value_or_next_key=ctypes.addressof(value),
         flags=0,
     )
     attr_p = ctypes.pointer(attr)
@@ -92,17 +172,129 @@ def _update_elem(fd, key, value):
             os.strerror(eno)))
 
 
+def _concat(arrays, t):
+    ret = (t * sum(len(a) for a in arrays))()
+    off = 0
+    for a in arrays:
+        ctypes.memmove(ctypes.addressof(ret) + off, a, ctypes.sizeof(a))
+        off += ctypes.sizeof(a)
+    return ret
+
+
+def _to_array(vals, t):
+    if isinstance(vals, ctypes.Array) and vals._type_ is t:
+        return vals
+    return (t * len(vals))(*[v if isinstance(v, t) else t(v) for v in vals])
+
+
+def _get_dtype(t):
+    '''The numpy dtype laid out the same as ctypes type t'''
+    if issubclass(t, ctypes.Array):
+        return numpy.dtype((_get_dtype(t._type_), (t._length_,)))
+    elif issubclass(t, (ctypes.Structure, ctypes.Union)):
+        names, formats, offsets = [], [], []
+        for f in t._fields_:
+            if len(f) > 2:
+                raise TypeError('bitfield {} has no numpy equivalent'.format(
+                    f[0]))
+            names.append(f[0])
+            formats.append(_get_dtype(f[1]))
+            offsets.append(getattr(t, f[0]).offset)
+        return numpy.dtype({
+            'names': names,
+            'formats': formats,
+            'offsets': offsets,
+            'itemsize': ctypes.sizeof(t),
+        })
+    return numpy.dtype(t)
+
+
+def _split_dtype(t):
+    '''Returns (dtype, shape) for an array of t, so that arrays of arrays
+    come out as multidimensional arrays of the innermost type
+    '''
+    dtype = _get_dtype(t)
+    if dtype.subdtype is not None:
+        return dtype.subdtype
+    return dtype, ()
+
+
+def _to_ndarray(arr, t):
+    dtype, shape = _split_dtype(t)
+    if len(arr) == 0:
+        return numpy.zeros((0,) + shape, dtype=dtype)
+    return numpy.frombuffer(arr, dtype=dtype).reshape((len(arr),) + shape)
+
+
+def _from_ndarray(vals, t):
+    dtype, shape = _split_dtype(t)
+    vals = numpy.ascontiguousarray(vals, dtype=dtype)
+    if vals.shape[1:] != shape:
+        raise ValueError('shape {} does not hold {}'.format(
+            vals.shape, t.__name__))
+    return (t * len(vals)).from_buffer_copy(vals)
+
+
 class BpfMap(FileDescriptorDatastructure):
-    def __init__(self, max_entries):
+    MAP_TYPE = BpfMapType.HASH
+    MAP_FLAGS = 0
+
+    # Batch commands that have turned out to be unsupported for this map
+    _unsupported_batch_cmds = frozenset()
+
+    def __init__(self, max_entries, fd=None):
+        '''Create a map, or if fd is given, take ownership of an existing
+        one that matches this class
+        '''
         self.fd = -1
-        key_size = ctypes.sizeof(self.KEY_TYPE)
-        value_size = ctypes.sizeof(self.VALUE_TYPE)
-        self.fd = _map_create(BpfMapType.HASH, key_size, value_size, max_entries)
+        self.max_entries = max_entries
+        if fd is None:
+            key_size = ctypes.sizeof(self.KEY_TYPE)
+            value_size = ctypes.sizeof(self.VALUE_TYPE)
+            fd = _map_create(self.MAP_TYPE, key_size, value_size,
+                             max_entries, self.MAP_FLAGS)
+        self.fd = fd
+        self._elem_attrs = _ElemAttrs(self.fd)
 
     def close(self):
         if self.fd >= 0:
             os.close(self.fd)
 
+    def pin(self, path):
+        '''Pin the map at path on a bpf filesystem, so that it, and its
+        contents, outlive this process. See open_pinned.
+        '''
+        _obj.pin(self.fd, path)
+
+    @staticmethod
+    def open_pinned(path, key_type, value_type, default=None):
+        '''Open the map pinned at path, as the same kind of map create_map
+        would return. Raises ValueError if key_type or value_type aren't the
+        size of its keys and values.
+        '''
+        fd = _obj.get_pinned(path)
+        try:
+            info = _obj.get_info(fd, _BpfMapInfo)
+            for what, t, size in [('key', key_type, info.key_size),
+                                  ('value', value_type, info.value_size)]:
+                if ctypes.sizeof(t) != size:
+                    raise ValueError(
+                        '{} has {} byte {}s, but {} is {} bytes'.format(
+                            path, size, what, t.__name__, ctypes.sizeof(t)))
+            map_type = BpfMapType(info.type)
+        except Exception:
+            os.close(fd)
+            raise
+
+        class MapClass(_get_map_class(map_type, info.map_flags)):
+            MAP_TYPE = map_type
+            MAP_FLAGS = info.map_flags
+            KEY_TYPE = key_type
+            VALUE_TYPE = value_type
+            DEFAULT_VALUE = default if default is not None else value_type()
+
+        return MapClass(info.max_entries, fd=fd)
+
     def __getitem__(self, key):
         if not isinstance(key, self.KEY_TYPE):
             key = self.KEY_TYPE(key)
@@ -120,36 +312,50 @@ class BpfMap(FileDescriptorDatastructure):
             key = self.KEY_TYPE(key)
         self.delete(key)
 
-    def update(self, key, value):
-        if not isinstance(key, self.KEY_TYPE):
-            raise TypeError('key {} is not instance of key_type {}'.format(
-                repr(key), repr(self.KEY_TYPE)))
+    def _elem_op(self, cmd, key, value_or_next_key=None):
+        attrs = self._elem_attrs
+        attrs.attr.key = ctypes.addressof(key) if key is not None else 0
+        attrs.attr.value_or_next_key = (
+            ctypes.addressof(value_or_next_key)
+            if value_or_next_key is not None else 0)
+        return _syscall.bpf(cmd, attrs.attr_p, _ELEM_ATTR_SIZE)
+
+    @property
+    def _raw_value_type(self):
+        '''The type of the value the kernel reads and writes for each key'''
+        return self.VALUE_TYPE
 
+    def _to_raw_value(self, value):
         if not isinstance(value, self.VALUE_TYPE):
             raise TypeError('value {} is not instance of value_type {}'.format(
                 repr(value), repr(self.VALUE_TYPE)))
+        return value
 
-        _update_elem(self.fd, key, value)
+    def _to_raw_values(self, values):
+        return _to_array(values, self.VALUE_TYPE)
 
-    def lookup(self, key):
+    def _from_raw_value(self, raw):
+        return raw
+
+    def update(self, key, value):
         if not isinstance(key, self.KEY_TYPE):
             raise TypeError('key {} is not instance of key_type {}'.format(
                 repr(key), repr(self.KEY_TYPE)))
 
-        key_p = ctypes.cast(ctypes.pointer(key), ctypes.c_char_p)
+        value = self._to_raw_value(value)
+        if self._elem_op(_MapCmd.UPDATE_ELEM, key, value) != 0:
+            eno = _syscall._get_errno()
+            raise OSError(eno, 'Failed to update bpf map: {}'.format(
+                os.strerror(eno)))
 
-        value = self.VALUE_TYPE()
-        value_p = ctypes.cast(ctypes.pointer(value), ctypes.c_char_p)
-        attr = _BpfAttrMapElem(
-            map_fd=self.fd,
-            key=key_p,
-            value_or_next_key=value_p,
-            flags=0,
-        )
-        attr_p = ctypes.pointer(attr)
-        ret = _syscall.bpf(_MapCmd.LOOKUP_ELEM, attr_p, ctypes.sizeof(attr))
-        if ret == 0:
-            return value
+    def lookup(self, key):
+        if not isinstance(key, self.KEY_TYPE):
+            raise TypeError('key {} is not instance of key_type {}'.format(
+                repr(key), repr(self.KEY_TYPE)))
+
+        value = self._raw_value_type()
+        if self._elem_op(_MapCmd.LOOKUP_ELEM, key, value) == 0:
+            return self._from_raw_value(value)
 
         eno = _syscall._get_errno()
         if eno == errno.ENOENT:
@@ -163,12 +369,7 @@ class BpfMap(FileDescriptorDatastructure):
             raise TypeError('key {} is not instance of key_type {}'.format(
                 repr(key), repr(self.KEY_TYPE)))
 
-        key_p = ctypes.cast(ctypes.pointer(key), ctypes.c_char_p)
-        attr = _BpfAttrMapElem(map_fd=self.fd, key=key_p, flags=0)
-        attr_p = ctypes.pointer(attr)
-
-        ret = _syscall.bpf(_MapCmd.DELETE_ELEM, attr_p, ctypes.sizeof(attr))
-        if ret == 0:
+        if self._elem_op(_MapCmd.DELETE_ELEM, key) == 0:
             return
 
         eno = _syscall._get_errno()
@@ -179,23 +380,14 @@ class BpfMap(FileDescriptorDatastructure):
             os.strerror(eno)))
 
     def get_next_key(self, last_key):
-        if not isinstance(last_key, self.KEY_TYPE):
+        '''Returns the key after last_key, the first key if last_key is None
+        (or, for hash maps, no longer in the map), or None at the end
+        '''
+        if last_key is not None and not isinstance(last_key, self.KEY_TYPE):
             raise TypeError('key {} is not instance of key_type {}'.format(
                 repr(last_key), repr(self.KEY_TYPE)))
-        key_p = ctypes.cast(ctypes.pointer(last_key), ctypes.c_char_p)
-
         next_key = self.KEY_TYPE()
-        next_key_p = ctypes.cast(ctypes.pointer(next_key), ctypes.c_char_p)
-
-        attr = _BpfAttrMapElem(
-            map_fd=self.fd,
-            key=key_p,
-            value_or_next_key=next_key_p,
-            flags=0,
-        )
-        attr_p = ctypes.pointer(attr)
-        ret = _syscall.bpf(_MapCmd.GET_NEXT_KEY, attr_p, ctypes.sizeof(attr))
-        if ret == 0:
+        if self._elem_op(_MapCmd.GET_NEXT_KEY, last_key, next_key) == 0:
             return next_key
 
         eno = _syscall._get_errno()
@@ -205,22 +397,483 @@ class BpfMap(FileDescriptorDatastructure):
         raise OSError(eno, 'Failed to get next key: {}'.format(
             os.strerror(eno)))
 
-    def keys(self):
-        keys = []
-        last_key = self.KEY_TYPE()
+    def _batch_op(self, cmd, keys_addr, values_addr, count, in_batch=0,
+                  out_batch=0):
+        '''Returns (errno, count), where count is how many elements were
+        processed. Everything else is passed by address.
+        '''
+        attr = _BpfAttrMapBatch(
+            in_batch=in_batch,
+            out_batch=out_batch,
+            keys=keys_addr,
+            values=values_addr,
+            count=count,
+            map_fd=self.fd,
+        )
+        ret = _syscall.bpf(cmd, ctypes.byref(attr), ctypes.sizeof(attr))
+        return (_syscall._get_errno() if ret != 0 else 0), attr.count
+
+    def _has_batch(self, cmd):
+        return cmd not in self._unsupported_batch_cmds
+
+    def _batch_unsupported(self, cmd, eno, what):
+        '''Note that cmd isn't supported, after checking that it can be done
+        an element at a time instead. If not, raises OSError for eno.
+        '''
+        if (cmd in [_MapCmd.LOOKUP_AND_DELETE_BATCH, _MapCmd.DELETE_BATCH]
+                and self.MAP_TYPE in _undeletable_map_types):
+            raise OSError(eno, 'Failed to {} bpf map: {}'.format(
+                what, os.strerror(eno)))
+        self._unsupported_batch_cmds = self._unsupported_batch_cmds | {cmd}
+
+    def _lookup_batches(self, cmd, chunk_size):
+        '''Yields (keys, values), arrays of up to chunk_size entries at a
+        time. If cmd isn't supported, notes that and yields nothing.
+        '''
+        # Hash maps hand back a bucket number to resume from, and others a
+        # key, so make room for either. The kernel reads where to start
+        # before writing where to resume, so one buffer does for both.
+        batch = ctypes.create_string_buffer(
+            max(ctypes.sizeof(self.KEY_TYPE), 8))
+        delete = cmd == _MapCmd.LOOKUP_AND_DELETE_BATCH
+        in_batch = 0
         while True:
-            next_key = self.get_next_key(last_key)
-            if next_key is None:
-                return keys
-            keys.append(next_key)
-            last_key = next_key
+            keys = (self.KEY_TYPE * chunk_size)()
+            values = (self._raw_value_type * chunk_size)()
+            eno, count = self._batch_op(
+                cmd, ctypes.addressof(keys), ctypes.addressof(values),
+                chunk_size, in_batch, ctypes.addressof(batch))
+            if eno in _batch_unsupported_errnos and in_batch == 0:
+                self._batch_unsupported(cmd, eno, 'lookup and delete from'
+                                        if delete else 'lookup')
+                return
+            elif eno == errno.ENOSPC and count == 0:
+                # A hash bucket didn't fit
+                chunk_size *= 2
+                continue
+            elif eno not in [0, errno.ENOENT]:
+                raise OSError(eno, 'Failed to lookup bpf map: {}'.format(
+                    os.strerror(eno)))
+
+            if count > 0:
+                yield ((self.KEY_TYPE * count).from_buffer(keys),
+                       (self._raw_value_type * count).from_buffer(values))
+            if eno == errno.ENOENT:
+                return
+            in_batch = ctypes.addressof(batch)
+
+    def _lookup_all(self, cmd, delete):
+        if self._has_batch(cmd):
+            chunks = list(self._lookup_batches(cmd, self.max_entries))
+            if self._has_batch(cmd):
+                return (_concat([k for k, _ in chunks], self.KEY_TYPE),
+                        _concat([v for _, v in chunks],
+                                self._raw_value_type))
+
+        items = []
+        for k, v in self._raw_items(_DEFAULT_CHUNK_SIZE):
+            items.append((k, v))
+            if delete:
+                try:
+                    self.delete(k)
+                except KeyError:
+                    pass
+        return (_to_array([k for k, _ in items], self.KEY_TYPE),
+                _to_array([v for _, v in items], self._raw_value_type))
+
+    def lookup_batch(self):
+        '''Returns (keys, values), arrays of KEY_TYPE and VALUE_TYPE holding
+        every entry in the map, read a batch at a time
+        '''
+        return self._lookup_all(_MapCmd.LOOKUP_BATCH, delete=False)
+
+    def lookup_and_delete_batch(self):
+        '''Like lookup_batch, but empties the map as it goes'''
+        return self._lookup_all(_MapCmd.LOOKUP_AND_DELETE_BATCH, delete=True)
+
+    def to_numpy(self):
+        '''Returns (keys, values), numpy arrays holding every entry in the
+        map. Their dtypes mirror KEY_TYPE and VALUE_TYPE, and they're views
+        of the buffers lookup_batch reads into, so nothing is converted an
+        entry at a time.
+        '''
+        if numpy is None:
+            raise ImportError('to_numpy requires numpy')
+        keys, values = self.lookup_batch()
+        return (_to_ndarray(keys, self.KEY_TYPE),
+                _to_ndarray(values, self.VALUE_TYPE))
+
+    def from_numpy(self, keys, values):
+        '''Set keys[i] to values[i] for all i with update_batch. keys and
+        values are converted to the dtypes to_numpy would return.
+        '''
+        if numpy is None:
+            raise ImportError('from_numpy requires numpy')
+        self.update_batch(_from_ndarray(keys, self.KEY_TYPE),
+                          _from_ndarray(values, self.VALUE_TYPE))
+
+    def update_batch(self, keys, values):
+        '''Set keys[i] to values[i] for all i, in one syscall. Anything
+        that isn't already an array of KEY_TYPE or VALUE_TYPE is converted
+        into one first.
+        '''
+        keys = _to_array(keys, self.KEY_TYPE)
+        values = self._to_raw_values(values)
+        if len(keys) != len(values):
+            raise ValueError('{} keys but {} values'.format(
+                len(keys), len(values)))
+
+        if self._has_batch(_MapCmd.UPDATE_BATCH) and len(keys) > 0:
+            eno, count = self._batch_op(
+                _MapCmd.UPDATE_BATCH, ctypes.addressof(keys),
+                ctypes.addressof(values), len(keys))
+            if eno == 0:
+                return
+            elif eno not in _batch_unsupported_errnos or count != 0:
+                raise OSError(eno, 'Failed to update bpf map: {}'.format(
+                    os.strerror(eno)))
+            self._batch_unsupported(_MapCmd.UPDATE_BATCH, eno, 'update')
+
+        for k, v in zip(keys, values):
+            self[k] = v
+
+    def delete_batch(self, keys):
+        '''Delete all of keys in one syscall. Raises KeyError for the first
+        one that isn't there, after deleting the ones before it.
+        '''
+        keys = _to_array(keys, self.KEY_TYPE)
+
+        if self._has_batch(_MapCmd.DELETE_BATCH) and len(keys) > 0:
+            eno, count = self._batch_op(
+                _MapCmd.DELETE_BATCH, ctypes.addressof(keys), 0, len(keys))
+            if eno == 0:
+                return
+            elif eno == errno.ENOENT:
+                raise KeyError(keys[count])
+            elif eno not in _batch_unsupported_errnos or count != 0:
+                raise OSError(eno, 'Failed to delete from bpf map: {}'.format(
+                    os.strerror(eno)))
+            self._batch_unsupported(
+                _MapCmd.DELETE_BATCH, eno, 'delete from')
+
+        for k in keys:
+            del self[k]
+
+    def _raw_items(self, chunk_size):
+        if self._has_batch(_MapCmd.LOOKUP_BATCH):
+            key_size = ctypes.sizeof(self.KEY_TYPE)
+            value_type = self._raw_value_type
+            value_size = ctypes.sizeof(value_type)
+            for keys, values in self._lookup_batches(
+                    _MapCmd.LOOKUP_BATCH, chunk_size):
+                for idx in range(len(keys)):
+                    yield (self.KEY_TYPE.from_buffer_copy(
+                               keys, idx * key_size),
+                           value_type.from_buffer_copy(
+                               values, idx * value_size))
+            if self._has_batch(_MapCmd.LOOKUP_BATCH):
+                return
+
+        key = self.get_next_key(None)
+        while key is not None:
+            value = self._raw_value_type()
+            if self._elem_op(_MapCmd.LOOKUP_ELEM, key, value) == 0:
+                yield key, value
+            key = self.get_next_key(key)
+
+    def items(self, chunk_size=_DEFAULT_CHUNK_SIZE):
+        '''Lazily yields (key, value) for each entry in the map, reading
+        chunk_size of them at a time where batches are supported.
+
+        Without batches, if the last key we saw is deleted, hash maps
+        start over from the first key, so entries may come up again.
+        '''
+        for k, v in self._raw_items(chunk_size):
+            yield k, self._from_raw_value(v)
+
+    def keys(self, chunk_size=_DEFAULT_CHUNK_SIZE):
+        '''Lazily yields each key in the map. See items.'''
+        for k, _ in self.items(chunk_size):
+            yield k
+
+    def values(self, chunk_size=_DEFAULT_CHUNK_SIZE):
+        '''Lazily yields each value in the map. See items.'''
+        for _, v in self.items(chunk_size):
+            yield v
+
+    def __iter__(self):
+        return self.keys()
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        if self._has_batch(_MapCmd.LOOKUP_BATCH):
+            n = sum(len(keys) for keys, _ in self._lookup_batches(
+                _MapCmd.LOOKUP_BATCH, _DEFAULT_CHUNK_SIZE))
+            if self._has_batch(_MapCmd.LOOKUP_BATCH):
+                return n
+
+        n = 0
+        key = self.get_next_key(None)
+        while key is not None:
+            n += 1
+            key = self.get_next_key(key)
+        return n
+
+
+_num_possible_cpus = None
+
+
+def get_num_possible_cpus():
+    '''How many cpus per-cpu maps hold a value for'''
+    global _num_possible_cpus
+    if _num_possible_cpus is None:
+        # Something like 0-7, or 0,2-3
+        with open('/sys/devices/system/cpu/possible') as f:
+            ranges = f.read().strip().split(',')
+        _num_possible_cpus = max(int(r.split('-')[-1]) for r in ranges) + 1
+    return _num_possible_cpus
+
+
+def _get_padded_array_type(value_type, num):
+    '''An array of num value_types, each padded to 8 bytes the way the kernel
+    lays out per-cpu values and array map elements
+    '''
+    pad = -ctypes.sizeof(value_type) % 8
+    if pad == 0:
+        return value_type * num
+
+    class PaddedValue(ctypes.Structure):
+        _fields_ = [
+            ('value', value_type),
+            ('pad', ctypes.c_uint8 * pad),
+        ]
+
+    return PaddedValue * num
+
+
+_aggregates = {
+    'sum': sum,
+    'max': max,
+    'min': min,
+}
+
+
+class PerCpuBpfMap(BpfMap):
+    '''A map with a value per key per cpu. In bpf, subscripting reads and
+    writes the value for the cpu we're running on. From python, values are
+    lists with one value per possible cpu, and setting a single value sets
+    it for all of them.
+    '''
+    MAP_TYPE = BpfMapType.PERCPU_HASH
+
+    def __init__(self, max_entries, fd=None):
+        self.num_cpus = get_num_possible_cpus()
+        self._per_cpu_type = _get_padded_array_type(
+            self.VALUE_TYPE, self.num_cpus)
+        self._value_stride = ctypes.sizeof(self._per_cpu_type) // self.num_cpus
+        super(PerCpuBpfMap, self).__init__(max_entries, fd)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, self.KEY_TYPE):
+            key = self.KEY_TYPE(key)
+        self.update(key, self._convert_value(value))
+
+    def _convert_value(self, value):
+        if isinstance(value, (self.VALUE_TYPE, self._per_cpu_type)):
+            return value
+        elif isinstance(value, (list, tuple, range)):
+            return [v if isinstance(v, self.VALUE_TYPE) else self.VALUE_TYPE(v)
+                    for v in value]
+        return self.VALUE_TYPE(value)
+
+    @property
+    def _raw_value_type(self):
+        return self._per_cpu_type
+
+    def _to_raw_value(self, value):
+        if isinstance(value, self._per_cpu_type):
+            return value
+        elif isinstance(value, self.VALUE_TYPE):
+            value = [value] * self.num_cpus
+        elif len(value) != self.num_cpus:
+            raise ValueError('{} values for {} cpus'.format(
+                len(value), self.num_cpus))
+
+        raw = self._per_cpu_type()
+        for cpu, v in enumerate(value):
+            if not isinstance(v, self.VALUE_TYPE):
+                raise TypeError(
+                    'value {} is not instance of value_type {}'.format(
+                        repr(v), repr(self.VALUE_TYPE)))
+            ctypes.memmove(ctypes.addressof(raw) + cpu * self._value_stride,
+                           ctypes.addressof(v), ctypes.sizeof(v))
+        return raw
+
+    def _to_raw_values(self, values):
+        if (isinstance(values, ctypes.Array) and
+                values._type_ is self._per_cpu_type):
+            return values
+        return (self._per_cpu_type * len(values))(*[
+            self._to_raw_value(self._convert_value(v)) for v in values])
+
+    def _from_raw_value(self, raw):
+        return [self.VALUE_TYPE.from_buffer(raw, cpu * self._value_stride)
+                for cpu in range(self.num_cpus)]
+
+    def aggregate(self, key, how='sum'):
+        '''Combine the values for key across cpus, with how one of 'sum',
+        'max' or 'min'. VALUE_TYPE must be a number.
+        '''
+        return _aggregates[how](v.value for v in self[key])
+
+    def _per_cpu_ndarray(self, raw, n):
+        dtype, shape = _split_dtype(self.VALUE_TYPE)
+        if n == 0:
+            return numpy.zeros((0, self.num_cpus) + shape, dtype=dtype)
+        inner_strides = numpy.zeros(shape, dtype=dtype).strides
+        return numpy.ndarray(
+            shape=(n, self.num_cpus) + shape, dtype=dtype, buffer=raw,
+            strides=(ctypes.sizeof(self._per_cpu_type),
+                     self._value_stride) + inner_strides)
+
+    def to_numpy(self, aggregate=None):
+        '''Like BpfMap.to_numpy, but values have a second dimension for cpus.
+        If aggregate is one of 'sum', 'max' or 'min', values are combined
+        across cpus instead, all at once.
+        '''
+        if numpy is None:
+            raise ImportError('to_numpy requires numpy')
+        keys, values = self.lookup_batch()
+        values = self._per_cpu_ndarray(values, len(values))
+        if aggregate is not None:
+            if aggregate not in _aggregates:
+                raise ValueError('Unknown aggregate {}'.format(aggregate))
+            values = getattr(numpy, aggregate)(values, axis=1)
+        return _to_ndarray(keys, self.KEY_TYPE), values
+
+    def from_numpy(self, keys, values):
+        '''Like BpfMap.from_numpy. values may have a second dimension for
+        cpus, and without one every cpu gets the same value.
+        '''
+        if numpy is None:
+            raise ImportError('from_numpy requires numpy')
+        dtype, shape = _split_dtype(self.VALUE_TYPE)
+        values = numpy.asarray(values, dtype=dtype)
+        if values.shape[1:] == shape:
+            values = values[:, numpy.newaxis]
+        raw = (self._per_cpu_type * len(values))()
+        self._per_cpu_ndarray(raw, len(values))[...] = values
+        self.update_batch(_from_ndarray(keys, self.KEY_TYPE), raw)
+
+
+class MmapArray(BpfMap):
+    '''An array map which python reads and writes through shared memory
+    rather than syscalls (requires linux 5.5). Indexing copies elements in
+    and out, and as_ctypes and as_numpy give views of the whole array.
+    In bpf, it's subscripted like any other map.
+    '''
+    MAP_TYPE = BpfMapType.ARRAY
+    MAP_FLAGS = BpfMapFlags.MMAPABLE
+    KEY_TYPE = ctypes.c_uint32
+
+    def __init__(self, max_entries, fd=None):
+        self.mm = None
+        super(MmapArray, self).__init__(max_entries, fd)
+        self._array_type = _get_padded_array_type(
+            self.VALUE_TYPE, max_entries)
+        self._stride = ctypes.sizeof(self._array_type) // max_entries
+        try:
+            self.mm = mmap.mmap(self.fd, ctypes.sizeof(self._array_type))
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        # Views from as_ctypes and as_numpy hold onto the mapping, so it's
+        # unmapped once they're gone too
+        self.mm = None
+        super(MmapArray, self).close()
+
+    def _get_offset(self, key):
+        idx = key.value if isinstance(key, self.KEY_TYPE) else key
+        if not 0 <= idx < self.max_entries:
+            raise IndexError(idx)
+        return idx * self._stride
+
+    def lookup(self, key):
+        return self.VALUE_TYPE.from_buffer_copy(self.mm, self._get_offset(key))
+
+    def update(self, key, value):
+        if not isinstance(value, self.VALUE_TYPE):
+            raise TypeError('value {} is not instance of value_type {}'.format(
+                repr(value), repr(self.VALUE_TYPE)))
+        off = self._get_offset(key)
+        self.mm[off:off + ctypes.sizeof(value)] = bytes(value)
+
+    def __len__(self):
+        return self.max_entries
+
+    def as_ctypes(self):
+        '''A ctypes array over the shared memory. If VALUE_TYPE isn't a
+        multiple of 8 bytes, each element is padded, with its value in
+        .value.
+        '''
+        return self._array_type.from_buffer(self.mm)
+
+    def as_numpy(self):
+        '''A numpy array over the shared memory, with a dtype like
+        to_numpy's values
+        '''
+        if numpy is None:
+            raise ImportError('as_numpy requires numpy')
+        dtype, shape = _split_dtype(self.VALUE_TYPE)
+        inner_strides = numpy.zeros(shape, dtype=dtype).strides
+        return numpy.ndarray(
+            shape=(self.max_entries,) + shape, dtype=dtype, buffer=self.mm,
+            strides=(self._stride,) + inner_strides)
+
+
+def create_mmap_array(value_type, max_entries, default=None):
+    class ArrayClass(MmapArray):
+        VALUE_TYPE = value_type
+        DEFAULT_VALUE = default if default is not None else value_type()
+
+    return ArrayClass(max_entries)
 
-    def items(self):
-        return [(k, self.lookup(k)) for k in self.keys()]
 
+_per_cpu_map_types = set([
+    BpfMapType.PERCPU_HASH,
+    BpfMapType.PERCPU_ARRAY,
+    BpfMapType.LRU_PERCPU_HASH,
+])
 
-def create_map(key_type, value_type, max_entries, default=None):
-    class MapClass(BpfMap):
+
+def _get_map_class(map_type, map_flags):
+    if map_type in _per_cpu_map_types:
+        return PerCpuBpfMap
+    elif map_type == BpfMapType.ARRAY and map_flags & BpfMapFlags.MMAPABLE:
+        return MmapArray
+    elif map_type == BpfMapType.LPM_TRIE:
+        return LpmTrie
+    return BpfMap
+
+
+def create_map(key_type, value_type, max_entries, default=None,
+               map_type=BpfMapType.HASH, map_flags=0):
+    '''Create a map of max_entries value_types indexed by key_types. map_type
+    may be any of the hash or array types, and the per-cpu ones give you a
+    PerCpuBpfMap. Once an LRU map is full, inserting evicts the least
+    recently used entries instead of failing. map_flags are BpfMapFlags.
+    '''
+    class MapClass(_get_map_class(map_type, map_flags)):
+        MAP_TYPE = map_type
+        MAP_FLAGS = map_flags
         KEY_TYPE = key_type
         VALUE_TYPE = value_type
         DEFAULT_VALUE = default if default is not None else value_type()
@@ -228,6 +881,173 @@ def create_map(key_type, value_type, max_entries, default=None):
     return MapClass(max_entries)
 
 
+class BpfMapOfMaps(BpfMap):
+    '''A map whose values are maps like INNER_MAP, with INNER_MAX_ENTRIES
+    entries. In bpf, subscripting it gives the inner map, which can be
+    subscripted in turn, as in m[0][key]. If there's no inner map, reads
+    give the default value and writes do nothing. From python, values are
+    set to maps, and looking them up gives the ids of the maps that are
+    there.
+    '''
+    MAP_TYPE = BpfMapType.HASH_OF_MAPS
+    VALUE_TYPE = ctypes.c_uint32
+
+    def __init__(self, max_entries, fd=None):
+        if fd is None:
+            # The kernel checks that inner maps all look like this one
+            template = self.INNER_MAP(self.INNER_MAX_ENTRIES)
+            try:
+                fd = _map_create(
+                    self.MAP_TYPE, ctypes.sizeof(self.KEY_TYPE),
+                    ctypes.sizeof(self.VALUE_TYPE), max_entries,
+                    self.MAP_FLAGS, template.fd)
+            finally:
+                template.close()
+        super(BpfMapOfMaps, self).__init__(max_entries, fd)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, self.KEY_TYPE):
+            key = self.KEY_TYPE(key)
+        self.update(key, value)
+
+    def _to_raw_value(self, value):
+        if isinstance(value, BpfMap):
+            value = self.VALUE_TYPE(value.fd)
+        return super(BpfMapOfMaps, self)._to_raw_value(value)
+
+    def _to_raw_values(self, values):
+        return _to_array([self._to_raw_value(v) for v in values],
+                         self.VALUE_TYPE)
+
+    def replace(self, key, keys, values):
+        '''Build a new inner map holding keys and values, and put it in at
+        key with a single update. Programs see either the old map or the
+        new one, never a partly updated one. Returns the new map. Closing
+        the old one is up to you.
+        '''
+        m = self.INNER_MAP(self.INNER_MAX_ENTRIES)
+        try:
+            m.update_batch(keys, values)
+            self[key] = m
+        except Exception:
+            m.close()
+            raise
+        return m
+
+    @staticmethod
+    def open_pinned(path, key_type, inner_map):
+        '''Open the map of maps pinned at path, whose inner maps are like
+        inner_map
+        '''
+        fd = _obj.get_pinned(path)
+        try:
+            info = _obj.get_info(fd, _BpfMapInfo)
+            if info.type not in _map_of_maps_types:
+                raise ValueError('{} is not a map of maps'.format(path))
+            elif ctypes.sizeof(key_type) != info.key_size:
+                raise ValueError(
+                    '{} has {} byte keys, but {} is {} bytes'.format(
+                        path, info.key_size, key_type.__name__,
+                        ctypes.sizeof(key_type)))
+        except Exception:
+            os.close(fd)
+            raise
+        return _create_map_of_maps_class(
+            key_type, inner_map, BpfMapType(info.type), info.map_flags)(
+                info.max_entries, fd=fd)
+
+
+class LpmKey(ctypes.Structure):
+    '''Base for LPM trie keys, which match any address whose first
+    prefixlen bits are the same as data's. Besides the fields, they can be
+    built from anything ipaddress.ip_network takes, like '10.0.0.0/8', or
+    from addresses, which get a prefix as long as they are.
+    '''
+    def __init__(self, *args, **kwargs):
+        if len(kwargs) == 0 and len(args) == 1 and isinstance(args[0], (
+                str, ipaddress.IPv4Address, ipaddress.IPv6Address,
+                ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            net = ipaddress.ip_network(str(args[0]), strict=False)
+            packed = net.network_address.packed
+            if len(packed) != ctypes.sizeof(self.DATA_TYPE):
+                raise ValueError('{} does not fit in {}'.format(
+                    net, self.DATA_TYPE.__name__))
+            args = (net.prefixlen, self.DATA_TYPE.from_buffer_copy(packed))
+        super(LpmKey, self).__init__(*args, **kwargs)
+
+    def to_network(self):
+        '''The ipaddress network this key matches'''
+        return ipaddress.ip_network((bytes(self.data), self.prefixlen))
+
+
+_lpm_key_types = {}
+
+
+def create_lpm_key_type(data_type):
+    '''The LpmKey type for prefixes of data_type, e.g. ctypes.c_uint8 * 4
+    for IPv4 addresses
+    '''
+    if data_type not in _lpm_key_types:
+        class LpmKeyClass(LpmKey):
+            DATA_TYPE = data_type
+            _fields_ = [
+                ('prefixlen', ctypes.c_uint32),
+                ('data', data_type),
+            ]
+        _lpm_key_types[data_type] = LpmKeyClass
+    return _lpm_key_types[data_type]
+
+
+class LpmTrie(BpfMap):
+    '''A longest prefix match trie, keyed by an LpmKey type. Looking up a
+    key finds the entry with the longest prefix that matches it. In bpf,
+    tries can also be subscripted with the key's DATA_TYPE, which looks up
+    with a prefix as long as it is.
+    '''
+    MAP_TYPE = BpfMapType.LPM_TRIE
+    MAP_FLAGS = BpfMapFlags.NO_PREALLOC
+
+
+def create_lpm_trie(data_type, value_type, max_entries, default=None):
+    '''Create an LPM trie of up to max_entries prefixes of data_type'''
+    class TrieClass(LpmTrie):
+        KEY_TYPE = create_lpm_key_type(data_type)
+        VALUE_TYPE = value_type
+        DEFAULT_VALUE = default if default is not None else value_type()
+
+    return TrieClass(max_entries)
+
+
+_map_of_maps_types = set([
+    BpfMapType.ARRAY_OF_MAPS,
+    BpfMapType.HASH_OF_MAPS,
+])
+
+
+def _create_map_of_maps_class(key_type, inner_map, map_type, map_flags):
+    class MapOfMapsClass(BpfMapOfMaps):
+        MAP_TYPE = map_type
+        MAP_FLAGS = map_flags
+        KEY_TYPE = key_type
+        INNER_MAP = type(inner_map)
+        INNER_MAX_ENTRIES = inner_map.max_entries
+        DEFAULT_VALUE = ctypes.c_uint32()
+
+    return MapOfMapsClass
+
+
+def create_map_of_maps(key_type, inner_map, max_entries,
+                       map_type=BpfMapType.HASH_OF_MAPS, map_flags=0):
+    '''Create a map of up to max_entries maps like inner_map, indexed by
+    key_types. map_type is HASH_OF_MAPS or ARRAY_OF_MAPS. inner_map itself
+    isn't added; it's only used to tell what the inner maps look like.
+    '''
+    if map_type not in _map_of_maps_types:
+        raise ValueError('{} is not a map of maps type'.format(map_type))
+    return _create_map_of_maps_class(
+        key_type, inner_map, map_type, map_flags)(max_entries)
+
+
 PERF_MAX_STACK_DEPTH = 127
 
 
@@ -237,10 +1057,12 @@ class BpfStackTraceMap(BpfMap):
 
     def __init__(self, max_entries):
         self.fd = -1
+        self.max_entries = max_entries
         key_size = ctypes.sizeof(self.KEY_TYPE)
         value_size = ctypes.sizeof(self.VALUE_TYPE)
         self.fd = _map_create(
             BpfMapType.STACK_TRACE, key_size, value_size, max_entries)
+        self._elem_attrs = _ElemAttrs(self.fd)
 
     def __del__(self):
         if self.fd >= 0:
@@ -261,20 +1083,9 @@ class BpfStackTraceMap(BpfMap):
             raise TypeError('key {} is not instance of key_type {}'.format(
                 repr(key), repr(self.KEY_TYPE)))
 
-        key_p = ctypes.cast(ctypes.pointer(key), ctypes.c_char_p)
-
-        value = self.VALUE_TYPE()
-        value_p = ctypes.cast(ctypes.pointer(value), ctypes.c_char_p)
-        attr = _BpfAttrMapElem(
-            map_fd=self.fd,
-            key=key_p,
-            value_or_next_key=value_p,
-            flags=0,
-        )
-        attr_p = ctypes.pointer(attr)
-        ret = _syscall.bpf(_MapCmd.LOOKUP_ELEM, attr_p, ctypes.sizeof(attr))
-        if ret == 0:
-            return value
+        value = self._raw_value_type()
+        if self._elem_op(_MapCmd.LOOKUP_ELEM, key, value) == 0:
+            return self._from_raw_value(value)
 
         eno = _syscall._get_errno()
         if eno == errno.ENOENT:
@@ -288,12 +1099,7 @@ class BpfStackTraceMap(BpfMap):
             raise TypeError('key {} is not instance of key_type {}'.format(
                 repr(key), repr(self.KEY_TYPE)))
 
-        key_p = ctypes.cast(ctypes.pointer(key), ctypes.c_char_p)
-        attr = _BpfAttrMapElem(map_fd=self.fd, key=key_p, flags=0)
-        attr_p = ctypes.pointer(attr)
-
-        ret = _syscall.bpf(_MapCmd.DELETE_ELEM, attr_p, ctypes.sizeof(attr))
-        if ret == 0:
+        if self._elem_op(_MapCmd.DELETE_ELEM, key) == 0:
             return
 
         eno = _syscall._get_errno()
@@ -304,11 +1110,60 @@ class BpfStackTraceMap(BpfMap):
             os.strerror(eno)))
 
 
+# perf_event_header, unpacked with struct rather than PerfEventHeader
+# because it's read for every record
+_perf_header = struct.Struct('=IHH')
+
+# A PERF_SAMPLE_RAW sample is a perf_event_header, a u32 size and the data
+_PERF_SAMPLE_DATA_OFFSET = _perf_header.size + ctypes.sizeof(ctypes.c_uint32)
+
+# A PERF_RECORD_LOST is a perf_event_header, a u64 id and a u64 count of
+# the records that didn't fit
+_PERF_LOST_COUNT_OFFSET = _perf_header.size + 8
+
+
+class PerfQueueStats:
+    '''Counters for a PerfQueue, kept up to date as it's drained.
+
+    records is how many samples have been read, and bytes how much of the
+    ring they and any other records took up. lost is how many samples the
+    kernel dropped because the ring was full, which it only reports once it
+    has room for another record. drains counts calls to
+    get_items or get_array, and wakeups the times waiting for samples
+    ended with some ready. fill is how many bytes of the ring, out of size,
+    were waiting to be read at the last drain, and max_fill the most there
+    have ever been.
+    '''
+    _counters = ['records', 'bytes', 'lost', 'drains', 'wakeups']
+
+    def __init__(self, size):
+        for name in self._counters:
+            setattr(self, name, 0)
+        self.fill = 0
+        self.max_fill = 0
+        self.size = size
+
+    def copy(self):
+        stats = PerfQueueStats(self.size)
+        stats.__dict__.update(self.__dict__)
+        return stats
+
+    def __str__(self):
+        return ('records={} bytes={} lost={} drains={} wakeups={} '
+                'fill={}/{} max_fill={}/{}'.format(
+                    self.records, self.bytes, self.lost, self.drains,
+                    self.wakeups, self.fill, self.size, self.max_fill,
+                    self.size))
+
+
 class PerfQueue:
     def __init__(self, data_type, cpu, num_pages=9):
         self.mm_fd = -1
+        self.mm = self.view = self.page = None
         self.data_type = data_type
         self.num_pages = num_pages
+        self.items = []
+        self.sample_dtype = None
 
         try:
             attr = pe.PerfEventAttr()
@@ -323,12 +1178,28 @@ class PerfQueue:
 
             fcntl.ioctl(self.mm_fd, pe.PERF_EVENT_IOC_ENABLE, 0)
             self.pagesz = resource.getpagesize()
+            self.data_size = (self.num_pages - 1) * self.pagesz
+            self.stats = PerfQueueStats(self.data_size)
             self.mm = mmap.mmap(self.mm_fd, self.num_pages * self.pagesz)
+            self.view = memoryview(self.mm)
+            self.page = pe.PerfEventMmapPage.from_buffer(self.mm)
+            # Samples that wrap around the end of the ring are put back
+            # together here
+            self.scratch = bytearray(
+                _PERF_SAMPLE_DATA_OFFSET + ctypes.sizeof(data_type))
         except Exception:
             self.close()
             raise
 
     def close(self):
+        # The mmap can't be closed while anything still points into it
+        self.page = None
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
         if self.mm_fd > 0:
             os.close(self.mm_fd)
             self.mm_fd = -1
@@ -342,59 +1213,179 @@ class PerfQueue:
             self.items.extend(self.get_items())
         return self.items.pop()
 
-    def get_items(self, timeout_ms=1000):
+    def _wait(self, timeout_ms):
         if timeout_ms != 0:
             p = select.poll()
             p.register(self.mm_fd, select.POLLIN)
-            p.poll(timeout_ms)
+            if len(p.poll(timeout_ms)) > 0:
+                self.stats.wakeups += 1
             p.unregister(self.mm_fd)
 
-        class Sample(ctypes.Structure):
-            _pack_ = 1
-            _fields_ = [
-                ('header', pe.PerfEventHeader),
-                ('size', ctypes.c_uint32),
-                ('data', self.data_type)
-            ]
-
-        items = []
-        page = pe.PerfEventMmapPage.from_buffer(self.mm)
-
-        data_size = (self.num_pages - 1) * self.pagesz
-        begin, end = page.data_tail % data_size, page.data_head % data_size
-
-        while begin != end:
-            data_left = data_size - begin
-
-            header = pe.PerfEventHeader.from_buffer_copy(
-                self.mm, begin + self.pagesz)
-
-            if header.type == pe.PERF_RECORD_SAMPLE:
-                if data_left < header.size:
-                    self.mm.seek(begin + self.pagesz)
-                    data = self.mm.read(data_left)
-                    self.mm.seek(self.pagesz)
-                    data += self.mm.read(header.size - data_left)
-                    self.mm.seek(0)
-                    s = Sample.from_buffer_copy(data)
+    def _start_drain(self):
+        '''Returns (tail, head), the part of the ring to read, and counts
+        the drain
+        '''
+        tail, head = self.page.data_tail, self.page.data_head
+        stats = self.stats
+        stats.drains += 1
+        stats.bytes += head - tail
+        stats.fill = head - tail
+        stats.max_fill = max(stats.max_fill, stats.fill)
+        return tail, head
+
+    def _samples(self, tail, head):
+        '''Yields (buf, offset) for the data of each sample from tail to
+        head, oldest first. buf is usually the mmap itself, but it's the
+        scratch buffer for samples that wrap around, so the data must be
+        copied out before moving on.
+        '''
+        view, pagesz, data_size = self.view, self.pagesz, self.data_size
+
+        while tail < head:
+            off = pagesz + tail % data_size
+            rec_type, _, size = _perf_header.unpack_from(view, off)
+
+            if rec_type == pe.PERF_RECORD_SAMPLE:
+                data_left = pagesz + data_size - off
+                if data_left < size:
+                    if len(self.scratch) < size:
+                        self.scratch = bytearray(size)
+                    scratch = self.scratch
+                    scratch[:data_left] = view[off:off + data_left]
+                    scratch[data_left:size] = \
+                        view[pagesz:pagesz + size - data_left]
+                    yield scratch, _PERF_SAMPLE_DATA_OFFSET
                 else:
-                    s = Sample.from_buffer_copy(self.mm, begin + self.pagesz)
-                items.append(s.data)
-            elif header.type == pe.PERF_RECORD_LOST:
-                print('lost')
+                    yield view, off + _PERF_SAMPLE_DATA_OFFSET
+            elif rec_type == pe.PERF_RECORD_LOST:
+                lost_off = tail + _PERF_LOST_COUNT_OFFSET
+                self.stats.lost += ctypes.c_uint64.from_buffer_copy(
+                    view, pagesz + lost_off % data_size).value
             else:
                 assert False
 
-            begin = (begin + header.size) % data_size
-
-        page.data_tail = page.data_head
+            tail += size
 
+    def get_items(self, timeout_ms=1000):
+        '''Returns a data_type for each sample in the ring, waiting up to
+        timeout_ms for there to be any
+        '''
+        self._wait(timeout_ms)
+        from_buffer_copy = self.data_type.from_buffer_copy
+        tail, head = self._start_drain()
+        items = [from_buffer_copy(buf, off)
+                 for buf, off in self._samples(tail, head)]
+        self.page.data_tail = head
+        self.stats.records += len(items)
         return items
 
+    def _get_sample_dtype(self):
+        '''The numpy dtype of a whole sample record holding one data_type,
+        padded to 8 bytes like the kernel pads them
+        '''
+        if self.sample_dtype is None:
+            self.sample_dtype = numpy.dtype({
+                'names': ['type', 'size', 'data'],
+                'formats': [numpy.uint32, numpy.uint16,
+                            _get_dtype(self.data_type)],
+                'offsets': [0, 6, _PERF_SAMPLE_DATA_OFFSET],
+                'itemsize': (_PERF_SAMPLE_DATA_OFFSET +
+                             ctypes.sizeof(self.data_type) + 7) & ~7,
+            })
+        return self.sample_dtype
+
+    def get_array(self, timeout_ms=1000):
+        '''Like get_items, but returns the samples as one contiguous numpy
+        array with a dtype mirroring data_type.
+
+        Runs of samples that are each exactly one data_type, which is what
+        perf_event_output of a data_type writes, are checked and copied out
+        of the ring a whole run at a time. Anything else goes a record at a
+        time.
+        '''
+        if numpy is None:
+            raise ImportError('get_array requires numpy')
+        self._wait(timeout_ms)
+
+        sample_dtype = self._get_sample_dtype()
+        rec_size = sample_dtype.itemsize
+        item_size = ctypes.sizeof(self.data_type)
+        pagesz, data_size = self.pagesz, self.data_size
+        tail, head = self._start_drain()
+
+        # No record is smaller than one of these samples or a
+        # PERF_RECORD_LOST (a header, an id and a count)
+        dtype, shape = _split_dtype(self.data_type)
+        max_items = (head - tail) // min(rec_size, _perf_header.size + 16)
+        out = numpy.empty((max_items,) + shape, dtype=dtype)
+        out_bytes = out.reshape(-1).view(numpy.uint8)
+
+        n = 0
+        while tail < head:
+            off = tail % data_size
+            count = min(head - tail, data_size - off) // rec_size
+            if count > 0:
+                recs = numpy.frombuffer(
+                    self.view, sample_dtype, count, pagesz + off)
+                odd = ((recs['type'] != pe.PERF_RECORD_SAMPLE) |
+                       (recs['size'] != rec_size))
+                if odd.any():
+                    count = int(odd.argmax())
+                out[n:n + count] = recs['data'][:count]
+                del recs
+                n += count
+                tail += count * rec_size
+                if count > 0:
+                    continue
+
+            # The next record wraps around the end of the ring or isn't one
+            # of our samples
+            _, _, size = _perf_header.unpack_from(self.view, pagesz + off)
+            for buf, data_off in self._samples(tail, tail + size):
+                out_bytes[n * item_size:(n + 1) * item_size] = \
+                    numpy.frombuffer(buf, numpy.uint8, item_size, data_off)
+                n += 1
+            tail += size
+
+        self.page.data_tail = head
+        self.stats.records += n
+        return out[:n]
+
+
+class BpfQueueStats:
+    '''The PerfQueueStats of each of a BpfQueue's cpus, in per_cpu'''
+    def __init__(self, per_cpu):
+        self.per_cpu = per_cpu
+
+    def snapshot(self):
+        '''A copy of the stats as they are now, which stays put as the
+        queue is drained further
+        '''
+        return BpfQueueStats(
+            {cpu: s.copy() for cpu, s in self.per_cpu.items()})
+
+    def total(self):
+        '''A PerfQueueStats with every cpu's counters added up. fill,
+        max_fill and size are those of the fullest cpu's ring.
+        '''
+        total = PerfQueueStats(0)
+        for s in self.per_cpu.values():
+            for name in PerfQueueStats._counters:
+                setattr(total, name, getattr(total, name) + getattr(s, name))
+            total.fill = max(total.fill, s.fill)
+            total.max_fill = max(total.max_fill, s.max_fill)
+            total.size = s.size
+        return total
+
+    def __str__(self):
+        return '\n'.join('cpu {}: {}'.format(cpu, s)
+                         for cpu, s in sorted(self.per_cpu.items()))
+
 
 class BpfQueue(FileDescriptorDatastructure):
     def __init__(self, data_type, num_pages=9):
         self.queues = {}
+        self.stats = BpfQueueStats({})
 
         self.fd = _map_create(
             BpfMapType.PERF_EVENT_ARRAY, 4, 4, multiprocessing.cpu_count())
@@ -403,6 +1394,7 @@ class BpfQueue(FileDescriptorDatastructure):
             q = PerfQueue(data_type, cpu, num_pages)
             _update_elem(self.fd, ctypes.c_int(cpu), ctypes.c_int(q.mm_fd))
             self.queues[cpu] = q
+            self.stats.per_cpu[cpu] = q.stats
 
 
     def close(self):
@@ -423,19 +1415,126 @@ class BpfQueue(FileDescriptorDatastructure):
             self.items.extend(self.get_items())
         return self.items.pop()
 
-    def get_items(self, timeout_ms=1000):
+    def _wait(self, timeout_ms):
+        if timeout_ms == 0:
+            return
         p = select.poll()
+        fd_to_queue = {}
         for cpu, q in self.queues.items():
             p.register(q.mm_fd, select.POLLIN)
-        p.poll(timeout_ms)
+            fd_to_queue[q.mm_fd] = q
+        for fd, _ in p.poll(timeout_ms):
+            fd_to_queue[fd].stats.wakeups += 1
         for cpu, q in self.queues.items():
             p.unregister(q.mm_fd)
 
+    def get_items(self, timeout_ms=1000):
+        self._wait(timeout_ms)
+
         items = []
         for cpu, q in self.queues.items():
             items.extend(q.get_items(timeout_ms=0))
 
         return items
 
+    def get_array(self, timeout_ms=1000):
+        '''Like get_items, but returns a numpy array, as from
+        PerfQueue.get_array, of every cpu's samples
+        '''
+        if numpy is None:
+            raise ImportError('get_array requires numpy')
+        self._wait(timeout_ms)
+        return numpy.concatenate([
+            q.get_array(timeout_ms=0) for cpu, q in self.queues.items()])
+
     def get_cpu_queue(self, cpu):
         return self.queues[cpu]
+
+
+# Bits in a ring buffer record's length
+_RINGBUF_BUSY = 1 << 31
+_RINGBUF_DISCARD = 1 << 30
+_RINGBUF_HDR_SIZE = 8
+
+
+class RingBufQueue(FileDescriptorDatastructure):
+    '''A ring buffer of data_type records (linux 5.8+). Unlike BpfQueue,
+    there's one buffer of num_pages pages (a power of 2) shared by all cpus,
+    so records come out in the order they were submitted.
+
+    In bpf, use funcs.ringbuf_output to copy a record in, or
+    funcs.ringbuf_reserve, fill in the record it points to, and
+    funcs.ringbuf_submit it, to write it in place.
+    '''
+    def __init__(self, data_type, num_pages=64):
+        if num_pages <= 0 or num_pages & (num_pages - 1) != 0:
+            raise ValueError('num_pages must be a power of 2')
+
+        self.fd = -1
+        self.data_type = data_type
+        self.pagesz = resource.getpagesize()
+        self.size = num_pages * self.pagesz
+        self.consumer_mm = self.producer_mm = self.epoll = None
+        self.items = collections.deque()
+
+        try:
+            self.fd = _map_create(BpfMapType.RINGBUF, 0, 0, self.size)
+            # The consumer position is ours to write. After the producer
+            # position comes the data, mapped twice in a row, so records
+            # that wrap around are still contiguous.
+            self.consumer_mm = mmap.mmap(self.fd, self.pagesz)
+            self.producer_mm = mmap.mmap(
+                self.fd, self.pagesz + 2 * self.size, prot=mmap.PROT_READ,
+                offset=self.pagesz)
+            self.consumer_pos = ctypes.c_uint64.from_buffer(self.consumer_mm)
+            self.epoll = select.epoll()
+            self.epoll.register(self.fd, select.EPOLLIN)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+            self.epoll = None
+        self.consumer_pos = None
+        for mm in [self.consumer_mm, self.producer_mm]:
+            if mm is not None:
+                mm.close()
+        self.consumer_mm = self.producer_mm = None
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self.items) == 0:
+            self.items.extend(self.get_items())
+        return self.items.popleft()
+
+    def get_items(self, timeout_ms=1000):
+        '''Returns all the records that have been submitted, oldest first,
+        waiting up to timeout_ms for there to be any
+        '''
+        if timeout_ms != 0:
+            self.epoll.poll(timeout_ms / 1000 if timeout_ms > 0 else -1)
+
+        mm, data_off, mask = self.producer_mm, self.pagesz, self.size - 1
+        cons = self.consumer_pos.value
+        prod = ctypes.c_uint64.from_buffer_copy(mm).value
+        items = []
+        while cons < prod:
+            off = data_off + (cons & mask)
+            length = ctypes.c_uint32.from_buffer_copy(mm, off).value
+            if length & _RINGBUF_BUSY:
+                # Reserved, but not submitted or discarded yet
+                break
+            if not length & _RINGBUF_DISCARD:
+                items.append(self.data_type.from_buffer_copy(
+                    mm, off + _RINGBUF_HDR_SIZE))
+            length &= ~(_RINGBUF_BUSY | _RINGBUF_DISCARD)
+            cons += (length + _RINGBUF_HDR_SIZE + 7) & ~7
+        self.consumer_pos.value = cons
+        return items
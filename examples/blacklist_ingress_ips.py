@@ -8,6 +8,8 @@
 
 import argparse
 import ctypes
+import ipaddress
+import os
 import resource
 import socket
 import sys
@@ -28,36 +30,84 @@ resource.setrlimit(
     (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
 
 
-def build_blacklist_maps(f):
-    # TODO figure out how big the map needs to be from the input file first
-    v4_blacklist = py2bpf.datastructures.create_map(
-        V4Addr, ctypes.c_uint8, 2 ** 10)
-    v6_blacklist = py2bpf.datastructures.create_map(
-        V6Addr, ctypes.c_uint8, 2 ** 10)
+# Blacklists are tries of prefixes, so a whole subnet takes a single entry
+V4Prefix = py2bpf.datastructures.create_lpm_key_type(V4Addr)
+V6Prefix = py2bpf.datastructures.create_lpm_key_type(V6Addr)
+
 
+def read_blacklist(f):
+    v4_prefixes, v6_prefixes = [], []
     for l in f:
-        ip = l.strip()
-        if ':' in ip:
-            v6_blacklist[V6Addr(*socket.inet_pton(socket.AF_INET6, ip))] = 1
+        net = ipaddress.ip_network(l.strip(), strict=False)
+        if net.version == 6:
+            v6_prefixes.append(V6Prefix(net))
         else:
-            v4_blacklist[V4Addr(*socket.inet_pton(socket.AF_INET, ip))] = 1
-
-    return v4_blacklist, v6_blacklist
+            v4_prefixes.append(V4Prefix(net))
+    return v4_prefixes, v6_prefixes
 
 
-def compile_filter(f):
-    v4_blacklist, v6_blacklist = build_blacklist_maps(f)
-
+def make_templates():
+    # TODO figure out how big the map needs to be from the input file first
+    return (
+        py2bpf.datastructures.create_lpm_trie(V4Addr, ctypes.c_uint8, 2 ** 10),
+        py2bpf.datastructures.create_lpm_trie(V6Addr, ctypes.c_uint8, 2 ** 10),
+    )
+
+
+# Each blacklist lives in slot 0 of an array of maps, so that loading a new
+# one swaps it in all at once, rather than the filter seeing it half done
+def create_blacklist_tables():
+    templates = make_templates()
+    tables = tuple(
+        py2bpf.datastructures.create_map_of_maps(
+            ctypes.c_uint32, t, 1,
+            map_type=py2bpf.datastructures.BpfMapType.ARRAY_OF_MAPS)
+        for t in templates)
+    for t in templates:
+        t.close()
+    return tables
+
+
+def open_blacklist_tables(pin_dir):
+    paths = [os.path.join(pin_dir, name)
+             for name in ['v4_blacklist', 'v6_blacklist']]
+    if not all(os.path.exists(p) for p in paths):
+        return None
+    templates = make_templates()
+    tables = tuple(
+        py2bpf.datastructures.BpfMapOfMaps.open_pinned(
+            p, ctypes.c_uint32, t)
+        for p, t in zip(paths, templates))
+    for t in templates:
+        t.close()
+    return tables
+
+
+def pin_blacklist_tables(pin_dir, v4_tables, v6_tables):
+    os.makedirs(pin_dir, exist_ok=True)
+    v4_tables.pin(os.path.join(pin_dir, 'v4_blacklist'))
+    v6_tables.pin(os.path.join(pin_dir, 'v6_blacklist'))
+
+
+def load_blacklists(v4_tables, v6_tables, v4_prefixes, v6_prefixes):
+    for tables, prefixes in [(v4_tables, v4_prefixes),
+                             (v6_tables, v6_prefixes)]:
+        # The table holds onto the new blacklist, and the old one goes away
+        # once nothing's using it
+        tables.replace(0, prefixes, [1] * len(prefixes)).close()
+
+
+def compile_filter(v4_tables, v6_tables):
     def drop_fn(skb):
-        nonlocal v4_blacklist, v6_blacklist
+        nonlocal v4_tables, v6_tables
         if skb.protocol == socket.htons(ETH_P_IPV6):
             v6_src_addr = V6Addr()
             py2bpf.funcs.skb_load_bytes(skb, 14 + 8, v6_src_addr, 16)
-            return v6_blacklist[v6_src_addr]
+            return v6_tables[0][v6_src_addr]
         elif skb.protocol == socket.htons(ETH_P_IP):
             v4_src_addr = V4Addr()
             py2bpf.funcs.skb_load_bytes(skb, 14 + 12, v4_src_addr, 4)
-            return v4_blacklist[v4_src_addr]
+            return v4_tables[0][v4_src_addr]
 
         return 0
 
@@ -66,28 +116,57 @@ def compile_filter(f):
 
 def main(argv):
     parser = argparse.ArgumentParser()
-    parser.add_argument('--blacklist-file', required=True,
-                        help='File of ips to blacklist.  "-" means stdin')
+    parser.add_argument('--blacklist-file',
+                        help='File of ips or subnets to blacklist.  "-" '
+                        'means stdin')
     parser.add_argument('--dev', required=True,
                         help='Device for which to insert ingress filter')
     parser.add_argument('--clear', action='store_true', default=False)
+    parser.add_argument('--pin-dir',
+                        help='Directory on a bpf filesystem to keep the '
+                        'blacklist in. If the filter installed it there, '
+                        'the new blacklist is swapped in under it rather '
+                        'than installing the filter again')
     args = parser.parse_args(argv[1:])
 
-    try:
-        py2bpf.tc.clear_ingress_filter(args.dev)
-    except Exception:
-        pass
-
     if args.clear:
+        try:
+            py2bpf.tc.clear_ingress_filter(args.dev)
+        except Exception:
+            pass
+        if args.pin_dir is not None:
+            for name in ['v4_blacklist', 'v6_blacklist']:
+                path = os.path.join(args.pin_dir, name)
+                if os.path.exists(path):
+                    os.unlink(path)
         return
+    elif args.blacklist_file is None:
+        parser.error('--blacklist-file is required')
 
     if args.blacklist_file == '-':
-        fn = compile_filter(sys.stdin)
+        v4_prefixes, v6_prefixes = read_blacklist(sys.stdin)
     else:
         with open(args.blacklist_file) as f:
-            fn = compile_filter(f)
+            v4_prefixes, v6_prefixes = read_blacklist(f)
+
+    tables = None
+    if args.pin_dir is not None:
+        tables = open_blacklist_tables(args.pin_dir)
+    if tables is not None:
+        load_blacklists(*tables, v4_prefixes, v6_prefixes)
+        return
+
+    try:
+        py2bpf.tc.clear_ingress_filter(args.dev)
+    except Exception:
+        pass
+
+    tables = create_blacklist_tables()
+    load_blacklists(*tables, v4_prefixes, v6_prefixes)
+    if args.pin_dir is not None:
+        pin_blacklist_tables(args.pin_dir, *tables)
 
-    fil = py2bpf.tc.IngressFilter(fn)
+    fil = py2bpf.tc.IngressFilter(compile_filter(*tables))
     fil.install(args.dev)
     fil.close()
 
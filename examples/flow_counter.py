@@ -37,7 +37,12 @@ resource.setrlimit(
     resource.RLIMIT_MEMLOCK,
     (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
 
-flow_counts = py2bpf.datastructures.create_map(Flow, ctypes.c_ulong, 256)
+# Per-cpu, so that cpus counting the same flow don't fight over its counter,
+# and LRU, so that once it's full new flows push out the quietest ones rather
+# than being dropped
+flow_counts = py2bpf.datastructures.create_map(
+    Flow, ctypes.c_ulong, 256,
+    map_type=py2bpf.datastructures.BpfMapType.LRU_PERCPU_HASH)
 
 
 def add_flow_to_map(skb):
@@ -75,16 +80,17 @@ def ips(x):
 
 
 for k, v in flow_counts.items():
+    count = sum(c.value for c in v)
     if k.l4_protocol == socket.IPPROTO_TCP:
         print('TCP: {}:{} => {}:{} :: {}'.format(
-            ips(k.src), k.src_port, ips(k.dst), k.dst_port, v.value))
+            ips(k.src), k.src_port, ips(k.dst), k.dst_port, count))
     elif k.l4_protocol == socket.IPPROTO_UDP:
         print('UDP: {}:{} => {}:{} :: {}'.format(
-            ips(k.src), k.src_port, ips(k.dst), k.dst_port, v.value))
+            ips(k.src), k.src_port, ips(k.dst), k.dst_port, count))
     elif k.l4_protocol == socket.IPPROTO_ICMP:
-        print('ICMP: {} => {} :: {}'.format(ips(k.src), ips(k.dst), v.value))
+        print('ICMP: {} => {} :: {}'.format(ips(k.src), ips(k.dst), count))
     else:
         print('proto({}): {} => {} :: {}'.format(
-            k.l4_protocol, ips(k.src), ips(k.dst), v.value))
+            k.l4_protocol, ips(k.src), ips(k.dst), count))
 
 flow_counts.close()
@@ -14,3 +14,9 @@ class TranslationError(Exception):
 
     def __str__(self):
         return 'Line {}: {}'.format(self.line, self.msg)
+
+
+class ComplexityWarning(UserWarning):
+    '''The verifier will likely reject a program for being too big or too
+    complex. See _bpf/_complexity.py.
+    '''
@@ -62,6 +62,12 @@ get_stackid = Func('get_stackid', 27, 3)
 
 probe_read_str = Func('probe_read_str', 45, 2, fill_array_size_args=[0])
 
+# For RingBufQueues (linux 5.8+). flags are BPF_RB_NO_WAKEUP (1) or
+# BPF_RB_FORCE_WAKEUP (2) to override when the consumer is woken up, or 0.
+ringbuf_output = Func('ringbuf_output', 130, 3, fill_array_size_args=[1])
+ringbuf_submit = Func('ringbuf_submit', 132, 2)
+ringbuf_discard = Func('ringbuf_discard', 133, 2)
+
 addrof = PseudoFunc('addrof', 1)
 memcpy = PseudoFunc('memcpy', 3)
 packet_copy = PseudoFunc('packet_copy', 4)
@@ -72,6 +78,11 @@ load_skb_word = PseudoFunc('load_skb_word', 2)
 
 mem_eq = PseudoFunc('mem_eq', 2)
 
+# Reserve room for one of a RingBufQueue's data_type, returning a pointer to
+# it, or 0 if the queue is full. Anything reserved has to be handed to
+# ringbuf_submit or ringbuf_discard before returning.
+ringbuf_reserve = PseudoFunc('ringbuf_reserve', 1)
+
 deref_u8 = PseudoFunc('deref', 1, ctypes.c_uint8)
 deref_u16 = PseudoFunc('deref', 1, ctypes.c_uint16)
 deref_u32 = PseudoFunc('deref', 1, ctypes.c_uint32)
@@ -8,12 +8,19 @@
 
 import ctypes
 import enum
+import errno
+import multiprocessing
 import os
 import re
 import sys
+import time
+import warnings
 
+from py2bpf._translation import _cache
 from py2bpf._translation._translate import convert_to_register_ops
-from py2bpf._bpf import _instructions, _syscall, _template_jit
+from py2bpf._bpf import (
+    _complexity, _instructions, _obj, _peephole, _syscall, _template_jit)
+from py2bpf.exception import ComplexityWarning
 
 
 class BpfCmd(enum.IntEnum):
@@ -34,48 +41,97 @@ class BpfAttrLoadProg(ctypes.Structure):
     ]
 
 
+class BpfProgInfo(ctypes.Structure):
+    '''The start of bpf_prog_info, which is all we need'''
+    _fields_ = [
+        ('type', ctypes.c_uint),
+        ('id', ctypes.c_uint),
+        ('tag', ctypes.c_uint8 * 8),
+    ]
+
+
 def _get_kern_version():
     m = re.match(r'(\d+)\.(\d+)\.(\d+).*', os.uname()[2])
     return (int(m.group(1)) << 16) + (int(m.group(2)) << 8) + int(m.group(3))
 
 
-def _load_prog(prog_type, insns_arr, insns_to_info):
-    log = ctypes.create_string_buffer(2 ** 20)
+# The kernel rejects log buffers bigger than this, at least on older kernels
+_MAX_LOG_SIZE = (2 ** 32 - 1) >> 8
+
+
+def _get_log_options(log_level, log_size):
+    if log_level is None:
+        log_level = int(os.environ.get('PY2BPF_LOG_LEVEL', 1))
+    if log_size is None:
+        log_size = int(os.environ.get('PY2BPF_LOG_SIZE', 2 ** 16))
+    return log_level, min(log_size, _MAX_LOG_SIZE)
+
+
+def _try_load_prog(prog_type, insns_arr, log_level, log_size):
+    '''Returns (fd, errno, log). fd is negative if loading failed'''
+    log = None
+    if log_level > 0:
+        log = ctypes.create_string_buffer(log_size)
 
     attr = BpfAttrLoadProg(
         prog_type=prog_type,
         insn_cnt=len(insns_arr),
         insns=ctypes.cast(ctypes.byref(insns_arr), ctypes.c_char_p),
         license=ctypes.c_char_p('GPL'.encode()),
-        log_level=100,
-        log_size=ctypes.sizeof(log),
-        log_buf=ctypes.addressof(log),
+        log_level=log_level,
+        log_size=ctypes.sizeof(log) if log is not None else 0,
+        log_buf=ctypes.addressof(log) if log is not None else None,
         kern_version=_get_kern_version(),
     )
 
     fd = _syscall.bpf(
         BpfCmd.PROG_LOAD, ctypes.pointer(attr), ctypes.sizeof(attr))
-    if fd < 0:
-        eno = _syscall._get_errno()
-
-        last_num = None
-        for l in log.value.decode().splitlines():
-            m = re.match('^(\d+): .*', l)
-            if m is not None:
-                num = int(m.group(1))
-                if last_num != num and num in insns_to_info:
-                    last_num = num
-                    if num > 0:
-                        print(file=sys.stderr)
-                    print(insns_to_info[num], file=sys.stderr)
-            print('', l, file=sys.stderr)
-
-        print(file=sys.stderr)
+    eno = _syscall._get_errno() if fd < 0 else 0
+    return fd, eno, log.value.decode() if log is not None else ''
+
+
+def _print_log(log, insns_to_info):
+    last_num = None
+    for l in log.splitlines():
+        m = re.match('^(\d+): .*', l)
+        if m is not None:
+            num = int(m.group(1))
+            if last_num != num and num in insns_to_info:
+                last_num = num
+                if num > 0:
+                    print(file=sys.stderr)
+                print(insns_to_info[num], file=sys.stderr)
+        print('', l, file=sys.stderr)
+
+    print(file=sys.stderr)
+
 
+def _load_prog(prog_type, insns_arr, insns_to_info, log_level=None,
+               log_size=None):
+    '''Load the program, returning its fd and the verifier log, if any.
+
+    Having the verifier log every load is slow, so we first load without a
+    log. Only if that fails do we load again with a log at log_level (or
+    PY2BPF_LOG_LEVEL, default 1) to explain why, starting with log_size
+    bytes (or PY2BPF_LOG_SIZE, default 64KiB) and growing it for as long as
+    the kernel says it's too small. A log_level of 0 never logs.
+    '''
+    log_level, log_size = _get_log_options(log_level, log_size)
+
+    fd, eno, log = _try_load_prog(prog_type, insns_arr, 0, 0)
+    while fd < 0 and log_level > 0:
+        fd, eno, log = _try_load_prog(
+            prog_type, insns_arr, log_level, log_size)
+        if eno != errno.ENOSPC or log_size >= _MAX_LOG_SIZE:
+            break
+        log_size = min(log_size * 4, _MAX_LOG_SIZE)
+
+    if fd < 0:
+        _print_log(log, insns_to_info)
         raise OSError(eno, 'Failed to load bpf prog: {}'.format(
             os.strerror(eno)))
 
-    return fd, log.value.decode()
+    return fd, log
 
 
 class ProgType(enum.IntEnum):
@@ -87,23 +143,214 @@ class ProgType(enum.IntEnum):
 
 
 class Prog:
-    def __init__(self, prog_type, bpf_insns, insns_to_info):
+    '''A loaded program. pretty holds the verifier log, which is only
+    collected when the first attempt to load fails, and load_time is how
+    many seconds loading took.
+    '''
+    def __init__(self, prog_type, bpf_insns, insns_to_info, raw_insns=None,
+                 log_level=None, log_size=None):
         self.prog_type = prog_type
         self.bpf_insns = bpf_insns
-        raw_insns = _instructions.convert_to_raw_instructions(bpf_insns)
+        if raw_insns is None:
+            raw_insns = _instructions.convert_to_raw_instructions(bpf_insns)
+        self.raw_insns = raw_insns
+        start = time.monotonic()
         self.fd, self.pretty = _load_prog(
-            self.prog_type, raw_insns, insns_to_info)
+            self.prog_type, raw_insns, insns_to_info, log_level, log_size)
+        self.load_time = time.monotonic() - start
 
     def close(self):
         os.close(self.fd)
         self.fd = -1
 
+    def pin(self, path):
+        '''Pin the program at path on a bpf filesystem, so that it outlives
+        this process. See open_pinned.
+        '''
+        _obj.pin(self.fd, path)
 
-def create_prog(prog_type, ctx_type, fn):
-    reg_insns, stack = convert_to_register_ops(fn, ctx_type)
+    @classmethod
+    def open_pinned(cls, path, prog_type=None):
+        '''Open the program pinned at path. There are no instructions to go
+        with it, just the fd. Raises ValueError if prog_type is given and
+        it's a different type of program.
+        '''
+        fd = _obj.get_pinned(path)
+        try:
+            info = _obj.get_info(fd, BpfProgInfo)
+            if prog_type is not None and info.type != prog_type:
+                raise ValueError('{} is a prog of type {}, not {}'.format(
+                    path, info.type, int(prog_type)))
+        except Exception:
+            os.close(fd)
+            raise
+
+        p = cls.__new__(cls)
+        try:
+            p.prog_type = ProgType(info.type)
+        except ValueError:
+            p.prog_type = info.type
+        p.bpf_insns = None
+        p.raw_insns = None
+        p.fd = fd
+        p.pretty = ''
+        p.load_time = 0
+        return p
 
-    verbose = 'PY2BPF_VERBOSE' in os.environ
 
+def _translate(ctx_type, fn, verbose, peephole_rules):
+    reg_insns, stack = convert_to_register_ops(fn, ctx_type)
     bpf_insns, insns_to_info = _template_jit.translate(
         reg_insns, stack=stack, verbose=verbose)
-    return Prog(prog_type, bpf_insns, insns_to_info)
+    bpf_insns, insns_to_info, _ = _peephole.optimize(
+        bpf_insns, insns_to_info, rules=peephole_rules, verbose=verbose)
+
+    report = _complexity.analyze(
+        bpf_insns, insns_to_info, _get_kern_version())
+    if verbose:
+        print(report)
+    for w in report.warnings:
+        warnings.warn('{}: {}'.format(fn.__name__, w), ComplexityWarning)
+
+    return bpf_insns, insns_to_info
+
+
+def create_prog(prog_type, ctx_type, fn, cache_dir=None, log_level=None,
+                log_size=None):
+    '''Compile fn and load it as a bpf program.
+
+    If cache_dir is given (or PY2BPF_CACHE_DIR is set), compiled programs
+    are stored there and reused for as long as fn, the values of the globals
+    and closure variables it references, and ctx_type are unchanged.
+
+    log_level and log_size control the verifier log collected if loading
+    fails. See _load_prog.
+    '''
+    verbose = 'PY2BPF_VERBOSE' in os.environ
+    peephole_rules = _peephole.get_enabled_rules()
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('PY2BPF_CACHE_DIR')
+
+    key = None
+    if cache_dir is not None:
+        key, datastructures = _cache.get_key(
+            prog_type, ctx_type, fn, options=tuple(peephole_rules))
+
+    if key is not None:
+        compiled = _cache.load(cache_dir, key)
+        if compiled is not None:
+            if verbose:
+                print('Using cached translation {}'.format(key))
+            raw_insns = compiled.to_raw_instructions(datastructures)
+            return Prog(prog_type, None, compiled.insns_to_info,
+                        raw_insns=raw_insns, log_level=log_level,
+                        log_size=log_size)
+
+    bpf_insns, insns_to_info = _translate(
+        ctx_type, fn, verbose, peephole_rules)
+    p = Prog(prog_type, bpf_insns, insns_to_info, log_level=log_level,
+             log_size=log_size)
+
+    # Only cache programs that made it past the verifier
+    if key is not None:
+        _cache.store(
+            cache_dir, key, p.raw_insns, insns_to_info, datastructures)
+
+    return p
+
+
+# What compile_many's workers compile. They're forked, so they inherit this
+# rather than having to pickle functions and closures.
+_compile_many_jobs = None
+
+
+def _compile_job(idx):
+    ctx_type, fn, datastructures, verbose, peephole_rules = \
+        _compile_many_jobs[idx]
+    try:
+        bpf_insns, insns_to_info = _translate(
+            ctx_type, fn, verbose, peephole_rules)
+    except Exception:
+        # Errors don't reliably survive pickling, so compile_many translates
+        # these again itself to raise them
+        return None
+    raw_insns = _instructions.convert_to_raw_instructions(bpf_insns)
+    # Forked workers share our fds, so any we don't know how to relocate are
+    # right as they are
+    return _cache.from_raw_instructions(
+        raw_insns, insns_to_info, datastructures, strict=False)
+
+
+def compile_many(progs, processes=None, cache_dir=None, log_level=None,
+                 log_size=None):
+    '''Compile and load many programs at once. progs is a list of
+    (prog_type, ctx_type, fn), and the Progs come back in the same order.
+
+    Translation runs in a pool of processes processes (by default, one per
+    cpu), which send back raw instructions with relocations for the map fds
+    they reference. Loading happens here, one program at a time. cache_dir,
+    log_level and log_size are as for create_prog.
+    '''
+    global _compile_many_jobs
+
+    verbose = 'PY2BPF_VERBOSE' in os.environ
+    peephole_rules = _peephole.get_enabled_rules()
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('PY2BPF_CACHE_DIR')
+
+    keys, jobs, compiled = [], [], []
+    for prog_type, ctx_type, fn in progs:
+        key, datastructures = _cache.get_key(
+            prog_type, ctx_type, fn, options=tuple(peephole_rules))
+        if cache_dir is None:
+            key = None
+        keys.append(key)
+        jobs.append((ctx_type, fn, datastructures, verbose, peephole_rules))
+        compiled.append(
+            _cache.load(cache_dir, key) if key is not None else None)
+
+    todo = [idx for idx, c in enumerate(compiled) if c is None]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(todo))
+
+    _compile_many_jobs = jobs
+    try:
+        if processes > 1:
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(processes) as pool:
+                results = pool.map(_compile_job, todo, chunksize=1)
+        else:
+            results = [_compile_job(idx) for idx in todo]
+    finally:
+        _compile_many_jobs = None
+    for idx, c in zip(todo, results):
+        compiled[idx] = c
+
+    ret = []
+    try:
+        for idx, (prog_type, ctx_type, fn) in enumerate(progs):
+            if compiled[idx] is None:
+                ret.append(create_prog(
+                    prog_type, ctx_type, fn, cache_dir=cache_dir,
+                    log_level=log_level, log_size=log_size))
+                continue
+
+            datastructures = jobs[idx][2]
+            p = Prog(prog_type, None, compiled[idx].insns_to_info,
+                     raw_insns=compiled[idx].to_raw_instructions(
+                         datastructures),
+                     log_level=log_level, log_size=log_size)
+            ret.append(p)
+
+            if keys[idx] is not None and idx in todo:
+                _cache.store(cache_dir, keys[idx], p.raw_insns,
+                             compiled[idx].insns_to_info, datastructures)
+    except Exception:
+        for p in ret:
+            p.close()
+        raise
+
+    return ret
@@ -27,6 +27,9 @@ setup(
         'py2bpf._bpf': '_bpf',
         'py2bpf._translation': '_translation',
     },
+    extras_require={
+        'numpy': ['numpy'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
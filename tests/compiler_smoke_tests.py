@@ -6,9 +6,23 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
+import contextlib
+import ctypes
+import io
+import os
+import socket
+import tempfile
 import unittest
+import py2bpf.datastructures
+import py2bpf.exception
+import py2bpf.funcs
 import py2bpf.prog
 import py2bpf.socket_filter
+import py2bpf.util
+from py2bpf._bpf import (
+    _complexity, _instructions as bi, _peephole, _template_jit)
+from py2bpf._translation import _cache, _labels, _regs
+from py2bpf._translation._translate import convert_to_register_ops
 
 
 def compile_socket_filter(fn):
@@ -96,5 +110,664 @@ class MathSmokeTest(unittest.TestCase):
         compile_socket_filter(fn)
 
 
+class BranchSmokeTest(unittest.TestCase):
+    def test_many_sequential_branches(self):
+        # Each if doubles the number of execution paths, so this only
+        # finishes if we aren't enumerating them.
+        src = ['def fn(ctx):', '    x = 0']
+        for n in range(300):
+            src.append('    if ctx.len == {}:'.format(n))
+            src.append('        x = {}'.format(n))
+        src.append('    return x')
+        namespace = {}
+        exec('\n'.join(src), namespace)
+
+        vis, stack = convert_to_register_ops(
+            namespace['fn'], py2bpf.socket_filter.SkBuffContext)
+        labels = [vi for vi in vis if isinstance(vi, _labels.Label)]
+        self.assertEqual(len(labels), 300)
+
+        # Every comparison gets its own temporaries, which would need far
+        # more than the 512 bytes of stack bpf allows if we didn't reuse
+        # their space.
+        self.assertLessEqual(stack.max_neg_stack_off, 64)
+        compile_socket_filter(namespace['fn'])
+
+    def test_const_branches_pruned(self):
+        def make_fn(debug):
+            def fn(ctx):
+                if debug:
+                    return py2bpf.funcs.get_smp_processor_id()
+                return ctx.len
+            return fn
+
+        for debug in [False, True]:
+            vis, stack = convert_to_register_ops(
+                make_fn(debug), py2bpf.socket_filter.SkBuffContext)
+            opnames = [vi.opname for vi in vis
+                       if not isinstance(vi, _labels.Label)]
+            self.assertNotIn('POP_JUMP_IF_FALSE', opnames)
+            self.assertEqual('CALL_FUNCTION' in opnames, debug)
+            compile_socket_filter(make_fn(debug))
+
+
+class CompareSmokeTest(unittest.TestCase):
+    def test_compare_jumps_fused(self):
+        def fn(ctx):
+            if ctx.protocol == 8 and ctx.len > 20:
+                return 1
+            return 0
+
+        vis, stack = convert_to_register_ops(
+            fn, py2bpf.socket_filter.SkBuffContext)
+        vis = [vi for vi in vis if not isinstance(vi, _labels.Label)]
+        self.assertNotIn('COMPARE_OP', [vi.opname for vi in vis])
+        jumps = [vi for vi in vis if vi.opname == 'POP_JUMP_IF_FALSE']
+        self.assertEqual([j.compare_op for j in jumps], ['==', '>'])
+        compile_socket_filter(fn)
+
+    def test_and_or_values(self):
+        def fn(ctx):
+            x = ctx.len > 10 and ctx.len < 1000
+            y = ctx.len < 10 or x
+            return y
+
+        compile_socket_filter(fn)
+
+    def test_chained_compare(self):
+        def fn(ctx):
+            if 10 < ctx.len <= 1500:
+                return 1
+            return 0
+
+        compile_socket_filter(fn)
+
+
+class FoldingSmokeTest(unittest.TestCase):
+    def test_offsets_folded(self):
+        eth_len = 14
+
+        def fn(ctx):
+            off = eth_len
+            off += 12
+            flags = (1 << 4) | 0x3
+            if off > 20 and flags & 0x10:
+                return py2bpf.funcs.load_skb_short(ctx, off)
+            return 0
+
+        vis, stack = convert_to_register_ops(
+            fn, py2bpf.socket_filter.SkBuffContext)
+        opnames = [vi.opname for vi in vis
+                   if not isinstance(vi, _labels.Label)]
+        for opname in ['COMPARE_OP', 'POP_JUMP_IF_FALSE', 'INPLACE_ADD',
+                       'BINARY_LSHIFT', 'BINARY_OR', 'BINARY_AND']:
+            self.assertNotIn(opname, opnames)
+        call = [vi for vi in vis if vi.opname == 'CALL_FUNCTION'][0]
+        self.assertEqual(call.src_vars[2].val.value, 26)
+        compile_socket_filter(fn)
+
+    def test_inplace_ops(self):
+        def fn(ctx):
+            x = ctx.len - 1
+            x *= 3
+            x //= 2
+            x &= 0xff
+            x |= 0x100
+            x <<= 2
+            x >>= 1
+            return x
+
+        compile_socket_filter(fn)
+
+    def test_no_folding_past_u64(self):
+        # bpf wraps these around at 64 bits, so they're left to it
+        def fn(ctx):
+            a = 1 << 63
+            b = a + a
+            c = 1 << 40
+            if b == 0:
+                return c << 30 >> 40
+            return 1
+
+        vis, stack = convert_to_register_ops(
+            fn, py2bpf.socket_filter.SkBuffContext)
+        opnames = [vi.opname for vi in vis
+                   if not isinstance(vi, _labels.Label)]
+        for opname in ['BINARY_ADD', 'POP_JUMP_IF_FALSE', 'BINARY_LSHIFT']:
+            self.assertIn(opname, opnames)
+        compile_socket_filter(fn)
+
+
+class RegisterSmokeTest(unittest.TestCase):
+    def test_vars_in_registers(self):
+        def fn(ctx):
+            a = ctx.len
+            b = ctx.protocol
+            return a + b + a
+
+        vis, stack = convert_to_register_ops(
+            fn, py2bpf.socket_filter.SkBuffContext)
+        self.assertEqual(stack.max_neg_stack_off, 0)
+        compile_socket_filter(fn)
+
+    def test_live_across_call(self):
+        def fn(ctx):
+            a = ctx.len
+            py2bpf.funcs.get_smp_processor_id()
+            return a
+
+        vis, stack = convert_to_register_ops(
+            fn, py2bpf.socket_filter.SkBuffContext)
+        dv = vis[0].dst_vars[0]
+        self.assertIsInstance(dv, _regs.RegVar)
+        self.assertIn(dv.reg, [bi.Reg.R7, bi.Reg.R8, bi.Reg.R9])
+        compile_socket_filter(fn)
+
+
+class PeepholeSmokeTest(unittest.TestCase):
+    def test_store_reload(self):
+        insns = [
+            bi.Mov(bi.Mem(bi.Reg.R6, 0, bi.Size.Word), bi.Reg.R0),
+            bi.Mov(bi.Reg.R0, bi.Mem(bi.Reg.RSP, -4, bi.Size.Word)),
+            bi.Mov(bi.Mem(bi.Reg.RSP, -4, bi.Size.Word), bi.Reg.R0),
+            bi.Ret(),
+        ]
+        new_insns, insns_to_info, hits = _peephole.optimize(
+            insns, {2: 'reload'})
+        self.assertEqual(len(new_insns), 3)
+        self.assertEqual(hits['store_reload'], 1)
+        self.assertEqual(hits['self_move'], 1)
+        self.assertEqual(insns_to_info, {2: 'reload'})
+
+    def test_const_cond(self):
+        insns = [
+            bi.Mov(bi.Imm(1), bi.Reg.R0),
+            bi.JumpIfEqual(bi.Imm(0), bi.Reg.R0, 'false'),
+            bi.Ret(),
+            bi.Label('false'),
+            bi.Mov(bi.Imm(2), bi.Reg.R0),
+            bi.Ret(),
+        ]
+        new_insns, _, _ = _peephole.optimize(insns, {})
+        self.assertEqual(len(new_insns), 2)
+
+        # No rules, no changes
+        new_insns, _, _ = _peephole.optimize(insns, {}, rules=[])
+        self.assertEqual(len(new_insns), len(insns))
+
+
+class ComplexitySmokeTest(unittest.TestCase):
+    def _diamonds(self, num):
+        insns = [bi.Mov(bi.Reg.R1, bi.Reg.R6)]
+        for n in range(num):
+            insns += [
+                bi.JumpIfEqual(bi.Imm(n), bi.Reg.R6, 'else{}'.format(n)),
+                bi.Call(bi.Imm(1)),
+                bi.Jump('end{}'.format(n)),
+                bi.Label('else{}'.format(n)),
+                bi.Mov(bi.Imm(n), bi.Mem(bi.Reg.RSP, -8 * (n + 1),
+                                         bi.Size.Quad)),
+                bi.Label('end{}'.format(n)),
+            ]
+        return insns + [bi.Mov(bi.Imm(0), bi.Reg.R0), bi.Ret()]
+
+    def test_analyze(self):
+        insns = self._diamonds(3)
+        report = _complexity.analyze(insns, {1: 'first', 7: 'second'},
+                                     py2bpf.prog._get_kern_version())
+        self.assertEqual(report.num_insns, 15)
+        self.assertEqual(report.num_paths, 8)
+        self.assertEqual(report.max_calls, 3)
+        self.assertEqual(report.stack_depth, 24)
+        self.assertEqual(report.hot_spots[0][0], 'second')
+        self.assertEqual(report.warnings, [])
+
+    def test_old_kernel_limits(self):
+        # 4.9 only takes 4096 instructions, can't prune these paths and
+        # these diamonds also use too much stack
+        report = _complexity.analyze(
+            self._diamonds(1500), {}, (4 << 16) + (9 << 8))
+        self.assertEqual(len(report.warnings), 3)
+
+
+class MemorySmokeTest(unittest.TestCase):
+    def test_chunks(self):
+        self.assertEqual(_template_jit._get_chunks(13, 8), [
+            (0, 8, bi.Size.Quad),
+            (8, 4, bi.Size.Word),
+            (12, 1, bi.Size.Byte),
+        ])
+        # Starting 2 bytes past an 8 byte boundary
+        self.assertEqual(_template_jit._get_chunks(8, 8, -6), [
+            (0, 2, bi.Size.Short),
+            (2, 4, bi.Size.Word),
+            (6, 2, bi.Size.Short),
+        ])
+        self.assertEqual(len(_template_jit._get_chunks(128, 2)), 64)
+
+    def test_mem_eq(self):
+        arr_type = ctypes.c_uint8 * 13
+        expected = arr_type(*range(13))
+
+        def fn(ctx):
+            buf = arr_type()
+            py2bpf.funcs.skb_load_bytes(ctx, 14, buf, 13)
+            if py2bpf.funcs.mem_eq(expected, buf):
+                return 1
+            return 0
+
+        compile_socket_filter(fn)
+
+    def test_memcpy(self):
+        class Value(ctypes.Structure):
+            _fields_ = [
+                ('start', ctypes.c_uint64),
+                ('family', ctypes.c_uint16),
+                ('addr', ctypes.c_uint8 * 128),
+            ]
+
+        m = py2bpf.datastructures.create_map(ctypes.c_uint32, Value, 4)
+
+        def fn(ctx):
+            v = m[0]
+            if not v:
+                return 0
+            copy = Value()
+            py2bpf.funcs.memcpy(v.addr, copy.addr, 128)
+            copy.start = 0x1122334455667788
+            m[1] = copy
+            return 1
+
+        compile_socket_filter(fn)
+        m.close()
+
+
+class MapSmokeTest(unittest.TestCase):
+    def test_map_types(self):
+        T = py2bpf.datastructures.BpfMapType
+        maps = [
+            py2bpf.datastructures.create_map(
+                ctypes.c_uint32, ctypes.c_uint64, 4, map_type=map_type)
+            for map_type in [T.HASH, T.ARRAY, T.PERCPU_HASH, T.PERCPU_ARRAY,
+                             T.LRU_HASH, T.LRU_PERCPU_HASH]
+        ] + [py2bpf.datastructures.create_mmap_array(ctypes.c_uint64, 4)]
+
+        for m in maps:
+            def fn(ctx):
+                m[ctx.pkt_type] += ctx.len
+                return m[3]
+
+            compile_socket_filter(fn)
+            m.close()
+
+    def test_map_of_maps(self):
+        T = py2bpf.datastructures.BpfMapType
+        template = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint64, 4)
+        for map_type in [T.ARRAY_OF_MAPS, T.HASH_OF_MAPS]:
+            m = py2bpf.datastructures.create_map_of_maps(
+                ctypes.c_uint32, template, 2, map_type=map_type)
+
+            def fn(ctx):
+                m[1][ctx.pkt_type] += ctx.len
+                del m[0][ctx.pkt_type]
+                return m[0][3]
+
+            compile_socket_filter(fn)
+            m.close()
+        template.close()
+
+    def test_lpm_trie(self):
+        V6Addr = ctypes.c_uint8 * 16
+        V6Prefix = py2bpf.datastructures.create_lpm_key_type(V6Addr)
+        t = py2bpf.datastructures.create_lpm_trie(V6Addr, ctypes.c_uint32, 4)
+
+        def fn(ctx):
+            addr = V6Addr()
+            py2bpf.funcs.skb_load_bytes(ctx, 8, addr, 16)
+            key = V6Prefix()
+            key.prefixlen = 64
+            py2bpf.funcs.skb_load_bytes(ctx, 24, key.data, 16)
+            del t[addr]
+            return t[addr] + t[key]
+
+        compile_socket_filter(fn)
+
+        def fn(ctx):
+            key = V6Prefix()
+            key.data[0] = 10
+            return t[key]
+
+        with self.assertRaises(py2bpf.exception.TranslationError):
+            compile_socket_filter(fn)
+        t.close()
+
+    def test_array_key(self):
+        Addr = ctypes.c_uint8 * 4
+        m = py2bpf.datastructures.create_map(Addr, ctypes.c_uint32, 4)
+
+        def fn(ctx):
+            addr = Addr()
+            py2bpf.funcs.skb_load_bytes(ctx, 16, addr, 4)
+            del m[addr]
+            return 0
+
+        compile_socket_filter(fn)
+        m.close()
+
+
+class PerfQueueSmokeTest(unittest.TestCase):
+    class Event(ctypes.Structure):
+        _fields_ = [
+            ('seq', ctypes.c_uint32),
+            ('pad', ctypes.c_uint8 * 17),
+        ]
+
+    def setUp(self):
+        # Samples, and reports of lost ones, go to the ring of the cpu the
+        # packet is handled on, so keep them all on one
+        self.cpus = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, [min(self.cpus)])
+
+        # Events are 24 bytes, so samples of them, with their 12 byte
+        # header, take 40 bytes of ring. That doesn't divide the one page
+        # ring, so some of them wrap around its end.
+        Event = self.Event
+        self.q = q = py2bpf.datastructures.BpfQueue(Event, num_pages=2)
+        self.counter = counter = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint32, 1,
+            map_type=py2bpf.datastructures.BpfMapType.ARRAY)
+
+        def fn(skb):
+            ev = Event()
+            counter[0] += 1
+            ev.seq = counter[0]
+            cpu = py2bpf.funcs.get_smp_processor_id()
+            py2bpf.funcs.perf_event_output(skb, q, cpu, ev)
+            return 0
+
+        self.p = py2bpf.prog.create_prog(
+            py2bpf.prog.ProgType.SOCKET_FILTER,
+            py2bpf.socket_filter.SkBuffContext, fn)
+        self.raw = socket.socket(
+            socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
+        self.raw.setsockopt(socket.SOL_SOCKET, 50, self.p.fd)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.udp.close()
+        self.raw.close()
+        self.p.close()
+        self.counter.close()
+        self.q.close()
+        os.sched_setaffinity(0, self.cpus)
+
+    def send(self, n):
+        for _ in range(n):
+            self.udp.sendto(b'x', ('127.0.0.1', 9))
+
+    def check_events(self, drain):
+        seqs = []
+        for _ in range(10):
+            self.send(37)
+            seqs.extend(drain(self.q))
+        self.assertEqual(sorted(seqs), list(range(1, 371)))
+
+        stats = self.q.stats.total()
+        self.assertEqual(stats.records, 370)
+        self.assertEqual(stats.bytes, 370 * 40)
+        self.assertEqual(stats.lost, 0)
+        self.assertEqual(stats.drains, 10 * len(self.q.queues))
+
+        # Nothing was lost, so records sat back to back from the start of
+        # the ring, and the one across its end was split in two. Every seq
+        # came back, so it was put back together.
+        ring = self.q.get_cpu_queue(min(self.cpus))
+        rec_size = (12 + ctypes.sizeof(self.Event) + 7) & ~7
+        self.assertEqual(rec_size, 40)
+        self.assertNotEqual(ring.data_size % rec_size, 0)
+        self.assertGreater(370 * rec_size, ring.data_size)
+
+    def test_get_items(self):
+        self.check_events(
+            lambda q: [ev.seq for ev in q.get_items(timeout_ms=0)])
+
+    @unittest.skipIf(py2bpf.datastructures.numpy is None, 'requires numpy')
+    def test_get_array(self):
+        self.check_events(
+            lambda q: list(q.get_array(timeout_ms=0)['seq']))
+
+    def test_lost(self):
+        # Only about 100 fit, and the rest are reported lost once there's
+        # room again
+        self.send(200)
+        before = self.q.stats.snapshot()
+        self.q.get_items(timeout_ms=0)
+        self.send(1)
+        self.q.get_items()
+
+        stats = self.q.stats.total()
+        self.assertGreater(stats.lost, 0)
+        self.assertEqual(stats.records + stats.lost, 201)
+        self.assertGreater(stats.max_fill, stats.size - 40)
+        self.assertEqual(before.total().records, 0)
+
+
+class RingBufSmokeTest(unittest.TestCase):
+    class Event(ctypes.Structure):
+        _fields_ = [
+            ('len', ctypes.c_uint32),
+            ('kind', ctypes.c_uint32),
+        ]
+
+    def test_events(self):
+        Event = self.Event
+        q = py2bpf.datastructures.RingBufQueue(Event, num_pages=1)
+
+        def fn(skb):
+            ev = py2bpf.funcs.ringbuf_reserve(q)
+            if ev:
+                ev.len = skb.len
+                ev.kind = 1
+                if skb.len > 100:
+                    py2bpf.funcs.ringbuf_discard(ev, 0)
+                else:
+                    py2bpf.funcs.ringbuf_submit(ev, 0)
+            copy = Event()
+            copy.len = skb.len
+            copy.kind = 2
+            py2bpf.funcs.ringbuf_output(q, copy, 0)
+            return 0
+
+        p = py2bpf.prog.create_prog(
+            py2bpf.prog.ProgType.SOCKET_FILTER,
+            py2bpf.socket_filter.SkBuffContext, fn)
+        raw = socket.socket(
+            socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            raw.setsockopt(socket.SOL_SOCKET, 50, p.fd)
+            self.assertEqual(q.get_items(timeout_ms=0), [])
+
+            udp.sendto(b'x', ('127.0.0.1', 9))
+            udp.sendto(b'x' * 200, ('127.0.0.1', 9))
+            events = []
+            while len(events) < 3:
+                events.extend(q.get_items())
+
+            # The discarded reservation for the big packet never shows up
+            self.assertEqual(
+                [(ev.len, ev.kind) for ev in events],
+                [(29, 1), (29, 2), (228, 2)])
+        finally:
+            udp.close()
+            raw.close()
+            p.close()
+            q.close()
+
+
+class LoadSmokeTest(unittest.TestCase):
+    def test_load_time(self):
+        p = py2bpf.prog.create_prog(
+            py2bpf.prog.ProgType.SOCKET_FILTER,
+            py2bpf.socket_filter.SkBuffContext,
+            lambda ctx: 0,
+        )
+        self.assertGreater(p.load_time, 0)
+        self.assertEqual(p.pretty, '')
+        p.close()
+
+    @unittest.skipIf(len(py2bpf.util.get_bpf_fs_mounts()) == 0,
+                     'requires a bpf filesystem')
+    def test_pin(self):
+        p = py2bpf.prog.create_prog(
+            py2bpf.prog.ProgType.SOCKET_FILTER,
+            py2bpf.socket_filter.SkBuffContext,
+            lambda ctx: 0,
+        )
+        with tempfile.TemporaryDirectory(
+                dir=py2bpf.util.get_bpf_fs_mounts()[0]) as d:
+            path = os.path.join(d, 'prog')
+            p.pin(path)
+            p.close()
+
+            p = py2bpf.prog.Prog.open_pinned(
+                path, py2bpf.prog.ProgType.SOCKET_FILTER)
+            self.assertEqual(
+                p.prog_type, py2bpf.prog.ProgType.SOCKET_FILTER)
+            p.close()
+
+            with self.assertRaises(ValueError):
+                py2bpf.prog.Prog.open_pinned(
+                    path, py2bpf.prog.ProgType.KPROBE)
+
+    def test_log_on_failure(self):
+        # R0 is never set, so the verifier rejects this
+        insns = [bi.Ret()]
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            with self.assertRaises(OSError):
+                py2bpf.prog.Prog(
+                    py2bpf.prog.ProgType.SOCKET_FILTER, insns, {},
+                    log_size=128)
+        self.assertIn('R0', err.getvalue())
+
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            with self.assertRaises(OSError):
+                py2bpf.prog.Prog(
+                    py2bpf.prog.ProgType.SOCKET_FILTER, insns, {},
+                    log_level=0)
+        self.assertNotIn('R0', err.getvalue())
+
+
+class CompileManySmokeTest(unittest.TestCase):
+    def test_compile_many(self):
+        m = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint64, 4)
+
+        def make_fn(n):
+            def fn(ctx):
+                m[n] += 1
+                return n
+            return fn
+
+        progs = [(py2bpf.prog.ProgType.SOCKET_FILTER,
+                  py2bpf.socket_filter.SkBuffContext, make_fn(n))
+                 for n in range(4)]
+        ps = py2bpf.prog.compile_many(progs, processes=2)
+        self.assertEqual(len(ps), 4)
+        for p in ps:
+            self.assertGreaterEqual(p.fd, 0)
+            p.close()
+
+        with tempfile.TemporaryDirectory() as d:
+            ps = py2bpf.prog.compile_many(progs, processes=2, cache_dir=d)
+            ps += py2bpf.prog.compile_many(progs, processes=2, cache_dir=d)
+            for p1, p2 in zip(ps[:4], ps[4:]):
+                self.assertEqual(bytes(p1.raw_insns), bytes(p2.raw_insns))
+            for p in ps:
+                p.close()
+        m.close()
+
+    def test_compile_many_error(self):
+        def fn(ctx):
+            return ctx.no_such_field
+
+        with self.assertRaises(py2bpf.exception.TranslationError):
+            py2bpf.prog.compile_many([
+                (py2bpf.prog.ProgType.SOCKET_FILTER,
+                 py2bpf.socket_filter.SkBuffContext, lambda ctx: 0),
+                (py2bpf.prog.ProgType.SOCKET_FILTER,
+                 py2bpf.socket_filter.SkBuffContext, fn),
+            ], processes=2)
+
+
+class CacheSmokeTest(unittest.TestCase):
+    def create_prog(self, fn, cache_dir):
+        return py2bpf.prog.create_prog(
+            py2bpf.prog.ProgType.SOCKET_FILTER,
+            py2bpf.socket_filter.SkBuffContext,
+            fn,
+            cache_dir=cache_dir,
+        )
+
+    def test_cache_hit(self):
+        m = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint64, 4)
+
+        def fn(ctx):
+            return m[ctx.protocol]
+
+        with tempfile.TemporaryDirectory() as d:
+            p1 = self.create_prog(fn, d)
+            p2 = self.create_prog(fn, d)
+            self.assertIsNotNone(p1.bpf_insns)
+            self.assertIsNone(p2.bpf_insns)
+            self.assertEqual(bytes(p1.raw_insns), bytes(p2.raw_insns))
+            p1.close()
+            p2.close()
+        m.close()
+
+    def test_cache_miss_on_changed_closure(self):
+        def make_fn(val):
+            return lambda ctx: val
+
+        with tempfile.TemporaryDirectory() as d:
+            p1 = self.create_prog(make_fn(1), d)
+            p2 = self.create_prog(make_fn(2), d)
+            self.assertIsNotNone(p2.bpf_insns)
+            self.assertNotEqual(bytes(p1.raw_insns), bytes(p2.raw_insns))
+            p1.close()
+            p2.close()
+
+    def test_cache_miss_on_changed_helper_closure(self):
+        def make_fn(val):
+            def limit():
+                return val
+            return lambda ctx: limit()
+
+        with tempfile.TemporaryDirectory() as d:
+            p1 = self.create_prog(make_fn(5), d)
+            p2 = self.create_prog(make_fn(9), d)
+            self.assertIsNotNone(p2.bpf_insns)
+            self.assertNotEqual(bytes(p1.raw_insns), bytes(p2.raw_insns))
+            p1.close()
+            p2.close()
+
+    def test_impure_builtin_uncacheable(self):
+        key, _ = _cache.get_key(
+            py2bpf.prog.ProgType.SOCKET_FILTER,
+            py2bpf.socket_filter.SkBuffContext,
+            lambda ctx: os.getpid())
+        self.assertIsNone(key)
+
+        key, _ = _cache.get_key(
+            py2bpf.prog.ProgType.SOCKET_FILTER,
+            py2bpf.socket_filter.SkBuffContext,
+            lambda ctx: socket.htons(80))
+        self.assertIsNotNone(key)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+import ctypes
+import errno
+import ipaddress
+import os
+import tempfile
+import threading
+import unittest
+import py2bpf.datastructures
+import py2bpf.util
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class MapTest(unittest.TestCase):
+    def setUp(self):
+        self.m = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint64, 4)
+
+    def tearDown(self):
+        self.m.close()
+
+    def test_elem_ops(self):
+        self.m[1] = 10
+        self.m[2] = 20
+        self.assertEqual(self.m[1].value, 10)
+        self.assertEqual(sorted(k.value for k in self.m.keys()), [1, 2])
+
+        del self.m[1]
+        with self.assertRaises(KeyError):
+            self.m[1]
+        with self.assertRaises(KeyError):
+            del self.m[1]
+
+    def test_full(self):
+        for k in range(4):
+            self.m[k] = k
+        with self.assertRaises(OSError) as cm:
+            self.m[4] = 4
+        self.assertEqual(cm.exception.errno, errno.E2BIG)
+
+    def test_threads(self):
+        def worker(base):
+            for n in range(1000):
+                self.m[base] = base + n
+                self.assertEqual(self.m[base].value, base + n)
+
+        threads = [threading.Thread(target=worker, args=(k,))
+                   for k in range(1, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(v.value for _, v in self.m.items()),
+                         [1000, 1001, 1002, 1003])
+
+    def test_batch(self):
+        self.m.update_batch([1, 2, 3], [10, 20, 30])
+        keys, values = self.m.lookup_batch()
+        self.assertEqual(sorted(zip(keys, values)),
+                         [(1, 10), (2, 20), (3, 30)])
+
+        self.m.delete_batch([1])
+        with self.assertRaises(KeyError):
+            self.m.delete_batch([1])
+
+        keys, values = self.m.lookup_and_delete_batch()
+        self.assertEqual(sorted(keys), [2, 3])
+        self.assertEqual(len(self.m.lookup_batch()[0]), 0)
+
+    def test_batch_fallback(self):
+        self.m._unsupported_batch_cmds = frozenset(
+            py2bpf.datastructures._MapCmd)
+        self.m.update_batch([1, 2], [10, 20])
+        keys, values = self.m.lookup_batch()
+        self.assertEqual(sorted(zip(keys, values)), [(1, 10), (2, 20)])
+        self.m.delete_batch([1, 2])
+        self.assertEqual(len(self.m.lookup_batch()[0]), 0)
+
+    def test_iteration(self):
+        for k in range(4):
+            self.m[k] = k * 10
+        for unsupported in [frozenset(),
+                            frozenset(py2bpf.datastructures._MapCmd)]:
+            self.m._unsupported_batch_cmds = unsupported
+            self.assertEqual(len(self.m), 4)
+            self.assertIn(0, self.m)
+            self.assertNotIn(4, self.m)
+            self.assertEqual(sorted(k.value for k in self.m), [0, 1, 2, 3])
+            self.assertEqual(
+                sorted((k.value, v.value)
+                       for k, v in self.m.items(chunk_size=1)),
+                [(0, 0), (1, 10), (2, 20), (3, 30)])
+
+        # Deleting as we go restarts iteration from the first key
+        for k in self.m.keys():
+            del self.m[k]
+        self.assertEqual(len(self.m), 0)
+
+
+class ArrayMapTest(unittest.TestCase):
+    def test_batch_delete_unsupported(self):
+        m = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint64, 4,
+            map_type=py2bpf.datastructures.BpfMapType.ARRAY)
+        m.update_batch([1, 2], [10, 20])
+
+        # Array elements can't be deleted, one at a time or otherwise
+        with self.assertRaises(OSError):
+            m.lookup_and_delete_batch()
+        with self.assertRaises(OSError):
+            m.delete_batch([1])
+
+        # which doesn't stop the batches that do work
+        self.assertEqual(m._unsupported_batch_cmds, frozenset())
+        keys, values = m.lookup_batch()
+        self.assertEqual(list(values), [0, 10, 20, 0])
+        m.close()
+
+
+class PerCpuMapTest(unittest.TestCase):
+    def setUp(self):
+        self.m = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint32, 4,
+            map_type=py2bpf.datastructures.BpfMapType.PERCPU_HASH)
+        self.num_cpus = py2bpf.datastructures.get_num_possible_cpus()
+
+    def tearDown(self):
+        self.m.close()
+
+    def test_elem_ops(self):
+        self.m[1] = 5
+        self.assertEqual([v.value for v in self.m[1]], [5] * self.num_cpus)
+        self.m[2] = range(self.num_cpus)
+        self.assertEqual(self.m.aggregate(2, 'max'), self.num_cpus - 1)
+        self.assertEqual(self.m.aggregate(2), sum(range(self.num_cpus)))
+        with self.assertRaises(ValueError):
+            self.m[3] = [1] * (self.num_cpus + 1)
+
+    def test_batch(self):
+        self.m.update_batch([1, 2], [3, [4] * self.num_cpus])
+        self.assertEqual(
+            sorted((k.value, [c.value for c in v])
+                   for k, v in self.m.items()),
+            [(1, [3] * self.num_cpus), (2, [4] * self.num_cpus)])
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_numpy(self):
+        self.m.from_numpy([1, 2], [10, 20])
+        keys, values = self.m.to_numpy()
+        self.assertEqual(values.shape, (2, self.num_cpus))
+        keys, values = self.m.to_numpy(aggregate='sum')
+        self.assertEqual(sorted(zip(keys, values)),
+                         [(1, 10 * self.num_cpus), (2, 20 * self.num_cpus)])
+
+
+class LruMapTest(unittest.TestCase):
+    def setUp(self):
+        # LRU maps keep free lists, and with NO_COMMON_LRU whole LRU lists,
+        # per cpu, so which entries survive depends on where we run
+        self.cpus = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, [min(self.cpus)])
+
+    def tearDown(self):
+        os.sched_setaffinity(0, self.cpus)
+
+    def check_eviction(self, map_type, map_flags=0):
+        m = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint64, 16, map_type=map_type,
+            map_flags=map_flags)
+        try:
+            # Overfilling never fails, it just pushes the oldest entries out
+            for i in range(100):
+                m[i] = i
+            keys = sorted(k.value for k in m.keys())
+            self.assertLessEqual(len(keys), 16)
+            self.assertGreater(len(keys), 0)
+            self.assertEqual(keys, list(range(100 - len(keys), 100)))
+            self.assertNotIn(0, m)
+        finally:
+            m.close()
+
+    def test_lru_hash(self):
+        T = py2bpf.datastructures.BpfMapType
+        self.check_eviction(T.LRU_HASH)
+        self.check_eviction(
+            T.LRU_HASH, py2bpf.datastructures.BpfMapFlags.NO_COMMON_LRU)
+
+    def test_lru_percpu_hash(self):
+        self.check_eviction(
+            py2bpf.datastructures.BpfMapType.LRU_PERCPU_HASH)
+
+
+@unittest.skipIf(len(py2bpf.util.get_bpf_fs_mounts()) == 0,
+                 'requires a bpf filesystem')
+class PinTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(
+            dir=py2bpf.util.get_bpf_fs_mounts()[0])
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pin_map(self):
+        T = py2bpf.datastructures.BpfMapType
+        path = os.path.join(self.dir, 'm')
+        m = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint64, 4, map_type=T.LRU_HASH)
+        m[1] = 10
+        m.pin(path)
+        m.close()
+
+        m = py2bpf.datastructures.BpfMap.open_pinned(
+            path, ctypes.c_uint32, ctypes.c_uint64)
+        self.assertEqual(m.MAP_TYPE, T.LRU_HASH)
+        self.assertEqual(m.max_entries, 4)
+        self.assertEqual(m[1].value, 10)
+        m[2] = 20
+        m.close()
+
+        with self.assertRaises(ValueError):
+            py2bpf.datastructures.BpfMap.open_pinned(
+                path, ctypes.c_uint32, ctypes.c_uint32)
+        with self.assertRaises(FileNotFoundError):
+            py2bpf.datastructures.BpfMap.open_pinned(
+                os.path.join(self.dir, 'missing'), ctypes.c_uint32,
+                ctypes.c_uint64)
+
+    def test_pin_per_cpu_map(self):
+        path = os.path.join(self.dir, 'm')
+        m = py2bpf.datastructures.create_map(
+            ctypes.c_uint32, ctypes.c_uint32, 4,
+            map_type=py2bpf.datastructures.BpfMapType.PERCPU_ARRAY)
+        m[1] = 3
+        m.pin(path)
+        m.close()
+
+        m = py2bpf.datastructures.BpfMap.open_pinned(
+            path, ctypes.c_uint32, ctypes.c_uint32)
+        self.assertIsInstance(m, py2bpf.datastructures.PerCpuBpfMap)
+        self.assertEqual(m.aggregate(1), 3 * m.num_cpus)
+        m.close()
+
+
+class MapOfMapsTest(unittest.TestCase):
+    def test_replace(self):
+        T = py2bpf.datastructures.BpfMapType
+        for map_type in [T.ARRAY_OF_MAPS, T.HASH_OF_MAPS]:
+            template = py2bpf.datastructures.create_map(
+                ctypes.c_uint32, ctypes.c_uint64, 8)
+            m = py2bpf.datastructures.create_map_of_maps(
+                ctypes.c_uint32, template, 2, map_type=map_type)
+            template.close()
+
+            inner = m.replace(0, [1, 2], [10, 20])
+            self.assertEqual(inner[2].value, 20)
+            first_id = m[0].value
+            self.assertNotEqual(first_id, 0)
+
+            m.replace(0, [3], [30]).close()
+            self.assertNotEqual(m[0].value, first_id)
+            inner.close()
+
+            with self.assertRaises(KeyError):
+                m[1]
+            m.close()
+
+
+class LpmTrieTest(unittest.TestCase):
+    def test_longest_prefix(self):
+        t = py2bpf.datastructures.create_lpm_trie(
+            ctypes.c_uint8 * 4, ctypes.c_uint32, 16)
+        t['10.0.0.0/8'] = 8
+        t[ipaddress.ip_network('10.1.0.0/16')] = 16
+        t['10.1.2.3'] = 32
+
+        self.assertEqual(t['10.2.0.1'].value, 8)
+        self.assertEqual(t[ipaddress.ip_address('10.1.0.1')].value, 16)
+        self.assertEqual(t['10.1.2.3'].value, 32)
+        self.assertNotIn('11.0.0.1', t)
+        self.assertEqual(
+            sorted(str(k.to_network()) for k in t.keys()),
+            ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.3/32'])
+
+        del t['10.1.0.0/16']
+        self.assertEqual(t['10.1.0.1'].value, 8)
+        with self.assertRaises(ValueError):
+            t['::1/128'] = 1
+        t.close()
+
+
+class MmapArrayTest(unittest.TestCase):
+    def test_shared_memory(self):
+        a = py2bpf.datastructures.create_mmap_array(ctypes.c_uint32, 4)
+        self.assertEqual(len(a), 4)
+        a[1] = 5
+        self.assertEqual(a[1].value, 5)
+        # Elements are padded to 8 bytes
+        self.assertEqual(a.as_ctypes()[1].value, 5)
+        with self.assertRaises(IndexError):
+            a[4]
+
+        # The syscall path sees the same memory
+        self.assertEqual(
+            [(k.value, v.value) for k, v in a.items()],
+            [(0, 0), (1, 5), (2, 0), (3, 0)])
+        a.close()
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_numpy_view(self):
+        a = py2bpf.datastructures.create_mmap_array(ctypes.c_uint64, 4)
+        view = a.as_numpy()
+        view[2] = 7
+        self.assertEqual(a[2].value, 7)
+        a.close()
+
+
+class RingBufQueueTest(unittest.TestCase):
+    def test_empty(self):
+        q = py2bpf.datastructures.RingBufQueue(ctypes.c_uint64, num_pages=1)
+        self.assertEqual(q.size, q.pagesz)
+        self.assertEqual(q.get_items(timeout_ms=0), [])
+        q.close()
+
+    def test_num_pages(self):
+        with self.assertRaises(ValueError):
+            py2bpf.datastructures.RingBufQueue(ctypes.c_uint64, num_pages=3)
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class NumpyTest(unittest.TestCase):
+    class Flow(ctypes.Structure):
+        _fields_ = [
+            ('addr', ctypes.c_uint8 * 4),
+            ('port', ctypes.c_uint16),
+        ]
+
+    def test_round_trip(self):
+        m = py2bpf.datastructures.create_map(self.Flow, ctypes.c_uint64, 8)
+        keys, values = m.to_numpy()
+        self.assertEqual(len(keys), 0)
+        self.assertEqual(keys.dtype.names, ('addr', 'port'))
+
+        keys = numpy.zeros(3, dtype=keys.dtype)
+        keys['addr'][:, 0] = [10, 11, 12]
+        keys['port'] = 80
+        m.from_numpy(keys, numpy.arange(3) * 100)
+
+        keys, values = m.to_numpy()
+        self.assertEqual(sorted(zip(keys['addr'][:, 0], values)),
+                         [(10, 0), (11, 100), (12, 200)])
+        self.assertEqual(m[self.Flow(addr=(11, 0, 0, 0), port=80)].value, 100)
+        m.close()
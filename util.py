@@ -13,3 +13,11 @@ def ensure_resources():
     resource.setrlimit(
         resource.RLIMIT_MEMLOCK,
         (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+
+
+def get_bpf_fs_mounts():
+    '''Where bpf filesystems, which maps and programs can be pinned to, are
+    mounted. Usually just /sys/fs/bpf.
+    '''
+    with open('/proc/mounts') as f:
+        return [l.split()[1] for l in f if l.split()[2] == 'bpf']